@@ -0,0 +1,496 @@
+"""
+
+Copyright 2017 bol.com. All Rights Reserved
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Offline benchmarks of the Python side of the comparison (no Hive nor BigQuery cluster is needed).
+
+The tables are replaced by a fake backend that replays some result sets: either synthetic ones (with a configurable
+number of buckets, number of columns, skew and rate of differences), or the ones recorded in a snapshot file (see
+--save-snapshot). Each scenario measures the generation of the SQL queries, the building of the results of the Count
+and sha queries, their comparison, the analysis of the column blocks and the rendering of the HTML differences.
+
+The timings are appended to a history file, and compared to the previous runs of the same scenario on the same
+machine, so that the regressions can be spotted.
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hive_compared_bq"))
+# the modules of the project are only reachable once the path is set
+import compact
+import hive_compared_bq
+import local_checksums
+# noinspection PyProtectedMember
+from hive_compared_bq import _Table, TableComparator
+
+AVERAGE_ROWS_PER_BUCKET = 7
+SHUFFLE_PRIME = 1000003  # the databases do not return the buckets in order: they are replayed in a "shuffled" order
+LOCAL_ROWS = 20000  # number of rows of the small table whose checksums are computed locally
+
+
+class SyntheticDataset(object):
+    """Generate on the fly the results of the queries, for 2 tables with some differences
+
+    Some buckets (``difference_rate`` of them) are different: for half of them the destination table has one more row,
+    for the others one of the column blocks is different.
+
+    :type number_buckets: int
+    :param number_buckets: the number of Group By values (buckets)
+
+    :type number_columns: int
+    :param number_columns: the number of columns of the tables
+
+    :type skew_factor: float
+    :param skew_factor: the first bucket contains ``skew_factor`` times more rows than the average (0: no skew)
+
+    :type difference_rate: float
+    :param difference_rate: the proportion of the buckets that are different
+
+    :type seed: int
+    :param seed: the seed of the random generator, so that the same scenario always gives the same data
+    """
+
+    def __init__(self, number_buckets, number_columns, skew_factor, difference_rate, seed=0):
+        self.number_buckets = number_buckets
+        self.number_columns = number_columns
+        self.skew_factor = skew_factor
+        self.seed = seed
+        number_differences = int(number_buckets * difference_rate)
+        differences = random.Random(seed).sample(xrange(number_buckets), number_differences)
+        self.count_differences = set(differences[:number_differences // 2])
+        self.sha_differences = set(differences[number_differences // 2:])
+
+    def get_columns(self):
+        """Return the description of the columns of the tables"""
+        return [{"name": "col_%i" % i, "type": "string" if i % 3 else "bigint"} for i in range(self.number_columns)]
+
+    def get_number_blocks(self, block_size):
+        return (self.number_columns + block_size - 1) // block_size
+
+    def iter_buckets(self):
+        """Return the buckets in a "shuffled" order, as a database would do"""
+        step = SHUFFLE_PRIME
+        while self.number_buckets % step == 0:
+            step += 2
+        return ((i * step) % self.number_buckets for i in xrange(self.number_buckets))
+
+    def get_count(self, bucket, side):
+        count = 1 + (bucket * 2654435761 % 4294967296) % (2 * AVERAGE_ROWS_PER_BUCKET - 1)
+        if bucket == 0 and self.skew_factor > 0:
+            count = int(self.skew_factor * AVERAGE_ROWS_PER_BUCKET)
+        if side == "dst" and bucket in self.count_differences:
+            count += 1
+        return count
+
+    def _is_different(self, bucket, side):
+        return side == "dst" and (bucket in self.count_differences or bucket in self.sha_differences)
+
+    def get_row_sha(self, bucket, side):
+        return base64.b64encode(struct.pack(">QQI", bucket, self.seed, int(self._is_different(bucket, side))))
+
+    def get_block_shas(self, bucket, side, number_blocks):
+        different_block = bucket % number_blocks if self._is_different(bucket, side) else -1
+        return ["%026x%s=" % (bucket * number_blocks + i, "d" if i == different_block else "s")
+                for i in range(number_blocks)]
+
+
+class RecordedDataset(SyntheticDataset):
+    """Replay the results recorded in a snapshot file for the source table (the destination table gets the same
+    results, except for some synthetic differences)
+
+    :type file_name: str
+    :param file_name: the path of the snapshot file
+
+    :type difference_rate: float
+    :param difference_rate: the proportion of the buckets that are different in the destination table
+    """
+
+    def __init__(self, file_name, difference_rate):
+        import snapshot
+        content = snapshot.read_snapshot(file_name)
+        self._columns = [{"name": str(x["name"]), "type": str(x["type"])} for x in content["columns"]]
+        self._buckets = [x[0] for x in content["buckets"] if x[2] is not None]
+        self._records = dict((x[0], x) for x in content["buckets"] if x[2] is not None)
+        SyntheticDataset.__init__(self, len(self._buckets), len(self._columns), 0, difference_rate)
+        self.count_differences = set(self._buckets[i] for i in self.count_differences)
+        self.sha_differences = set(self._buckets[i] for i in self.sha_differences)
+        self._differences = self.count_differences | self.sha_differences
+
+    def get_columns(self):
+        return self._columns
+
+    def iter_buckets(self):
+        return (self._buckets[i] for i in SyntheticDataset.iter_buckets(self))
+
+    def get_count(self, bucket, side):
+        return self._records[bucket][1] + int(side == "dst" and bucket in self.count_differences)
+
+    def get_row_sha(self, bucket, side):
+        if side == "dst" and bucket in self._differences:
+            return base64.b64encode(struct.pack(">QQI", bucket, self.seed, 1))
+        return self._records[bucket][2]
+
+    def get_block_shas(self, bucket, side, number_blocks):
+        shas = list(self._records[bucket][3])
+        if side == "dst" and bucket in self._differences:
+            shas[bucket % len(shas)] += "d"
+        return shas
+
+
+class FakeTable(_Table):
+    """_Table backend that replays the results of a dataset instead of executing the queries
+
+    :type side: str
+    :param side: "src" or "dst", the side of the dataset that is replayed
+
+    :type dataset: :class:`SyntheticDataset`
+    :param dataset: the dataset
+
+    :type latency: float
+    :param latency: the time (in seconds) waited before returning the results of each query
+    """
+
+    def __init__(self, side, parent, dataset, latency):
+        _Table.__init__(self, "benchmark", side, parent)
+        self.side = side
+        self.dataset = dataset
+        self.latency = latency
+        self._ddl_columns = dataset.get_columns()
+        self._group_by_column = self._ddl_columns[0]["name"]
+
+    def _wait(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def get_type(self):
+        return "fake"
+
+    def fetch_ddl_columns(self):
+        return self.dataset.get_columns(), []
+
+    def fetch_table_version(self):
+        return "benchmark"
+
+    def get_metadata_row_count(self):
+        return None
+
+    def get_metadata_partition_row_counts(self, column, values):
+        return dict((value, None) for value in values)
+
+    def get_table_size(self):
+        return None
+
+    def get_column_statistics(self, query, selected_columns):
+        pass
+
+    def get_sql_sample_clause(self, percent):
+        return ""
+
+    def get_sql_quick_check_condition(self, modulo, residue):
+        return "TRUE"
+
+    def get_sql_bucket_expression(self):
+        return "gb"
+
+    def get_sql_column_value(self, col):
+        return col["name"]
+
+    def create_sql_groupby_count(self):
+        return "counts"
+
+    def create_sql_show_bucket_columns(self, extra_columns_str, buckets_values):
+        return "rows"
+
+    def create_sql_bucket_index(self, columns, buckets_values):
+        return "bucket_index"
+
+    def create_sql_column_checksums(self, columns, buckets_values):
+        return "column_checksums"
+
+    def create_sql_intermediate_checksums(self, buckets_values=None):
+        return "shas"
+
+    def create_sql_row_values(self):
+        return "row_values"
+
+    def create_sql_iblt(self, number_cells):
+        return "iblt"
+
+    def create_sql_additive_checksums(self, column, low, high):
+        return "additive_checksums"
+
+    def create_sql_show_rows_by_keys(self, columns, keys):
+        return "rows"
+
+    def delete_temporary_table(self, table_name):
+        pass
+
+    def create_temporary_table(self, query):
+        self._wait()
+        return "bucket_index"
+
+    def temporary_table_exists(self, table_name):
+        return True
+
+    def launch_query_dict_result(self, query, result_dic, all_columns_from_2=False, query_type="count"):
+        self._wait()
+        for bucket in self.dataset.iter_buckets():
+            result_dic[bucket] = self.dataset.get_count(bucket, self.side)
+
+    def launch_query_csv_compare_result(self, query, rows, query_type="drilldown"):
+        self._wait()
+
+    def launch_query_rows_result(self, query, rows, query_type="drilldown"):
+        self._wait()
+
+    def launch_query_with_intermediate_table(self, query, result):
+        self._wait()
+        result["names_sha_tables"][self.get_id_string()] = "benchmark.temp_" + self.side
+        sha_dictionary = result["sha_dictionaries"][self.get_id_string()]
+        for bucket in self.dataset.iter_buckets():
+            sha_dictionary[bucket] = self.dataset.get_row_sha(bucket, self.side)
+
+    def launch_query_block_shas(self, temp_table, buckets_values, result_dic):
+        self._wait()
+        number_blocks = len(self.get_column_blocks(self.get_ddl_columns()))
+        for bucket in buckets_values.split(","):
+            bucket = int(bucket)
+            result_dic[bucket] = self.dataset.get_block_shas(bucket, self.side, number_blocks)
+
+
+def create_sql_tables(tc, columns):
+    """Return the Hive and BigQuery tables used to measure the generation of the SQL queries (without connection)
+
+    :rtype: list of :class:`_Table`
+    :returns: the tables, or only some of them if the modules of Hive or BigQuery are not installed
+    """
+    tables = []
+    for module_name, class_name in (("hive", "THive"), ("bq", "TBigQuery")):
+        try:
+            module = __import__(module_name)
+        except ImportError as e:
+            logging.warning("The generation of the SQL queries of %s cannot be measured: %s", class_name, e)
+            continue
+        table = getattr(module, class_name).__new__(getattr(module, class_name))  # no connection to the database
+        _Table.__init__(table, "benchmark", "sql", tc)
+        table._ddl_columns = columns
+        table._group_by_column = columns[0]["name"]
+        table.jarPath = None
+        table.engine = None
+        table._storage_information = {}
+        tables.append(table)
+    return tables
+
+
+class Timer(object):
+    """Measure the durations of the steps of a scenario (the best one of several repetitions)"""
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = {}
+
+    def measure(self, name, function, *args):
+        """Execute the function ``repeat`` times, keep its best duration and return the result of its last execution"""
+        best = None
+        result = None
+        for _ in range(self.repeat):
+            start = time.time()
+            try:
+                result = function(*args)
+            except SystemExit as e:  # the comparisons stop the program in some cases (for instance on skew)
+                result = e
+            duration = time.time() - start
+            best = duration if best is None else min(best, duration)
+        self.results[name] = best
+        logging.info("%-28s %10.4f s", name, best)
+        return result
+
+
+def run_scenario(dataset, latency, repeat, output_dir):
+    """Execute all the measurements on a dataset
+
+    :rtype: dict
+    :returns: the best duration (in seconds) of each step
+    """
+    tc = TableComparator()
+    tc.number_of_group_by = dataset.number_buckets
+    tc.skew_threshold = 40000
+    tsrc = FakeTable("src", tc, dataset, latency)
+    tdst = FakeTable("dst", tc, dataset, latency)
+    tc.set_tsrc(tsrc)
+    tc.set_tdst(tdst)
+    timer = Timer(repeat)
+
+    for table in create_sql_tables(tc, tsrc.get_ddl_columns()):
+        timer.measure("sql_sha_" + table.get_type(), table.create_sql_intermediate_checksums)
+
+    def build(digests):
+        store = compact.BucketArray(digests)
+        for bucket in dataset.iter_buckets():
+            store[bucket] = dataset.get_row_sha(bucket, "src") if digests else dataset.get_count(bucket, "src")
+        return store
+
+    timer.measure("build_counts", build, False)
+    timer.measure("build_shas", build, True)
+
+    big = build(False)
+    small = compact.BucketArray()
+    tdst.launch_query_dict_result("counts", small)
+    timer.measure("count_differences", compact.count_differences, big, small, tc.skew_threshold)
+    src_shas = build(True)
+    dst_shas = compact.BucketArray(True)
+    tdst.launch_query_with_intermediate_table("shas", {"names_sha_tables": {}, "sha_dictionaries": {
+        tdst.get_id_string(): dst_shas}})
+    timer.measure("digest_differences", compact.digest_differences, src_shas, dst_shas)
+
+    timer.measure("compare_groupby_count", tc.compare_groupby_count)
+    sha_results = timer.measure("compare_shas", tc.compare_shas)
+    if isinstance(sha_results, tuple) and len(sha_results[0]) > 0:
+        timer.measure("column_blocks_analysis", tc.get_column_blocks_most_differences, sha_results[0],
+                      sha_results[1])
+
+    number_columns = len(dataset.get_columns())
+    local_rows = [(idx % dataset.number_buckets, str(idx)) + tuple("%i_%i" % (idx, col)
+                                                                   for col in range(number_columns))
+                  for idx in range(LOCAL_ROWS)]
+    block_lengths = [len(block) for block in tsrc.get_column_blocks(tsrc.get_ddl_columns())]
+    timer.measure("local_checksums", local_checksums.compute_checksums, local_rows, block_lengths)
+
+    number_blocks = dataset.get_number_blocks(tc.block_size)
+    differences = sorted(dataset.sha_differences | dataset.count_differences)[:1000]
+    rows = {}
+    for side in ("src", "dst"):  # the column block with differences is shown, like in show_results_final_differences
+        rows[side] = ["^ %i | %s $" % (bucket, dataset.get_block_shas(bucket, side, number_blocks)[
+            bucket % number_blocks]) for bucket in differences]
+    timer.measure("html_diff", lambda: TableComparator.display_html_diff(
+        dict((k, list(v)) for k, v in rows.items()), os.path.join(output_dir, "benchmark_diff"), " , block shas"))
+    return timer.results
+
+
+def load_history(file_name):
+    """Return the previous results (one dict per scenario and run) stored in the history file"""
+    if not os.path.exists(file_name):
+        return []
+    with open(file_name) as f:
+        return [json.loads(line) for line in f if line.strip() != ""]
+
+
+def find_regressions(history, scenario, results, tolerance, number_runs=5):
+    """Compare the results of a scenario with the median of its last runs on the same machine
+
+    :rtype: list of tuple
+    :returns: the ``(step, duration, reference duration)`` of the steps that are slower than the reference multiplied
+                by the tolerance
+    """
+    previous = [x for x in history if x["scenario"] == scenario and x["machine"] == platform.node()][-number_runs:]
+    regressions = []
+    for step, duration in sorted(results.items()):
+        durations = sorted(x["results"][step] for x in previous if step in x["results"])
+        if len(durations) == 0:
+            continue
+        reference = durations[len(durations) // 2]
+        if duration > reference * tolerance and duration - reference > 0.01:  # ignore the noise of the tiny steps
+            regressions.append((step, duration, reference))
+    return regressions
+
+
+def parse_arguments():
+    """Parse the arguments received on the command line and returns the args element of argparse"""
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the Python side of hive_compared_bq",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--buckets", default="10000,100000",
+                        help="the numbers of buckets (Group By values) of the scenarios (default: 10000,100000)")
+    parser.add_argument("--columns", default="10,500",
+                        help="the numbers of columns of the scenarios (default: 10,500)")
+    parser.add_argument("--skew-factor", type=float, default=0,
+                        help="the first bucket has this number of times more rows than the average (default: 0)")
+    parser.add_argument("--difference-rate", type=float, default=0.001,
+                        help="the proportion of the buckets with differences (default: 0.001)")
+    parser.add_argument("--snapshot", help="replay the results recorded in this snapshot file (see --save-snapshot) "
+                                           "instead of\nsynthetic results (--buckets and --columns are then ignored)")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="the time (in seconds) waited by the fake tables before returning the results of each "
+                             "query")
+    parser.add_argument("--repeat", type=int, default=3, help="number of executions of each step (the best duration "
+                                                               "is kept, default: 3)")
+    parser.add_argument("--history", default=os.path.join(os.path.expanduser("~"), ".hive_compared_bq",
+                                                          "benchmark_history.jsonl"),
+                        help="the file where the results are appended (default: "
+                             "~/.hive_compared_bq/benchmark_history.jsonl)")
+    parser.add_argument("--tolerance", type=float, default=1.3,
+                        help="a step is reported as a regression if it is slower than this factor multiplied by the "
+                             "median\nof its last 5 runs (default: 1.3)")
+    parser.add_argument("--no-history", action="store_true", help="do not compare with nor save into the history")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s]\t[%(asctime)s]  %(message)s')
+    hive_compared_bq.webbrowser.open = lambda *a, **k: True  # the HTML differences are rendered but not shown
+
+    if args.snapshot is not None:
+        scenarios = [("snapshot=%s|differences=%s" % (os.path.basename(args.snapshot), args.difference_rate),
+                      lambda: RecordedDataset(args.snapshot, args.difference_rate))]
+    else:
+        scenarios = []
+        for number_buckets in [int(x) for x in args.buckets.split(",")]:
+            for number_columns in [int(x) for x in args.columns.split(",")]:
+                name = "buckets=%i|columns=%i|skew=%s|differences=%s" % (number_buckets, number_columns,
+                                                                          args.skew_factor, args.difference_rate)
+                scenarios.append((name, lambda b=number_buckets, c=number_columns: SyntheticDataset(
+                    b, c, args.skew_factor, args.difference_rate)))
+
+    history = [] if args.no_history else load_history(args.history)
+    output_dir = tempfile.mkdtemp(prefix="hive_compared_bq_benchmark_")
+    all_regressions = []
+    try:
+        for name, create_dataset in scenarios:
+            logging.info("Scenario %s (latency: %s s)", name, args.latency)
+            results = run_scenario(create_dataset(), args.latency, args.repeat, output_dir)
+            scenario = "%s|latency=%s" % (name, args.latency)
+            if args.no_history:
+                continue
+            for step, duration, reference in find_regressions(history, scenario, results, args.tolerance):
+                logging.warning("REGRESSION in %s: %s took %.4f s instead of %.4f s", scenario, step, duration,
+                                reference)
+                all_regressions.append((scenario, step))
+            directory = os.path.dirname(args.history)
+            if directory != "" and not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(args.history, "a") as f:
+                f.write(json.dumps({"date": time.strftime("%Y-%m-%d %H:%M:%S"), "machine": platform.node(),
+                                    "python": platform.python_version(), "numpy": compact.numpy is not None,
+                                    "scenario": scenario, "results": results}) + "\n")
+    finally:
+        shutil.rmtree(output_dir)
+
+    if len(all_regressions) > 0:
+        sys.exit("%i regressions were found" % len(all_regressions))
+
+if __name__ == "__main__":
+    main()
@@ -17,11 +17,14 @@ limitations under the License.
 """
 
 import logging
+import re
 import sys
 import time
 # noinspection PyProtectedMember
 from hive_compared_bq import _Table
+import iblt
 from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
 
 
 class TBigQuery(_Table):
@@ -52,21 +55,23 @@ class TBigQuery(_Table):
 
         self.project = project  # the Google Cloud project where this dataset/table belongs.If Null, then the default
         #  environment where this script is executed is used.
-        self.connection = self._create_connection()
+        self.connection = self.acquire_connection()
+        self._bq_table = None  # the table object with its metadata, see get_table_metadata()
 
-        # check that we can reach dataset and table
-        dataset = self.connection.dataset(database)
-        if not dataset.exists():
-            raise AttributeError("The dataset %s:%s does not seem to exist or is unreachable" % (project, database))
-
-        mytable = dataset.table(table)
-        if not mytable.exists():
-            raise AttributeError("The table %s:%s.%s does not seem to exist or is unreachable" %
+        # check that we can reach dataset and table. This is done with a single round trip, whose result (the schema
+        # and the metadata of the table) is kept for later
+        try:
+            self.get_table_metadata()
+        except NotFound:
+            raise AttributeError("The table %s:%s.%s (or its dataset) does not seem to exist or is unreachable" %
                                  (project, database, table))
 
     def get_type(self):
         return "bigQuery"
 
+    def get_connection_key(self):
+        return "bigQuery", self.project
+
     def _create_connection(self):
         """Connect to the table and return the connection object that we will use to launch queries"""
         if self.project is None:
@@ -74,29 +79,75 @@ class TBigQuery(_Table):
         else:
             return bigquery.Client(project=self.project)
 
-    def get_ddl_columns(self):
-        if len(self._ddl_columns) > 0:
-            return self._ddl_columns
-        else:
-            dataset = self.connection.dataset(self.database)
-            table = dataset.table(self.table)
-            table.reload()
-            schema = table.schema
-
-            all_columns = []
-            for field in schema:
-                col_name = str(field.name)
-                col_type = str(
-                    field.field_type.lower())  # force 'str' to remove unicode notation and align it to Hive format
-                # let's align the types with the ones in Hive
-                if col_type == 'integer':
-                    col_type = 'bigint'
-                my_dic = {"name": col_name, "type": col_type}
-                all_columns.append(my_dic)
+    def get_table_metadata(self):
+        """Return the (reloaded) table object of the Google Cloud API, that contains the schema and the metadata
 
-            self.filter_columns_from_cli(all_columns)
+        The table is only reloaded once, since all the metadata (schema, modification time...) come with the same call.
 
-            return self._ddl_columns
+        :rtype: :class:`google.cloud.bigquery.table.Table`
+        :returns: the table object
+        """
+        if self._bq_table is None:
+            table = self.connection.dataset(self.database).table(self.table)
+            table.reload()
+            self._bq_table = table
+        return self._bq_table
+
+    def fetch_ddl_columns(self):
+        schema = self.get_table_metadata().schema
+
+        all_columns = []
+        for field in schema:
+            col_name = str(field.name)
+            col_type = str(
+                field.field_type.lower())  # force 'str' to remove unicode notation and align it to Hive format
+            # let's align the types with the ones in Hive
+            if col_type == 'integer':
+                col_type = 'bigint'
+            my_dic = {"name": col_name, "type": col_type}
+            all_columns.append(my_dic)
+
+        return all_columns, []
+
+    def fetch_table_version(self):
+        # the metadata also contain the schema, so the metadata cache only saves the sample query of the BigQuery tables
+        table = self.get_table_metadata()
+        return "%s/%s" % (table.modified, table.num_bytes)
+
+    def get_metadata_row_count(self):
+        table = self.get_table_metadata()
+        if self.where_condition is not None or table._properties.get("streamingBuffer") is not None:
+            return None  # the rows still in the streaming buffer are not counted in the metadata
+        return table.num_rows
+
+    def get_table_size(self):
+        return None  # the BigQuery queries do not have any startup latency, so the checksums are not computed locally
+
+    def get_metadata_partition_row_counts(self, column, values):
+        counts = dict((value, None) for value in values)
+        table = self.get_table_metadata()
+        partitioning = table._properties.get("timePartitioning")
+        if self.where_condition is not None or partitioning is None or partitioning.get("type", "DAY") != "DAY" \
+                or table._properties.get("streamingBuffer") is not None:
+            return counts
+        if partitioning.get("field") is None:  # partitioned by ingestion time
+            if column not in ("_PARTITIONTIME", "_PARTITIONDATE"):
+                return counts
+        elif partitioning["field"] != column:
+            return counts
+
+        for value in values:
+            match = re.match(r"(\d{4})-?(\d{2})-?(\d{2})", value)
+            if match is None:
+                continue
+            # the metadata of a partition are reached with the decorator: table$YYYYMMDD
+            partition = self.connection.dataset(self.database).table(self.table + "$" + "".join(match.groups()))
+            try:
+                partition.reload()
+                counts[value] = partition.num_rows
+            except NotFound:
+                logging.debug("No metadata found for the partition %s of %s", value, self.get_id_string())
+        return counts
 
     def get_column_statistics(self, query, selected_columns):
         for row in self.query(query):
@@ -104,65 +155,155 @@ class TBigQuery(_Table):
                 value_column = row[idx]
                 col["Counter"][value_column] += 1
 
+    def get_sql_sample_clause(self, percent):
+        return "TABLESAMPLE SYSTEM (%s PERCENT)" % percent  # only the sampled storage blocks are read (and billed)
+
+    def get_sql_quick_check_condition(self, modulo, residue):
+        return "MOD( hash2( cast(%s as STRING)) & 2147483647, %i) = %i" % (self.get_groupby_column(), modulo, residue)
+
+    def get_sql_bucket_expression(self):
+        return "MOD( hash2( cast(%s as STRING)), %i)" % (self.get_groupby_column(), self.tc.number_of_group_by)
+
+    def get_sql_column_value(self, col):
+        name = col["name"]
+        bq_value_name = name
+        if col["type"] == 'decimal':  # removing trailing & unnecessary 'zero decimal' (*.0)
+            bq_value_name = 'regexp_replace( %s, "\\.0$", "")' % name
+        elif col["type"] == 'float' or col["type"] == 'double':
+            bq_value_name = "cast( cast( FLOOR( %s * 10000) as INT64) as STRING)" % name
+        elif not col["type"] == 'string':
+            bq_value_name = "cast( %s as STRING)" % name
+        return "CASE WHEN %s IS NULL THEN 'n_%s' ELSE %s END" % (name, name[:2], bq_value_name)
+
     def create_sql_groupby_count(self):
-        where_condition = ""
-        if self.where_condition is not None:
-            where_condition = "WHERE " + self.where_condition
-        query = self.hash2_js_udf + "SELECT MOD( hash2( cast(%s as STRING)), %i) as gb, count(*) as count FROM %s %s " \
-                                    "GROUP BY gb ORDER BY gb" \
-                                    % (self.get_groupby_column(), self.tc.number_of_group_by, self.full_name,
-                                       where_condition)
+        query = self.hash2_js_udf + "SELECT %s as gb, count(*) as count FROM %s GROUP BY gb ORDER BY gb" \
+                                    % (self.get_sql_bucket_expression(), self.get_sql_scan_source())
         logging.debug("BigQuery query is: %s", query)
         return query
 
     def create_sql_show_bucket_columns(self, extra_columns_str, buckets_values):
-        where_condition = ""
-        if self.where_condition is not None:
-            where_condition = self.where_condition + " AND"
-        gb_column = self.get_groupby_column()
-        bq_query = self.hash2_js_udf + "SELECT MOD( hash2( cast(%s as STRING)), %i) as bucket, %s as gb, %s FROM %s " \
-                                       "WHERE %s MOD( hash2( cast(%s as STRING)), %i) IN (%s)" \
-                                       % (gb_column, self.tc.number_of_group_by, gb_column, extra_columns_str,
-                                          self.full_name, where_condition, gb_column, self.tc.number_of_group_by,
-                                          buckets_values)
+        bucket_expression, source = self.get_sql_bucket_source(buckets_values)
+        bq_query = self.hash2_js_udf + "SELECT %s as bucket, %s as gb, %s FROM %s" \
+                                       % (bucket_expression, self.get_groupby_column(), extra_columns_str, source)
         logging.debug("BQ query to show the buckets and the extra columns is: %s", bq_query)
 
         return bq_query
 
-    def create_sql_intermediate_checksums(self):
-        column_blocks = self.get_column_blocks(self.get_ddl_columns())
-        number_of_blocks = len(column_blocks)
-        logging.debug("%i column_blocks (with a size of %i columns) have been considered: %s", number_of_blocks,
-                      self.tc.block_size, str(column_blocks))
+    def create_sql_bucket_index(self, columns, buckets_values):
+        bucket_expression, source = self.get_sql_bucket_source(buckets_values)
+        bq_query = self.hash2_js_udf + "SELECT %s as hcbq_bucket, %s FROM %s" \
+                                       % (bucket_expression, ", ".join(columns), source)
+        logging.debug("BQ query to create the bucket index is: %s", bq_query)
+
+        return bq_query
+
+    def create_sql_column_checksums(self, columns, buckets_values):
+        key_value = self.get_sql_key_value()  # each value is tied to its row, just like for the column blocks
+        values = ", ".join(["concat( %s, '|', %s) as col_%i" % (key_value, self.get_sql_column_value(col), idx)
+                            for idx, col in enumerate(columns)])
+        list_shas = ", ".join(["TO_BASE64( sha1( STRING_AGG( col_%i, '|' ORDER BY col_%i))) as col_%i_gb"
+                               % (idx, idx, idx) for idx in range(len(columns))])
+        bucket_expression, source = self.get_sql_bucket_source(buckets_values)
+        bq_query = self.hash2_js_udf + "SELECT gb, count(*) as count, %s FROM (\nSELECT %s as gb, %s FROM %s\n) " \
+                                       "GROUP BY gb" % (list_shas, bucket_expression, values, source)
+        logging.debug("BQ query to get the checksums of each column is: %s", bq_query)
+
+        return bq_query
 
-        # Generate the concatenations for the column_blocks
+    def get_sql_block_shas(self, column_blocks):
+        """Return the SQL expressions of the checksums of the column blocks, named block_0, block_1...
+
+        :type column_blocks: list of list
+        :param column_blocks: the column blocks (see get_column_blocks())
+
+        :rtype: str
+        :returns: the ',' separated SQL expressions
+        """
+        # Generate the concatenations for the column_blocks. Each block also contains the value of the Group By column,
+        # so that the checksum of a block is tied to its row (see get_column_blocks_most_differences)
+        key_value = self.get_sql_key_value()
         bq_basic_shas = ""
         for idx, block in enumerate(column_blocks):
-            bq_basic_shas += "TO_BASE64( sha1( concat( "
+            bq_basic_shas += "TO_BASE64( sha1( concat( %s, '|', " % key_value
             for col in block:
-                name = col["name"]
-                bq_value_name = name
-                if col["type"] == 'decimal':  # removing trailing & unnecessary 'zero decimal' (*.0)
-                    bq_value_name = 'regexp_replace( %s, "\\.0$", "")' % name
-                elif col["type"] == 'float' or col["type"] == 'double':
-                    bq_value_name = "cast( cast( FLOOR( %s * 10000) as INT64) as STRING)" % name
-                elif not col["type"] == 'string':
-                    bq_value_name = "cast( %s as STRING)" % name
-                bq_basic_shas += "CASE WHEN %s IS NULL THEN 'n_%s' ELSE %s END, '|'," % (name, name[:2], bq_value_name)
+                bq_basic_shas += "%s, '|'," % self.get_sql_column_value(col)
             bq_basic_shas = bq_basic_shas[:-6] + "))) as block_%i,\n" % idx
-        bq_basic_shas = bq_basic_shas[:-2]
+        return bq_basic_shas[:-2]
+
+    def create_sql_row_keys(self, extra_columns, condition=None):
+        """Return the query that computes the key of each row (see the iblt module), with some extra columns
+
+        :type extra_columns: list of str
+        :param extra_columns: the names of the columns to fetch along with the key
+
+        :type condition: str
+        :param condition: if defined, another condition the rows must match (see get_sql_scan_source())
+
+        :rtype: str
+        :returns: the query (without the UDF definition), that returns the extra columns and the column ``row_key``
+        """
+        column_blocks = self.get_column_blocks(self.get_ddl_columns())
+        list_blocks = ", ".join(["block_%i" % i for i in range(len(column_blocks))])
+        extra = "".join(["%s, " % col for col in extra_columns])
+        row_key = "CAST( CONCAT( '0x', SUBSTR( TO_HEX( sha1( concat( %s))), 1, %i)) AS INT64)" \
+                  % (list_blocks, iblt.KEY_HEX_DIGITS)
+        return "SELECT %s%s as row_key FROM (\nSELECT %s%s\nFROM %s\n)" \
+               % (extra, row_key, extra, self.get_sql_block_shas(column_blocks), self.get_sql_scan_source(condition))
+
+    def create_sql_iblt(self, number_cells):
+        size = iblt.get_subtable_size(number_cells)
+        cells = "MOD( DIV( row_key, 1099511627776), %i), %i + MOD( MOD( DIV( row_key, 1048576), 1048576), %i), " \
+                "%i + MOD( MOD( row_key, 1048576), %i)" % (size, size, size, 2 * size, size)  # 3 slices of 20 bits
+        check = "MOD( MOD( row_key, %i) * MOD( row_key, %i), %i)" % ((iblt.CHECK_PRIME,) * 3)
+        bq_query = self.hash2_js_udf + "SELECT cell, count(*) as count, SUM( CAST( row_key AS NUMERIC)) as key_sum, " \
+                                       "SUM( CAST( %s AS NUMERIC)) as check_sum FROM (\n%s\n) AS row_keys\n" \
+                                       "CROSS JOIN UNNEST([%s]) AS cell GROUP BY cell" \
+                                       % (check, self.create_sql_row_keys([]), cells)
+        logging.debug("BigQuery IBLT query is:\n%s", bq_query)
 
-        where_condition = ""
-        if self.where_condition is not None:
-            where_condition = "WHERE " + self.where_condition
+        return bq_query
+
+    def create_sql_additive_checksums(self, column, low, high):
+        condition = self.get_sql_incremental_condition(column, low, high)
+        bq_query = self.hash2_js_udf + "SELECT %s as gb, count(*) as count, SUM( CAST( row_key AS NUMERIC)) as " \
+                                       "key_sum FROM (\n%s\n) GROUP BY gb" \
+                                       % (self.get_sql_bucket_expression(),
+                                          self.create_sql_row_keys([self.get_groupby_column()], condition))
+        logging.debug("BigQuery query to get the additive checksums is:\n%s", bq_query)
+
+        return bq_query
+
+    def create_sql_show_rows_by_keys(self, columns, keys):
+        bq_query = self.hash2_js_udf + "SELECT %s FROM (\n%s\n) WHERE row_key IN (%s)" \
+                                       % (", ".join(columns), self.create_sql_row_keys(columns),
+                                          ", ".join([str(k) for k in keys]))
+        logging.debug("BQ query to show the rows of some keys is: %s", bq_query)
+
+        return bq_query
+
+    def create_sql_row_values(self):
+        values = ", ".join([self.get_sql_column_value(col) for col in self.get_ddl_columns()])
+        bq_query = self.hash2_js_udf + "SELECT %s as gb, %s, %s FROM %s" \
+                                       % (self.get_sql_bucket_expression(), self.get_sql_key_value(), values,
+                                          self.get_sql_scan_source())
+        logging.debug("BQ query to get the values of all the rows is: %s", bq_query)
+
+        return bq_query
 
-        bq_query = self.hash2_js_udf + "WITH blocks AS (\nSELECT MOD( hash2( cast(%s as STRING)), %i) as gb,\n%s\n" \
-                                       "FROM %s %s\n),\n" \
-                                       % (self.get_groupby_column(), self.tc.number_of_group_by, bq_basic_shas,
-                                          self.full_name, where_condition)  # 1st CTE with the basic block shas
+    def create_sql_intermediate_checksums(self, buckets_values=None):
+        column_blocks = self.get_column_blocks(self.get_ddl_columns())
+        number_of_blocks = len(column_blocks)
+        logging.debug("%i column_blocks (with a size of %i columns) have been considered: %s", number_of_blocks,
+                      self.tc.block_size, str(column_blocks))
+
+        bq_basic_shas = self.get_sql_block_shas(column_blocks)
+        bq_query = self.hash2_js_udf + "WITH blocks AS (\nSELECT %s as gb,\n%s\nFROM %s\n),\n" \
+                                       % (self.get_sql_bucket_expression(), bq_basic_shas,
+                                          self.get_sql_scan_source())  # 1st CTE with the basic block shas
         list_blocks = ", ".join(["block_%i" % i for i in range(number_of_blocks)])
-        bq_query += "full_lines AS(\nSELECT gb, TO_BASE64( sha1( concat( %s))) as row_sha, %s FROM blocks\n)\n" \
-                    % (list_blocks, list_blocks)  # 2nd CTE to get all the info of a row
+        buckets_filter = "" if buckets_values is None else " WHERE gb IN (%s)" % buckets_values
+        bq_query += "full_lines AS(\nSELECT gb, TO_BASE64( sha1( concat( %s))) as row_sha, %s FROM blocks%s\n)\n" \
+                    % (list_blocks, list_blocks, buckets_filter)  # 2nd CTE to get all the info of a row
         bq_list_shas = ", ".join(["TO_BASE64( sha1( STRING_AGG( block_%i, '|' ORDER BY block_%i))) as block_%i_gb "
                                   % (i, i, i) for i in range(number_of_blocks)])
         bq_query += "SELECT gb, TO_BASE64( sha1( STRING_AGG( row_sha, '|' ORDER BY row_sha))) as row_sha_gb, %s FROM " \
@@ -174,6 +315,35 @@ class TBigQuery(_Table):
     def delete_temporary_table(self, table_name):
         pass  # The temporary (cached) tables in BigQuery are deleted after 24 hours
 
+    def create_temporary_table(self, query):
+        return self.query_ctas_bq(query)
+
+    def temporary_table_exists(self, table_name):
+        dataset, table = table_name.split('.')
+        return self.connection.dataset(dataset).table(table).exists()
+
+    def estimate_query_bytes(self, query):
+        q = self.connection.run_sync_query(query)
+        q.use_legacy_sql = False
+        q.dry_run = True  # the query is only validated, and the number of bytes it would process is computed
+        q.run()
+        return q.total_bytes_processed
+
+    def reserve_budget(self, query):
+        """Check that the query fits in the budget of the run (see --max-bytes-billed) and reserve its bytes
+
+        :type query: str
+        :param query: query to execute in BigQuery
+
+        :rtype: int
+        :returns: the remaining budget before this query, or None if the run has no budget
+
+        :raises: IOError if the query would exceed the budget
+        """
+        if self.tc.budget is None:
+            return None
+        return self.tc.budget.reserve(self.estimate_query_bytes(query), "The query on %s" % self.get_id_string())
+
     def query(self, query):
         """Execute the received query in BigQuery and return an iterate Result object
 
@@ -182,7 +352,14 @@ class TBigQuery(_Table):
 
         :rtype: list of rows
         :returns: the QueryResults for this query
+
+        :raises: IOError if the query would exceed the budget of the run
         """
+        remaining_budget = self.reserve_budget(query)
+        if remaining_budget is not None:
+            # the synchronous queries cannot carry a maximum of bytes billed, so that BigQuery enforces the budget
+            logging.debug("Launching BigQuery query as a job, within the budget")
+            return self.run_async_job(query, remaining_budget).results().fetch_data()
         logging.debug("Launching BigQuery query")
         q = self.connection.run_sync_query(query)
         q.timeout_ms = 600000  # 10 minutes to execute the BQ query should be more than enough. 1 minute was too short
@@ -205,13 +382,36 @@ class TBigQuery(_Table):
         :rtype: str
         :returns: the full name of the cache table (dataset.table) that stores those results
 
-        :raises: IOError if the query has some execution errors
+        :raises: IOError if the query has some execution errors, or would exceed the budget of the run
         """
         logging.debug("Launching BigQuery CTAS query")
+        job = self.run_async_job(query, self.reserve_budget(query))
+        cache_table = job.destination.dataset_name + '.' + job.destination.name
+        logging.debug("The cache table of the final comparison query in BigQuery is: " + cache_table)
+
+        return cache_table
+
+    def run_async_job(self, query, maximum_bytes_billed=None):
+        """Execute the received query in BigQuery as a job, and wait for its end
+
+        :type query: str
+        :param query: query to execute in BigQuery
+
+        :type maximum_bytes_billed: int
+        :param maximum_bytes_billed: if defined, BigQuery fails the query instead of billing more bytes (see
+                --max-bytes-billed)
+
+        :rtype: :class:`google.cloud.bigquery.job.QueryJob`
+        :returns: the finished job
+
+        :raises: IOError if the query has some execution errors
+        """
         job_name = "job_hive_compared_bq_%f" % time.time()  # Job ID must be unique
         job = self.connection.run_async_query(job_name.replace('.', '_'),
                                               query)  # replace(): Job IDs must be alphanumeric
         job.use_legacy_sql = False
+        if maximum_bytes_billed is not None:
+            job.maximum_bytes_billed = maximum_bytes_billed  # the budget is also enforced by BigQuery itself
         job.begin()
         time.sleep(3)  # 3 second is the minimum latency we get in BQ in general. So no need to try fetching before
         retry_count = 300  # 10 minutes (because of below time sleep of 2 seconds). This should be enough
@@ -219,17 +419,13 @@ class TBigQuery(_Table):
             retry_count -= 1
             time.sleep(2)
             job.reload()
-        logging.debug("BigQuery CTAS query finished")
+        logging.debug("BigQuery job finished")
 
         if job.errors is not None:
             raise IOError("There was a problem in executing the query in BigQuery: %s" % str(job.errors))
+        return job
 
-        cache_table = job.destination.dataset_name + '.' + job.destination.name
-        logging.debug("The cache table of the final comparison query in BigQuery is: " + cache_table)
-
-        return cache_table
-
-    def launch_query_dict_result(self, query, result_dic, all_columns_from_2=False):
+    def launch_query_dict_result(self, query, result_dic, all_columns_from_2=False, query_type="count"):
         for row in self.query(query):
             if not all_columns_from_2:
                 result_dic[row[0]] = row[1]
@@ -237,12 +433,17 @@ class TBigQuery(_Table):
                 result_dic[row[0]] = row[2:]
         logging.debug("All %i BigQuery rows fetched", len(result_dic))
 
-    def launch_query_csv_compare_result(self, query, rows):
+    def launch_query_csv_compare_result(self, query, rows, query_type="drilldown"):
         for row in self.query(query):
             line = "^ " + " | ".join([str(col) for col in row]) + " $"
             rows.append(line)
         logging.debug("All %i BigQuery rows fetched", len(rows))
 
+    def launch_query_rows_result(self, query, rows, query_type="drilldown"):
+        for row in self.query(query):
+            rows.append(tuple(row))
+        logging.debug("All %i BigQuery rows fetched", len(rows))
+
     def launch_query_with_intermediate_table(self, query, result):
         try:
             result["names_sha_tables"][self.get_id_string()] = self.query_ctas_bq(query)
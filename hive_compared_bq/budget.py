@@ -0,0 +1,80 @@
+"""
+
+Copyright 2017 bol.com. All Rights Reserved
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import threading
+
+
+def format_bytes(number_bytes):
+    """Return a human readable representation of a number of bytes, for instance: '12.35 GB'"""
+    for unit, size in (("TB", 10 ** 12), ("GB", 10 ** 9), ("MB", 10 ** 6)):
+        if number_bytes >= size:
+            return "%.2f %s" % (float(number_bytes) / size, unit)
+    return "%i bytes" % number_bytes
+
+
+class BytesBudget(object):
+    """Keep track of the bytes processed (and billed) by the BigQuery queries of a run, to not exceed a maximum
+
+    Before being submitted, each query is executed in "dry run" mode to know how many bytes it would process. Those
+    bytes are then reserved in the budget, and the query is refused if the budget is not big enough.
+
+    The same object is shared by all the tables of the run (including the ones of the partitions, see
+    create_partition_comparator()), so several queries may reserve some bytes at the same time.
+
+    :type max_bytes: int
+    :param max_bytes: the maximum number of bytes that the queries of the run may process
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.reserved_bytes = 0
+        self._lock = threading.Lock()
+
+    def get_remaining(self):
+        """Return the number of bytes that can still be processed
+
+        :rtype: int
+        :returns: the remaining budget, in bytes
+        """
+        with self._lock:
+            return max(0, self.max_bytes - self.reserved_bytes)
+
+    def reserve(self, number_bytes, description):
+        """Reserve the bytes processed by a query, if they fit in the remaining budget
+
+        :type number_bytes: int
+        :param number_bytes: the number of bytes the query would process
+
+        :type description: str
+        :param description: the description of the query, for the logs (ex: "The query on bigQuery_dataset.table")
+
+        :rtype: int
+        :returns: the remaining budget before the reservation, that can be enforced on the query itself
+
+        :raises: IOError if the query would exceed the remaining budget
+        """
+        with self._lock:
+            remaining = max(0, self.max_bytes - self.reserved_bytes)
+            if number_bytes > remaining:
+                raise IOError("%s would process %s, more than the remaining budget of %s (see --max-bytes-billed)"
+                              % (description, format_bytes(number_bytes), format_bytes(remaining)))
+            self.reserved_bytes += number_bytes
+        logging.debug("%s will process %s (%s of the budget used so far)", description, format_bytes(number_bytes),
+                      format_bytes(self.reserved_bytes))
+        return remaining
@@ -0,0 +1,188 @@
+"""
+
+Copyright 2017 bol.com. All Rights Reserved
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+
+
+def _byte_strings(value):
+    """Transform (recursively) the unicode strings read from JSON into 'str', to remove the unicode notation"""
+    if isinstance(value, dict):
+        return dict((_byte_strings(k), _byte_strings(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_byte_strings(x) for x in value]
+    if not isinstance(value, str) and isinstance(value, type(u"")):
+        return value.encode("utf-8")
+    return value
+
+
+class RunCheckpoint(object):
+    """Persist the results of each phase of a comparison (a "run"), so that the run can be resumed later on
+
+    The state of the run is stored in a JSON file, in a directory dedicated to this run. Each phase (synchronisation of
+    the tables, count, sha...) saves its results once it is finished, so that a resumed run can skip it.
+
+    :type runs_dir: str
+    :param runs_dir: the directory where all the runs are stored
+
+    :type run_id: str
+    :param run_id: the identifier of the run. If None, a new identifier is generated
+    """
+
+    def __init__(self, runs_dir, run_id=None):
+        if run_id is None:
+            run_id = time.strftime("%Y%m%d_%H%M%S") + "_%i" % os.getpid()
+        self.run_id = run_id
+        self.directory = os.path.join(runs_dir, run_id)
+        self.file_name = os.path.join(self.directory, "state.json")
+        self._lock = threading.Lock()
+        self._state = {"description": None, "phases": {}}
+
+    @staticmethod
+    def load(runs_dir, run_id):
+        """Return the checkpoint of a previous run
+
+        :type runs_dir: str
+        :param runs_dir: the directory where all the runs are stored
+
+        :type run_id: str
+        :param run_id: the identifier of the run to resume
+
+        :rtype: :class:`RunCheckpoint`
+        :returns: the checkpoint, with the results of the phases that were finished
+
+        :raises: ValueError if the run cannot be found
+        """
+        checkpoint = RunCheckpoint(runs_dir, run_id)
+        if not os.path.exists(checkpoint.file_name):
+            raise ValueError("The state of the run %s could not be found in %s" % (run_id, checkpoint.file_name))
+        with open(checkpoint.file_name) as f:
+            checkpoint._state = _byte_strings(json.load(f))
+        logging.info("Resuming the run %s. Finished phases: %s", run_id, sorted(checkpoint._state["phases"].keys()))
+        return checkpoint
+
+    @staticmethod
+    def delete_old_runs(runs_dir, max_age, excluded_runs=()):
+        """Delete the states of the runs that were not modified since more than ``max_age`` seconds
+
+        Otherwise a directory would be kept forever for each run (and for each job of the service).
+
+        :type runs_dir: str
+        :param runs_dir: the directory where all the runs are stored
+
+        :type max_age: int
+        :param max_age: the age (in seconds) above which the state of a run is deleted
+
+        :type excluded_runs: list of str
+        :param excluded_runs: the identifiers of the runs to keep, whatever their age (the current ones)
+
+        :rtype: list of str
+        :returns: the identifiers of the runs deleted
+        """
+        if not os.path.isdir(runs_dir):
+            return []
+        deleted = []
+        limit = time.time() - max_age
+        for run_id in os.listdir(runs_dir):
+            file_name = os.path.join(runs_dir, run_id, "state.json")
+            if run_id in excluded_runs or not os.path.exists(file_name) or os.path.getmtime(file_name) >= limit:
+                continue
+            try:
+                shutil.rmtree(os.path.join(runs_dir, run_id))
+                deleted.append(run_id)
+            except OSError:  # for instance deleted by another run at the same time
+                logging.debug("The state of the run %s could not be deleted: %s", run_id, sys.exc_info()[1])
+        if len(deleted) > 0:
+            logging.info("The states of %i old runs were deleted", len(deleted))
+        return deleted
+
+    def check_description(self, description):
+        """Register the description of the comparison, or check that it is the same as the one of the resumed run
+
+        :type description: dict
+        :param description: what describes the comparison (tables, WHERE conditions, columns...)
+
+        :raises: ValueError if the run was made with another description
+        """
+        description = _byte_strings(json.loads(json.dumps(description)))  # same representation as the one read from
+        # the file
+        if self._state["description"] is None:
+            self._state["description"] = description
+            self.save()
+        elif self._state["description"] != description:
+            raise ValueError("The run %s cannot be resumed because it was made with other parameters: %s"
+                             % (self.run_id, self._state["description"]))
+
+    def get_description(self):
+        """Return the description of the comparison (see check_description())"""
+        return self._state["description"]
+
+    def has_phase(self, name):
+        """Return True if the phase has been finished (and its results saved)"""
+        with self._lock:
+            return name in self._state["phases"]
+
+    def get_phase(self, name):
+        """Return the results (dict) saved for the phase"""
+        with self._lock:
+            return self._state["phases"][name]
+
+    def get_phase_names(self):
+        """Return the names (sorted) of the phases that have been finished, to follow the progress of the run"""
+        with self._lock:
+            return sorted(self._state["phases"].keys())
+
+    def save_phase(self, name, results):
+        """Save the results of a phase that has just been finished
+
+        :type name: str
+        :param name: name of the phase
+
+        :type results: dict
+        :param results: the results of the phase. Must be serializable in JSON
+        """
+        with self._lock:
+            self._state["phases"][name] = results
+        self.save()
+
+    def remove_phases(self, names):
+        """Forget the results of some phases (for instance because they depend on some temporary tables that have been
+        deleted since)
+
+        :type names: list of str
+        :param names: the names of the phases
+        """
+        with self._lock:
+            for name in names:
+                self._state["phases"].pop(name, None)
+        self.save()
+
+    def save(self):
+        """Write the state of the run on disk (in an atomic way, so that a crash cannot corrupt it)"""
+        with self._lock:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            tmp_file = self.file_name + ".tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(self._state, f)
+            os.rename(tmp_file, self.file_name)
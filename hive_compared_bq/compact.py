@@ -0,0 +1,285 @@
+"""
+
+Copyright 2017 bol.com. All Rights Reserved
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Compact storage of the results of the Count and sha queries (one value per bucket).
+
+A Python dictionary costs more than 100 bytes per bucket (hash table entry, int object, base64 string...). Here the
+buckets are kept in an array of integers, and the values in an array of integers (counts) or in a bytearray of fixed
+size binary digests (the sha1 are decoded from base64), so that a bucket only costs 16 or 28 bytes. The comparisons of
+2 tables are done on the sorted arrays, with vectorized operations if numpy is installed (it is optional).
+"""
+
+import array
+import base64
+import bisect
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # the comparisons are then done with some (slower) loops
+
+DIGEST_SIZE = 20  # size of a sha1 in bytes
+
+
+def _int_array(data):
+    """Return an array of integers built from its binary representation"""
+    result = array.array('l')
+    if hasattr(result, "frombytes"):
+        result.frombytes(data)
+    else:
+        result.fromstring(data)  # Python 2
+    return result
+
+
+class BucketArray(object):
+    """Store one value (a count or a sha1 digest) per bucket, in a compact way
+
+    It is filled like the dictionaries given to _Table.launch_query_dict_result(): ``store[bucket] = value``, including
+    the special ``store["error"] = exception`` in case of error. The buckets are sorted the first time they are read.
+
+    :type digests: bool
+    :param digests: True if the values are (base64 encoded) sha1 digests, False if they are integers
+    """
+
+    def __init__(self, digests=False):
+        self.digests = digests
+        self.error = None
+        self._keys = array.array('l')
+        self._values = bytearray() if digests else array.array('l')
+        self._sorted = True
+
+    def __setitem__(self, key, value):
+        if key == "error":
+            self.error = value
+            return
+        key = int(key)
+        if len(self._keys) > 0 and key <= self._keys[-1]:
+            self._sorted = False
+        self._keys.append(key)
+        if self.digests:
+            digest = base64.b64decode(value)
+            if len(digest) != DIGEST_SIZE:
+                raise ValueError("The value %s of the bucket %i is not a base64 encoded sha1" % (value, key))
+            self._values.extend(digest)
+        else:
+            self._values.append(int(value))
+
+    def copy_from(self, other):
+        """Replace the content by the one of another BucketArray of the same kind (the values are not decoded)"""
+        other._sort()
+        self.error = other.error
+        self._keys = array.array('l', other._keys)
+        self._values = bytearray(other._values) if self.digests else array.array('l', other._values)
+        self._sorted = True
+
+    def update(self, other):
+        """Add all the (bucket, value) pairs of a dictionary"""
+        for key, value in other.items():
+            self[key] = value
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _find(self, key):
+        """Return the position of the bucket in the (sorted) arrays, or -1 if it is not stored"""
+        self._sort()
+        idx = bisect.bisect_left(self._keys, key)
+        if idx < len(self._keys) and self._keys[idx] == key:
+            return idx
+        return -1
+
+    def __contains__(self, key):
+        if key == "error":
+            return self.error is not None
+        return self._find(key) >= 0
+
+    def _get_value(self, idx):
+        """Return the value stored at a given position, in the format it was received"""
+        if self.digests:
+            return base64.b64encode(bytes(self._values[idx * DIGEST_SIZE:(idx + 1) * DIGEST_SIZE])).decode("ascii")
+        return self._values[idx]
+
+    def __getitem__(self, key):
+        if key == "error" and self.error is not None:
+            return self.error
+        idx = self._find(key)
+        if idx < 0:
+            raise KeyError(key)
+        return self._get_value(idx)
+
+    def get(self, key, default=None):
+        idx = self._find(key)
+        return default if idx < 0 else self._get_value(idx)
+
+    def keys(self):
+        self._sort()
+        return list(self._keys)
+
+    def iteritems(self):
+        self._sort()
+        for idx, key in enumerate(self._keys):
+            yield key, self._get_value(idx)
+
+    items = iteritems
+
+    def nbytes(self):
+        """Return the memory (in bytes) used by the arrays"""
+        return len(self._keys) * self._keys.itemsize + \
+            (len(self._values) if self.digests else len(self._values) * self._values.itemsize)
+
+    def _sort(self):
+        """Sort the arrays by bucket (only needed if the buckets were not received in order)"""
+        if self._sorted:
+            return
+        if numpy is not None:
+            keys = numpy.frombuffer(self._keys, dtype="i%i" % self._keys.itemsize)
+            order = numpy.argsort(keys, kind="mergesort")
+            self._keys = _int_array(keys[order].tobytes())
+            if self.digests:
+                self._values = bytearray(numpy.frombuffer(self._values, dtype=numpy.uint8)
+                                         .reshape(-1, DIGEST_SIZE)[order].tobytes())
+            else:
+                self._values = _int_array(numpy.frombuffer(self._values, dtype="i%i" % self._values.itemsize)[order]
+                                          .tobytes())
+            self._sorted = True
+            return
+        order = sorted(range(len(self._keys)), key=self._keys.__getitem__)
+        self._keys = array.array('l', [self._keys[i] for i in order])
+        if self.digests:
+            self._values = bytearray().join(self._values[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE] for i in order)
+        else:
+            self._values = array.array('l', [self._values[i] for i in order])
+        self._sorted = True
+
+    def _key_vector(self):
+        """Return the (sorted) buckets as a numpy array, without copying them"""
+        self._sort()
+        return numpy.frombuffer(self._keys, dtype="i%i" % self._keys.itemsize)
+
+    def _value_vector(self):
+        """Return the values as a numpy array (one row of DIGEST_SIZE bytes per bucket for digests)"""
+        self._sort()
+        if self.digests:
+            return numpy.frombuffer(self._values, dtype=numpy.uint8).reshape(-1, DIGEST_SIZE)
+        return numpy.frombuffer(self._values, dtype="i%i" % self._values.itemsize)
+
+
+def _match(first, second):
+    """Return, for each bucket of ``first`` (in sorted order), its position in ``second`` or -1 if it is not there
+
+    :type first: :class:`BucketArray`
+    :param first: the buckets to look for
+
+    :type second: :class:`BucketArray`
+    :param second: the buckets where to look
+
+    :rtype: list of int or :class:`numpy.ndarray`
+    :returns: the positions in ``second``
+    """
+    first._sort()
+    second._sort()
+    if numpy is not None:
+        first_keys = first._key_vector()
+        second_keys = second._key_vector()
+        if len(second_keys) == 0:
+            return numpy.full(len(first_keys), -1, dtype=numpy.int64)
+        positions = numpy.searchsorted(second_keys, first_keys)
+        positions[positions == len(second_keys)] = 0
+        return numpy.where(second_keys[positions] == first_keys, positions, -1)
+    return [second._find(key) for key in first._keys]
+
+
+def count_differences(big, small, skew_threshold):
+    """Compare the counts of the buckets of 2 tables, and find the buckets with too many rows
+
+    Only the buckets of ``big`` (the table with the most buckets) are considered.
+
+    :type big: :class:`BucketArray`
+    :param big: the counts of the table with the most buckets
+
+    :type small: :class:`BucketArray`
+    :param small: the counts of the other table
+
+    :type skew_threshold: int
+    :param skew_threshold: the number of rows above which a bucket is considered as skewed
+
+    :rtype: tuple
+    :returns: ``(differences, skew)``, where ``differences`` is the list of the ``(bucket, difference of counts,
+                count in big)`` tuples, from the smallest difference to the biggest; and ``skew`` is the list of the
+                ``(bucket, biggest count)`` tuples of the skewed buckets
+    """
+    positions = _match(big, small)
+    if numpy is not None:
+        keys = big._key_vector()
+        big_counts = big._value_vector()
+        small_counts = numpy.zeros(len(keys), dtype=numpy.int64)
+        found = positions >= 0
+        if len(small) > 0:
+            small_counts[found] = small._value_vector()[positions[found]]
+        delta = numpy.abs(big_counts - small_counts)
+        idx_diff = numpy.nonzero(delta != 0)[0]
+        idx_diff = idx_diff[numpy.lexsort((keys[idx_diff], delta[idx_diff]))]
+        differences = [(int(keys[i]), int(delta[i]), int(big_counts[i])) for i in idx_diff]
+        maximum = numpy.maximum(big_counts, small_counts)
+        skew = [(int(keys[i]), int(maximum[i])) for i in numpy.nonzero(maximum > skew_threshold)[0]]
+        return differences, skew
+
+    differences = []
+    skew = []
+    for idx, key in enumerate(big._keys):
+        big_count = big._values[idx]
+        small_count = small._values[positions[idx]] if positions[idx] >= 0 else 0
+        if big_count != small_count:
+            differences.append((key, abs(big_count - small_count), big_count))
+        if max(big_count, small_count) > skew_threshold:
+            skew.append((key, max(big_count, small_count)))
+    differences.sort(key=lambda x: (x[1], x[0]))
+    return differences, skew
+
+
+def digest_differences(src, dst):
+    """Compare the digests of the buckets of 2 tables
+
+    :type src: :class:`BucketArray`
+    :param src: the digests of the source table
+
+    :type dst: :class:`BucketArray`
+    :param dst: the digests of the destination table
+
+    :rtype: tuple
+    :returns: ``(different, missing)``, where ``different`` is the list of the buckets whose digests are different;
+                and ``missing`` the list of the buckets of ``dst`` that are not in ``src``
+    """
+    positions = _match(dst, src)
+    if numpy is not None:
+        keys = dst._key_vector()
+        found = positions >= 0
+        different = numpy.zeros(len(keys), dtype=bool)
+        if len(src) > 0:
+            different[found] = (dst._value_vector()[found] != src._value_vector()[positions[found]]).any(axis=1)
+        return [int(x) for x in keys[different]], [int(x) for x in keys[~found]]
+
+    different = []
+    missing = []
+    for idx, key in enumerate(dst._keys):
+        position = positions[idx]
+        if position < 0:
+            missing.append(key)
+        elif dst._values[idx * DIGEST_SIZE:(idx + 1) * DIGEST_SIZE] != \
+                src._values[position * DIGEST_SIZE:(position + 1) * DIGEST_SIZE]:
+            different.append(key)
+    return different, missing
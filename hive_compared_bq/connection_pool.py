@@ -0,0 +1,178 @@
+"""
+
+Copyright 2017 bol.com. All Rights Reserved
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import sys
+import threading
+import time
+
+
+def close_connection(connection):
+    """Close a connection, if its type supports it (the BigQuery clients have nothing to close)"""
+    close = getattr(connection, "close", None)
+    if close is not None:
+        try:
+            close()
+        except:
+            logging.debug("The connection could not be closed: %s", sys.exc_info()[1])
+
+
+class ConnectionPool(object):
+    """Keep the connections to the databases open between several comparisons, to reuse them
+
+    Creating a connection is expensive (Kerberos authentication for Hive, credentials and client for BigQuery...). The
+    long-running service (see service.py) executes many comparisons in the same process, so the connections of the
+    finished comparisons are kept here, and given to the next comparisons on the same server.
+
+    A connection is only used by one comparison at a time: each comparison takes its connections through a
+    :class:`ConnectionLease`, which gives them back to the pool when the comparison is finished.
+
+    :type max_idle_time: int
+    :param max_idle_time: the connections unused for more than this number of seconds are closed instead of being
+                            reused (the servers close the idle sessions after some time)
+    """
+
+    def __init__(self, max_idle_time=600):
+        self.max_idle_time = max_idle_time
+        self._idle_connections = {}  # key: see _Table.get_connection_key(), value: list of (connection, release time)
+        self._lock = threading.Lock()
+        self.number_created = 0
+        self.number_reused = 0
+
+    def acquire(self, key, create):
+        """Return an idle connection for the given key, or a new one if there is none
+
+        :type key: tuple
+        :param key: the identifier of the server (see _Table.get_connection_key())
+
+        :type create: function
+        :param create: the function (without argument) that creates a new connection
+
+        :rtype: object
+        :returns: the connection, that must be given back with release()
+        """
+        expired = []
+        connection = None
+        with self._lock:
+            idle = self._idle_connections.get(key, [])
+            while len(idle) > 0 and connection is None:
+                candidate, release_time = idle.pop()
+                if time.time() - release_time > self.max_idle_time:
+                    expired.append(candidate)
+                else:
+                    connection = candidate
+                    self.number_reused += 1
+        for candidate in expired:
+            close_connection(candidate)
+        if connection is not None:
+            logging.debug("Reusing a connection to %s", key)
+            return connection
+        logging.debug("Creating a new connection to %s", key)
+        connection = create()
+        with self._lock:
+            self.number_created += 1
+        return connection
+
+    def release(self, key, connection):
+        """Give back a connection, so that it can be reused by the next comparisons
+
+        :type key: tuple
+        :param key: the identifier of the server given to acquire()
+
+        :type connection: object
+        :param connection: the connection returned by acquire()
+        """
+        with self._lock:
+            self._idle_connections.setdefault(key, []).append((connection, time.time()))
+
+    def close(self):
+        """Close all the idle connections"""
+        with self._lock:
+            connections = [x[0] for idle in self._idle_connections.values() for x in idle]
+            self._idle_connections = {}
+        for connection in connections:
+            close_connection(connection)
+
+    def get_statistics(self):
+        """Return some statistics about the connections of the pool
+
+        :rtype: dict
+        :returns: the number of connections created, reused, and currently idle for each server
+        """
+        with self._lock:
+            return {"created": self.number_created, "reused": self.number_reused,
+                    "idle": dict(("/".join(str(x) for x in key), len(idle))
+                                 for key, idle in self._idle_connections.items())}
+
+
+class ConnectionLease(object):
+    """The connections taken from a :class:`ConnectionPool` by one comparison
+
+    It is given to the TableComparator of the comparison (see TableComparator.set_connection_pool()), and to the
+    comparators of its partitions, so that all their connections are given back together at the end of the comparison.
+
+    :type pool: :class:`ConnectionPool`
+    :param pool: the pool where the connections are taken
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def acquire(self, key, create):
+        """Take a connection from the pool (see ConnectionPool.acquire())"""
+        connection = self.pool.acquire(key, create)
+        with self._lock:
+            self._connections.append((key, connection))
+        return connection
+
+    def release(self, key, connection, reusable=True):
+        """Give back one connection before the end of the comparison, for instance the one of a finished partition
+
+        :type key: tuple
+        :param key: the identifier of the server given to acquire()
+
+        :type connection: object
+        :param connection: the connection returned by acquire(), that must not be used anymore
+
+        :type reusable: bool
+        :param reusable: False to close the connection instead (see release_all())
+        """
+        with self._lock:
+            self._connections.remove((key, connection))
+        if reusable:
+            self.pool.release(key, connection)
+        else:
+            close_connection(connection)
+
+    def release_all(self, reusable=True):
+        """Give back all the connections taken by the comparison, that must not be used anymore
+
+        :type reusable: bool
+        :param reusable: False to close the connections instead, for instance when the comparison failed (a query may
+                        have been interrupted, leaving the connection in an unknown state)
+        """
+        with self._lock:
+            connections = self._connections
+            self._connections = []
+        for key, connection in connections:
+            if reusable:
+                self.pool.release(key, connection)
+            else:
+                close_connection(connection)
@@ -17,10 +17,12 @@ limitations under the License.
 """
 
 import logging
+import re
 import sys
 import time
 # noinspection PyProtectedMember
 from hive_compared_bq import _Table
+import iblt
 import pyhs2  # TODO switch to another module since this one is deprecated and does not support Python 3
 # see notes in : https://github.com/BradRuderman/pyhs2
 
@@ -28,27 +30,40 @@ import pyhs2  # TODO switch to another module since this one is deprecated and d
 class THive(_Table):
     """Hive implementation of the _Table object"""
 
-    def __init__(self, database, table, parent, hs2_server, jar_path):
+    min_split_size = 8000000  # 8 MB: the sha computations are heavy, so it is the smallest split size we want
+    max_split_size = 256000000  # 256 MB: above that, the mappers become too slow
+    max_number_mappers = 2000  # to avoid launching thousands of mappers on big tables
+    columnar_formats = ("orc", "parquet")  # only the needed columns are read in those formats
+    temporary_table_prefix = "temp_hiveCmpBq_"
+    temporary_table_format = "STORED AS ORC TBLPROPERTIES ('orc.compress'='ZLIB')"  # the temporary tables are read
+    # several times (differences of each column block...), so they are stored in a compact columnar format
+
+    def __init__(self, database, table, parent, hs2_server, jar_path, engine=None):
         _Table.__init__(self, database, table, parent)
         self.server = hs2_server
-        self.connection = self._create_connection()
+        self.connection = self.acquire_connection()
         self.jarPath = jar_path
+        self.engine = engine  # the execution engine (mr, tez...). If None, the default one of the cluster is used
+        self._functions_registered = False  # the UDFs of the jar are registered once per connection (Hive session)
+        self._storage_information = None  # see get_storage_information()
+        self._data_version_known = None  # see is_data_version_known()
 
     def get_type(self):
         return "hive"
 
+    def get_connection_key(self):
+        return "hive", self.server, self.database  # the database is the default one of the session
+
     def _create_connection(self):
         """Connect to the table and return the connection object that we will use to launch queries"""
         return pyhs2.connect(host=self.server, port=10000, authMechanism="KERBEROS", database=self.database)
 
-    def get_ddl_columns(self):
-        if len(self._ddl_columns) > 0:
-            return self._ddl_columns
-
+    def fetch_ddl_columns(self):
         is_col_def = True
         cur = self.connection.cursor()
         cur.execute("describe " + self.full_name)
         all_columns = []
+        partitions = []
         while cur.hasMoreRows:
             row = cur.fetchone()
             if row is None:
@@ -67,16 +82,249 @@ class THive(_Table):
             if is_col_def:
                 all_columns.append(my_dic)
             else:
-                self._ddl_partitions.append(my_dic)
+                partitions.append(my_dic)
         cur.close()
 
-        self.filter_columns_from_cli(all_columns)
+        return all_columns, partitions
 
-        return self._ddl_columns
+    def get_table_properties(self):
+        """Return the properties of the table (transient_lastDdlTime, totalSize, numRows...)
 
-    def get_column_statistics(self, query, selected_columns):
+        :rtype: dict
+        :returns: the dictionary of the properties of the table
+        """
+        properties = {}
+        cur = self.connection.cursor()
+        cur.execute("show tblproperties " + self.full_name)
+        while cur.hasMoreRows:
+            row = cur.fetchone()
+            if row is not None and len(row) > 1:
+                properties[row[0]] = row[1]
+        cur.close()
+        return properties
+
+    def get_storage_information(self):
+        """Return the file format, the total size and the bucketing of the table (to adapt the queries to the storage)
+
+        :rtype: dict
+        :returns: the dictionary ``{"format": file_format, "total_size": size_in_bytes, "num_buckets": number,
+                    "bucket_columns": columns, "bucketing_version": version}``, where ``file_format`` is for instance
+                    "orc", "parquet", "text" or "avro", ``total_size`` is None if unknown (for instance when the
+                    statistics of a partitioned table are not computed at table level), and ``num_buckets`` is -1 if
+                    the table is not bucketed
+        """
+        if self._storage_information is None:
+            input_format = ""
+            num_buckets = -1
+            bucket_columns = []
+            cur = self.connection.cursor()
+            cur.execute("describe formatted " + self.full_name)
+            while cur.hasMoreRows:
+                row = cur.fetchone()
+                if row is None or row[0] is None or row[1] is None:
+                    continue
+                if row[0].strip() == "InputFormat:":
+                    input_format = row[1].strip().lower()
+                elif row[0].strip() == "Num Buckets:":
+                    num_buckets = int(row[1].strip())
+                elif row[0].strip() == "Bucket Columns:":  # format is: [col1, col2]
+                    bucket_columns = [x.strip() for x in row[1].strip()[1:-1].split(",") if x.strip() != ""]
+            cur.close()
+
+            file_format = "text"
+            for known_format in ("orc", "parquet", "avro", "sequencefile", "rcfile", "hbase"):
+                if known_format in input_format:
+                    file_format = known_format
+            properties = self.get_table_properties()
+            total_size = properties.get("totalSize")
+            self._storage_information = {"format": file_format,
+                                         "total_size": int(total_size) if total_size is not None else None,
+                                         "num_buckets": num_buckets, "bucket_columns": bucket_columns,
+                                         "bucketing_version": properties.get("bucketing_version", "1")}
+            logging.debug("Storage information of %s: %s", self.full_name, self._storage_information)
+        return self._storage_information
+
+    def get_split_size(self, bytes_per_mapper):
+        """Return the split size to use, so that a mapper handles about ``bytes_per_mapper`` bytes
+
+        The split size is bound between min_split_size and max_split_size, and is increased for the big tables so that
+        we don't launch more than max_number_mappers mappers.
+
+        :type bytes_per_mapper: int
+        :param bytes_per_mapper: the ideal number of bytes handled by each mapper
+
+        :rtype: int
+        :returns: the split size, in bytes
+        """
+        split_size = max(self.min_split_size, min(self.max_split_size, bytes_per_mapper))
+        total_size = self.get_storage_information()["total_size"]
+        if total_size is not None:
+            split_size = max(split_size, total_size // self.max_number_mappers)
+        return split_size
+
+    def get_query_settings(self, query_type):
+        """Return the Hive settings adapted to a kind of query and to the storage of the table
+
+        The settings are kept in the Hive session, so all of them are always set (to not inherit the ones of the
+        previous query).
+
+        * "sample": only a few rows and columns are read, so we want few (big) splits.
+        * "count": in columnar formats only the Group By column is read, so the splits can be big. In other formats,
+          the whole rows are read but the computation is light.
+        * "sha": the computation of the checksums is heavy and proportional to the number of columns, so the splits
+          are smaller for the wide tables (and even smaller for the columnar formats, since they are compressed). A
+          lot of checksums go through the shuffle, so we also need more reducers.
+        * "drilldown": the whole table is read but only the rows of a few buckets are kept, so this is light.
+        * "fetch": reading the small temporary tables, which does not need any MapReduce job.
+
+        :type query_type: str
+        :param query_type: the kind of query
+
+        :rtype: list of str
+        :returns: the list of the "set" commands to execute before the query
+        """
+        storage = self.get_storage_information()
+        is_columnar = storage["format"] in self.columnar_formats
+        number_columns = max(1, len(self.get_ddl_columns()))
+
+        fetch_conversion = "minimal"  # force a MapReduce, because simple 'fetch' queries on a large table may generate
+        # some timeout otherwise
+        bytes_per_reducer = 256000000
+        if query_type == "sample":
+            split_size = self.get_split_size(self.max_split_size)
+        elif query_type == "count" or query_type == "drilldown":
+            split_size = self.get_split_size(self.max_split_size if is_columnar else 64000000)
+        elif query_type == "sha":
+            bytes_per_mapper = 640000000 // number_columns  # 64 MB for a table with 10 columns
+            if is_columnar:
+                bytes_per_mapper //= 4  # the data is compressed
+            split_size = self.get_split_size(bytes_per_mapper)
+            bytes_per_reducer = 64000000
+        else:  # "fetch"
+            split_size = self.get_split_size(self.max_split_size)
+            fetch_conversion = "more"  # the temporary tables are small, no need of a MapReduce job
+
+        settings = ["set mapreduce.input.fileinputformat.split.maxsize = %i" % split_size,
+                    "set hive.fetch.task.conversion = %s" % fetch_conversion,
+                    "set hive.vectorized.execution.enabled = %s" % ("true" if storage["format"] == "orc" else "false"),
+                    "set hive.exec.reducers.bytes.per.reducer = %i" % bytes_per_reducer]
+        if self.engine is not None:
+            settings.append("set hive.execution.engine = %s" % self.engine)
+        return settings
+
+    def fetch_table_version(self):
+        properties = self.get_table_properties()
+        # transient_lastDdlTime changes with the DDL, but also with most of the writes (INSERT, LOAD...), the size
+        # and number of files are added for the cases where the statistics are updated without it. This is not the
+        # case for the partitioned tables (the writes in a partition do not change the properties of the table) and
+        # for the external tables (the files can be written without Hive): the version is then only valid for the
+        # schema of the table
+        self._data_version_known = "totalSize" in properties and "numFiles" in properties \
+            and THive.are_statistics_accurate(properties) and properties.get("EXTERNAL", "").upper() != "TRUE"
+        return "%s/%s/%s" % (properties.get("transient_lastDdlTime"), properties.get("totalSize"),
+                             properties.get("numFiles"))
+
+    def is_data_version_known(self):
+        self.get_table_version()  # the properties of the table are checked when its version is fetched
+        return bool(self._data_version_known)
+
+    def get_partition_specs(self):
+        """Return the partitions of the table, as registered in the metastore
+
+        :rtype: list of dict
+        :returns: the specification of each partition, as a dictionary {partition_column: value}. The list is void if
+                    the table is not partitioned
+        """
+        specs = []
+        try:
+            cur = self.query("show partitions " + self.full_name)
+            while cur.hasMoreRows:
+                row = cur.fetchone()
+                if row is not None:
+                    # format is: col1=value1/col2=value2
+                    specs.append(dict(partition_spec.split("=", 1) for partition_spec in row[0].split("/")))
+            cur.close()
+        except IOError:
+            logging.debug("The table %s is not partitioned", self.full_name)
+        return specs
+
+    @staticmethod
+    def are_statistics_accurate(properties):
+        """Return True if the basic statistics (numRows...) of the table or partition are up to date
+
+        :type properties: dict
+        :param properties: the properties (parameters) of the table or partition
+        """
+        accurate = properties.get("COLUMN_STATS_ACCURATE", "")
+        # format is 'true' in Hive 1, and some JSON like '{"BASIC_STATS":"true"}' in Hive 2
+        return "numRows" in properties and (accurate == "true" or '"BASIC_STATS":"true"' in accurate)
+
+    def get_partition_properties(self, column, value):
+        """Return the properties (numRows, totalSize...) of a partition
+
+        :type column: str
+        :param column: the column that partitions the table
+
+        :type value: str
+        :param value: the value of the partition
+
+        :rtype: dict
+        :returns: the dictionary of the properties of the partition
+        """
+        properties = {}
         cur = self.connection.cursor()
-        cur.execute(query)
+        cur.execute("describe formatted %s partition (%s)" % (self.full_name,
+                                                             self.get_sql_partition_condition(column, value)))
+        while cur.hasMoreRows:
+            row = cur.fetchone()  # the parameters appear like: ('', 'numRows', '1234')
+            if row is not None and len(row) > 2 and row[1] is not None and row[2] is not None:
+                properties[row[1].strip()] = row[2].strip()
+        cur.close()
+        return properties
+
+    def get_metadata_row_count(self):
+        if self.where_condition is not None:
+            return None
+        properties = self.get_table_properties()
+        if not THive.are_statistics_accurate(properties):  # usually the case of partitioned tables
+            return None
+        return int(properties["numRows"])
+
+    def get_table_size(self):
+        if not THive.are_statistics_accurate(self.get_table_properties()):
+            return None  # the totalSize is not updated by some writes (for instance with hive.stats.autogather=false)
+        return self.get_storage_information()["total_size"]
+
+    def get_metadata_partition_row_counts(self, column, values):
+        counts = dict((value, None) for value in values)
+        if self.where_condition is not None:
+            return counts
+        specs = self.get_partition_specs()
+        if len(specs) == 0 or list(specs[0].keys()) != [column]:  # we need the whole specification of the partitions
+            return counts
+        existing_partitions = set(spec[column] for spec in specs)
+        for value in values:
+            if value not in existing_partitions:
+                counts[value] = 0
+                continue
+            properties = self.get_partition_properties(column, value)
+            if THive.are_statistics_accurate(properties):
+                counts[value] = int(properties["numRows"])
+        return counts
+
+    def get_partition_values(self, column):
+        if self.where_condition is None:  # the list of the partitions can be directly taken from the metastore
+            values = []
+            for spec in self.get_partition_specs():
+                value = spec.get(column)
+                if value is not None and value != "__HIVE_DEFAULT_PARTITION__" and value not in values:
+                    values.append(value)
+            if len(values) > 0:
+                return values
+        return _Table.get_partition_values(self, column)
+
+    def get_column_statistics(self, query, selected_columns):
+        cur = self.query(query, "sample")
         while cur.hasMoreRows:
             fetched = cur.fetchone()
             if fetched is not None:
@@ -85,65 +333,168 @@ class THive(_Table):
                     col["Counter"][value_column] += 1  # TODO what happens with NULL?
         cur.close()
 
+    def get_sql_sample_clause(self, percent):
+        return "TABLESAMPLE(%s PERCENT)" % percent  # block sampling: only some HDFS blocks are read
+
+    def get_sql_quick_check_condition(self, modulo, residue):
+        return "(hash( cast( %s as STRING)) & 2147483647) %% %i = %i" % (self.get_groupby_column(), modulo, residue)
+
+    def get_sql_quick_check_sample_clause(self, modulo, residue):
+        # If the table is bucketed on the Group By column (a string, so that the hash is the same as ours), Hive can
+        # directly read the files of the buckets of the subset
+        storage = self.get_storage_information()
+        gb_column = self.get_groupby_column()
+        gb_type = [col["type"] for col in self.get_ddl_columns() if col["name"] == gb_column]
+        if storage["bucket_columns"] == [gb_column] and gb_type == ["string"] and storage["num_buckets"] > 0 \
+                and storage["num_buckets"] % modulo == 0 and storage["bucketing_version"] != "2":
+            return "TABLESAMPLE(BUCKET %i OUT OF %i ON %s)" % (residue + 1, modulo, gb_column)
+        return ""
+
+    def get_sql_bucket_expression(self):
+        return "hash( cast( %s as STRING)) %% %i" % (self.get_groupby_column(), self.tc.number_of_group_by)
+
+    def get_sql_column_value(self, col):
+        name = col["name"]
+        hive_value_name = name
+        if col["type"] == 'date':
+            hive_value_name = "cast( %s as STRING)" % name
+        elif col["type"] == 'float' or col["type"] == 'double':
+            hive_value_name = "cast( floor( %s * 10000 ) as bigint)" % name
+        elif col["type"] == 'string' and name in self.decodeCP1252_columns:
+            hive_value_name = "DecodeCP1252( %s)" % name
+        return "CASE WHEN %s IS NULL THEN 'n_%s' ELSE %s END" % (name, name[:2], hive_value_name)
+
     def create_sql_groupby_count(self):
-        where_condition = ""
-        if self.where_condition is not None:
-            where_condition = "WHERE " + self.where_condition
-        query = "SELECT hash( cast( %s as STRING)) %% %i AS gb, count(*) AS count FROM %s %s GROUP BY " \
-                "hash( cast( %s as STRING)) %% %i" \
-                % (self.get_groupby_column(), self.tc.number_of_group_by, self.full_name, where_condition,
-                   self.get_groupby_column(), self.tc.number_of_group_by)
+        query = "SELECT %s AS gb, count(*) AS count FROM %s GROUP BY %s" \
+                % (self.get_sql_bucket_expression(), self.get_sql_scan_source(), self.get_sql_bucket_expression())
         logging.debug("Hive query is: %s", query)
 
         return query
 
     def create_sql_show_bucket_columns(self, extra_columns_str, buckets_values):
-        gb_column = self.get_groupby_column()
-        where_condition = ""
-        if self.where_condition is not None:
-            where_condition = self.where_condition + " AND"
-        hive_query = "SELECT hash( cast( %s as STRING)) %% %i as bucket, %s, %s FROM %s WHERE %s " \
-                     "hash( cast( %s as STRING)) %% %i IN (%s)" \
-                     % (gb_column, self.tc.number_of_group_by, gb_column, extra_columns_str, self.full_name,
-                        where_condition, gb_column, self.tc.number_of_group_by, buckets_values)
+        bucket_expression, source = self.get_sql_bucket_source(buckets_values)
+        hive_query = "SELECT %s as bucket, %s, %s FROM %s" % (bucket_expression, self.get_groupby_column(),
+                                                             extra_columns_str, source)
         logging.debug("Hive query to show the buckets and the extra columns is: %s", hive_query)
 
         return hive_query
 
-    def create_sql_intermediate_checksums(self):
-        column_blocks = self.get_column_blocks(self.get_ddl_columns())
-        number_of_blocks = len(column_blocks)
-        logging.debug("%i column_blocks (with a size of %i columns) have been considered: %s", number_of_blocks,
-                      self.tc.block_size, str(column_blocks))
+    def create_sql_bucket_index(self, columns, buckets_values):
+        bucket_expression, source = self.get_sql_bucket_source(buckets_values)
+        hive_query = "SELECT %s as hcbq_bucket, %s FROM %s" % (bucket_expression, ", ".join(columns), source)
+        logging.debug("Hive query to create the bucket index is: %s", hive_query)
+
+        return hive_query
+
+    def create_sql_column_checksums(self, columns, buckets_values):
+        key_value = self.get_sql_key_value()  # each value is tied to its row, just like for the column blocks
+        values = ", ".join(["concat( %s, '|', %s) as col_%i" % (key_value, self.get_sql_column_value(col), idx)
+                            for idx, col in enumerate(columns)])
+        list_shas = ", ".join(["base64( unhex( SHA1( concat_ws( '|', sort_array( collect_list( col_%i)))))) as "
+                               "col_%i_gb" % (idx, idx) for idx in range(len(columns))])
+        bucket_expression, source = self.get_sql_bucket_source(buckets_values)
+        hive_query = "SELECT gb, count(*) as count, %s FROM (\nSELECT %s as gb, %s FROM %s\n) columns_values " \
+                     "GROUP BY gb" % (list_shas, bucket_expression, values, source)
+        logging.debug("Hive query to get the checksums of each column is: %s", hive_query)
+
+        return hive_query
+
+    def get_sql_block_shas(self, column_blocks):
+        """Return the SQL expressions of the checksums of the column blocks, named block_0, block_1...
 
-        # Generate the concatenations for the column_blocks
+        :type column_blocks: list of list
+        :param column_blocks: the column blocks (see get_column_blocks())
+
+        :rtype: str
+        :returns: the ',' separated SQL expressions
+        """
+        # Generate the concatenations for the column_blocks. Each block also contains the value of the Group By column,
+        # so that the checksum of a block is tied to its row (see get_column_blocks_most_differences)
+        key_value = self.get_sql_key_value()
         hive_basic_shas = ""
         for idx, block in enumerate(column_blocks):
-            hive_basic_shas += "base64( unhex( SHA1( concat( "
+            hive_basic_shas += "base64( unhex( SHA1( concat( %s, '|', " % key_value
             for col in block:
-                name = col["name"]
-                hive_value_name = name
-                if col["type"] == 'date':
-                    hive_value_name = "cast( %s as STRING)" % name
-                elif col["type"] == 'float' or col["type"] == 'double':
-                    hive_value_name = "cast( floor( %s * 10000 ) as bigint)" % name
-                elif col["type"] == 'string' and name in self.decodeCP1252_columns:
-                    hive_value_name = "DecodeCP1252( %s)" % name
-                hive_basic_shas += "CASE WHEN %s IS NULL THEN 'n_%s' ELSE %s END, '|'," % (name, name[:2],
-                                                                                           hive_value_name)
+                hive_basic_shas += "%s, '|'," % self.get_sql_column_value(col)
             hive_basic_shas = hive_basic_shas[:-6] + ")))) as block_%i,\n" % idx
-        hive_basic_shas = hive_basic_shas[:-2]
+        return hive_basic_shas[:-2]
 
-        where_condition = ""
-        if self.where_condition is not None:
-            where_condition = "WHERE " + self.where_condition
+    def create_sql_row_keys(self, extra_columns, condition=None):
+        """Return the query that computes the key of each row (see the iblt module), with some extra columns
+
+        :type extra_columns: list of str
+        :param extra_columns: the names of the columns to fetch along with the key
+
+        :type condition: str
+        :param condition: if defined, another condition the rows must match (see get_sql_scan_source())
+
+        :rtype: str
+        :returns: the query, that returns the extra columns and the column ``row_key``
+        """
+        column_blocks = self.get_column_blocks(self.get_ddl_columns())
+        list_blocks = ", ".join(["block_%i" % i for i in range(len(column_blocks))])
+        extra = "".join(["%s, " % col for col in extra_columns])
+        row_key = "cast( conv( substr( lower( SHA1( concat( %s))), 1, %i), 16, 10) as bigint)" \
+                  % (list_blocks, iblt.KEY_HEX_DIGITS)  # SHA1() returns the hexadecimal representation
+        return "SELECT %s%s as row_key FROM (\nSELECT %s%s\nFROM %s\n) blocks" \
+               % (extra, row_key, extra, self.get_sql_block_shas(column_blocks), self.get_sql_scan_source(condition))
+
+    def create_sql_iblt(self, number_cells):
+        size = iblt.get_subtable_size(number_cells)
+        cells = "pmod( row_key DIV 1099511627776, %i), %i + pmod( pmod( row_key DIV 1048576, 1048576), %i), " \
+                "%i + pmod( pmod( row_key, 1048576), %i)" % (size, size, size, 2 * size, size)  # 3 slices of 20 bits
+        check = "pmod( row_key, %i) * pmod( row_key, %i) %% %i" % ((iblt.CHECK_PRIME,) * 3)
+        hive_query = "SELECT cell, count(*) as count, sum( cast( row_key as decimal(38,0))) as key_sum, " \
+                     "sum( cast( %s as decimal(38,0))) as check_sum FROM (\n%s\n) row_keys\nLATERAL VIEW explode( " \
+                     "array( %s)) cells AS cell GROUP BY cell" % (check, self.create_sql_row_keys([]), cells)
+        logging.debug("Hive IBLT query is:\n%s", hive_query)
+
+        return hive_query
+
+    def create_sql_additive_checksums(self, column, low, high):
+        condition = self.get_sql_incremental_condition(column, low, high)
+        bucket_expression = self.get_sql_bucket_expression()
+        hive_query = "SELECT %s as gb, count(*) as count, sum( cast( row_key as decimal(38,0))) as key_sum " \
+                     "FROM (\n%s\n) row_keys GROUP BY %s" \
+                     % (bucket_expression, self.create_sql_row_keys([self.get_groupby_column()], condition),
+                        bucket_expression)
+        logging.debug("Hive query to get the additive checksums is:\n%s", hive_query)
+
+        return hive_query
+
+    def create_sql_show_rows_by_keys(self, columns, keys):
+        list_columns = ", ".join(columns)
+        hive_query = "SELECT %s FROM (\n%s\n) row_keys WHERE row_key IN (%s)" \
+                     % (list_columns, self.create_sql_row_keys(columns), ", ".join([str(k) for k in keys]))
+        logging.debug("Hive query to show the rows of some keys is: %s", hive_query)
+
+        return hive_query
+
+    def create_sql_row_values(self):
+        # the values are converted into strings by concat() itself, since the checksums concatenate them with it (see
+        # get_sql_block_shas()) and cast() does not convert all the types (booleans...) in the same way. The query is
+        # simple enough to be executed without MapReduce job (with the settings of the "fetch" queries)
+        values = ", ".join(["concat( %s)" % self.get_sql_column_value(col) for col in self.get_ddl_columns()])
+        hive_query = "SELECT %s as gb, %s, %s FROM %s" % (self.get_sql_bucket_expression(), self.get_sql_key_value(),
+                                                          values, self.get_sql_scan_source())
+        logging.debug("Hive query to get the values of all the rows is: %s", hive_query)
+
+        return hive_query
 
-        hive_query = "WITH blocks AS (\nSELECT hash( cast( %s as STRING)) %% %i as gb,\n%s\nFROM %s %s\n),\n" \
-                     % (self.get_groupby_column(), self.tc.number_of_group_by, hive_basic_shas, self.full_name,
-                        where_condition)  # 1st CTE with the basic block shas
+    def create_sql_intermediate_checksums(self, buckets_values=None):
+        column_blocks = self.get_column_blocks(self.get_ddl_columns())
+        number_of_blocks = len(column_blocks)
+        logging.debug("%i column_blocks (with a size of %i columns) have been considered: %s", number_of_blocks,
+                      self.tc.block_size, str(column_blocks))
+
+        hive_basic_shas = self.get_sql_block_shas(column_blocks)
+        hive_query = "WITH blocks AS (\nSELECT %s as gb,\n%s\nFROM %s\n),\n" \
+                     % (self.get_sql_bucket_expression(), hive_basic_shas,
+                        self.get_sql_scan_source())  # 1st CTE with the basic block shas
         list_blocks = ", ".join(["block_%i" % i for i in range(number_of_blocks)])
-        hive_query += "full_lines AS(\nSELECT gb, base64( unhex( SHA1( concat( %s)))) as row_sha, %s FROM blocks\n)\n" \
-                      % (list_blocks, list_blocks)  # 2nd CTE to get all the info of a row
+        buckets_filter = "" if buckets_values is None else " WHERE gb IN (%s)" % buckets_values
+        hive_query += "full_lines AS(\nSELECT gb, base64( unhex( SHA1( concat( %s)))) as row_sha, %s FROM blocks%s\n" \
+                      ")\n" % (list_blocks, list_blocks, buckets_filter)  # 2nd CTE to get all the info of a row
         hive_list_shas = ", ".join(["base64( unhex( SHA1( concat_ws( '|', sort_array( collect_list( block_%i)))))) as "
                                     "block_%i_gb " % (i, i) for i in range(number_of_blocks)])
         hive_query += "SELECT gb, base64( unhex( SHA1( concat_ws( '|', sort_array( collect_list( row_sha)))))) as " \
@@ -154,39 +505,93 @@ class THive(_Table):
         return hive_query
 
     def delete_temporary_table(self, table_name):
-        self.query("DROP TABLE " + table_name).close()
+        self.query("DROP TABLE IF EXISTS " + table_name).close()
+
+    def delete_stale_temporary_tables(self, max_age, excluded_tables=()):
+        connection = self._create_connection()  # the other connection may be used by the comparison at the same time
+        try:
+            cur = connection.cursor()
+            cur.execute("show tables in %s like '%s*'" % (self.database, self.temporary_table_prefix.lower()))
+            tables = [row[0] for row in cur.fetch()]
+            excluded_tables = set(x.lower() for x in excluded_tables)
+            deleted_tables = []
+            for table in tables:
+                # the name ends with the creation time (see create_temporary_table())
+                match = re.search(r"_(\d{9,})_\d+$", table)
+                full_name = "%s.%s" % (self.database, table)
+                if match is None or full_name.lower() in excluded_tables:
+                    continue
+                if time.time() - int(match.group(1)) > max_age:
+                    logging.debug("Deleting the stale temporary table %s", full_name)
+                    cur.execute("DROP TABLE IF EXISTS " + full_name)
+                    deleted_tables.append(full_name)
+            cur.close()
+        finally:
+            connection.close()
+        if len(deleted_tables) > 0:
+            logging.info("%i stale temporary tables have been deleted in the database %s", len(deleted_tables),
+                         self.database)
+        return deleted_tables
+
+    def temporary_table_exists(self, table_name):
+        database, table = table_name.split('.')
+        cur = self.connection.cursor()
+        cur.execute("show tables in %s like '%s'" % (database, table))
+        tables = cur.fetch()
+        cur.close()
+        return len(tables) > 0
 
-    def query(self, query):
+    def query(self, query, query_type=None):
         """Execute the received query in Hive and return the cursor which is ready to be fetched and MUST be closed after
 
         :type query: str
         :param query: query to execute in Hive
 
+        :type query_type: str
+        :param query_type: the kind of query, to adapt the settings of Hive (see get_query_settings()). If None, the
+                            settings are not changed (for instance for DDL statements)
+
         :rtype: :class:`pyhs2.cursor.Cursor`
         :returns: the cursor for this query
 
         :raises: IOError if the query has some execution errors
         """
         logging.debug("Launching Hive query")
-        #  TODO split number should be done in function of file format (ORC, Avro...) and number of columns
-        #  split_maxsize = 256000000
-        # split_maxsize = 64000000
-        split_maxsize = 8000000
-        # split_maxsize = 16000000
+        if self.jarPath is not None:
+            self._register_functions()
         try:
+            settings = self.get_query_settings(query_type) if query_type is not None else []
             cur = self.connection.cursor()
-            cur.execute("set mapreduce.input.fileinputformat.split.maxsize = %i" % split_maxsize)
-            cur.execute("set hive.fetch.task.conversion=minimal")  # force a MapReduce, because simple 'fetch' queries
-            # on a large table may generate some timeout otherwise
+            for setting in settings:
+                cur.execute(setting)
             cur.execute(query)
         except:
             raise IOError("There was a problem in executing the query in Hive: %s", sys.exc_info()[1])
         logging.debug("Fetching Hive results")
         return cur
 
-    def launch_query_dict_result(self, query, result_dic, all_columns_from_2=False):
+    def _register_functions(self):
+        """Register the UDFs of the jar (needed to compute the shas), only once for the whole connection
+
+        :raises: IOError if the jar or the functions could not be registered
+        """
+        if self._functions_registered:
+            return
+        try:
+            cur = self.connection.cursor()
+            cur.execute("add jar " + self.jarPath)  # must be in a separated execution
+            cur.execute("create temporary function SHA1 as 'org.apache.hadoop.hive.ql.udf.UDFSha1'")
+            cur.execute("create temporary function DecodeCP1252 as "
+                        "'org.apache.hadoop.hive.ql.udf.generic.GenericUDFDecodeCP1252'")
+            cur.close()
+        except:
+            raise IOError("There was a problem in registering the UDFs of the jar %s: %s" % (self.jarPath,
+                                                                                             sys.exc_info()[1]))
+        self._functions_registered = True
+
+    def launch_query_dict_result(self, query, result_dic, all_columns_from_2=False, query_type="count"):
         try:
-            cur = self.query(query)
+            cur = self.query(query, query_type)
             while cur.hasMoreRows:
                 row = cur.fetchone()
                 if row is not None:
@@ -201,8 +606,8 @@ class THive(_Table):
             cur.close()
         logging.debug("All %i Hive rows fetched", len(result_dic))
 
-    def launch_query_csv_compare_result(self, query, rows):
-        cur = self.query(query)
+    def launch_query_csv_compare_result(self, query, rows, query_type="drilldown"):
+        cur = self.query(query, query_type)
         while cur.hasMoreRows:
             row = cur.fetchone()
             if row is not None:
@@ -211,24 +616,32 @@ class THive(_Table):
         logging.debug("All %i Hive rows fetched", len(rows))
         cur.close()
 
+    def launch_query_rows_result(self, query, rows, query_type="drilldown"):
+        cur = self.query(query, query_type)
+        while cur.hasMoreRows:
+            row = cur.fetchone()
+            if row is not None:
+                rows.append(tuple(row))
+        logging.debug("All %i Hive rows fetched", len(rows))
+        cur.close()
+
+    def create_temporary_table(self, query, query_type="drilldown"):
+        tmp_table = "%s.%s%s_%s" % (self.database, self.temporary_table_prefix, self.full_name.replace('.', '_'),
+                                    str(time.time()).replace('.', '_'))
+        self.query("CREATE TABLE %s %s AS\n%s" % (tmp_table, self.temporary_table_format, query), query_type).close()
+        return tmp_table
+
     def launch_query_with_intermediate_table(self, query, result):
         try:
-            cur = self.query("add jar " + self.jarPath)  # must be in a separated execution
-            cur.execute("create temporary function SHA1 as 'org.apache.hadoop.hive.ql.udf.UDFSha1'")
-            cur.execute("create temporary function DecodeCP1252 as "
-                        "'org.apache.hadoop.hive.ql.udf.generic.GenericUDFDecodeCP1252'")
+            self._register_functions()
         except:
             result["error"] = sys.exc_info()[1]
             raise
 
         if "error" in result:
-            cur.close()
             return  # let's stop the thread if some error popped up elsewhere
 
-        tmp_table = "%s.temp_hiveCmpBq_%s_%s" % (self.database, self.full_name.replace('.', '_'),
-                                                 str(time.time()).replace('.', '_'))
-        cur.execute("CREATE TABLE " + tmp_table + " AS\n" + query)
-        cur.close()
+        tmp_table = self.create_temporary_table(query, "sha")
         result["names_sha_tables"][self.get_id_string()] = tmp_table  # we confirm this table has been created
         result["cleaning"].append((tmp_table, self))
 
@@ -239,4 +652,5 @@ class THive(_Table):
             return
 
         projection_hive_row_sha = "SELECT gb, row_sha_gb FROM %s" % tmp_table
-        self.launch_query_dict_result(projection_hive_row_sha, result["sha_dictionaries"][self.get_id_string()])
+        self.launch_query_dict_result(projection_hive_row_sha, result["sha_dictionaries"][self.get_id_string()], False,
+                                      "fetch")
@@ -18,7 +18,15 @@ limitations under the License.
 
 import argparse
 import ast
+import budget
+import compact
+import connection_pool
+import copy
+import incremental
+import local_checksums
 import logging
+import os
+import random
 import threading
 import difflib
 import re
@@ -33,6 +41,7 @@ else:
     from collections import Counter
 
 ABC = ABCMeta('ABC', (object,), {})  # compatible with Python 2 *and* 3
+EXIT_CODE_FIXED = 3  # the differences of a previous run are fixed, but the rest of the tables was not compared again
 
 
 class _Table(ABC):
@@ -84,6 +93,17 @@ class _Table(ABC):
         self._ddl_columns = []  # array instead of dictionary because we want to maintain the order of the columns
         self._ddl_partitions = []  # take care, those rows also appear in the columns array
         self._group_by_column = None  # the column that is used to "bucket" the rows
+        self._table_version = None  # string that changes each time the table is modified (see get_table_version)
+        self._local_checksums = None  # the checksums of each bucket, when they are computed locally
+        self._local_lock = threading.Lock()  # the Count and sha steps may need the local checksums at the same time
+        self._shared_results = None  # if defined, the results of the Count and sha queries, computed once for several
+        # comparisons (see share_results())
+        self._shared_lock = threading.Lock()
+        self.connection_lock = threading.RLock()  # held by the comparisons that share this table to execute their
+        # queries, since a connection cannot be used by 2 threads at the same time (see share_results())
+        self.bucket_index = None  # if defined, the temporary table with the rows of some buckets (see
+        # create_bucket_index())
+        self.bucket_index_buckets = set()  # the buckets whose rows are in bucket_index
 
     @staticmethod
     def check_stdin_options(typedb, stdin_options, allowed_options, compulsory_options):
@@ -135,7 +155,7 @@ class _Table(ABC):
 
         :type argument: str
         :param argument: description of the table to connect to. Must have the format <type>/<database>.<table>
-                        type can be {hive,bq}
+                        type can be {hive,bq}. A snapshot (see snapshot module) is described by: snapshot/<path>
 
         :type options: str
         :param options: the dictionary of all the options for this table connection. Could be for instance:
@@ -149,6 +169,11 @@ class _Table(ABC):
 
         :raises: ValueError if the argument is void or does not match the format
         """
+        if argument.startswith("snapshot/"):
+            _Table.check_stdin_options("snapshot", options, [], {})
+            from snapshot import TSnapshot
+            return TSnapshot(argument[len("snapshot/"):], table_comparator)
+
         match = re.match(r'(\w+)/(\w+)\.(\w+)', argument)
         if match is None:
             raise ValueError("Table description must follow the following format: '<type>/<database>.<table>'")
@@ -162,12 +187,56 @@ class _Table(ABC):
             from bq import TBigQuery
             return TBigQuery(database, table, table_comparator, hash_options.get('project'))
         elif typedb == "hive":
-            hash_options = _Table.check_stdin_options(typedb, options, ["jar", "hs2"], {'hs2': 'Hive Server2 hostname'})
+            hash_options = _Table.check_stdin_options(typedb, options, ["jar", "hs2", "engine"],
+                                                      {'hs2': 'Hive Server2 hostname'})
             from hive import THive
-            return THive(database, table, table_comparator, hash_options['hs2'], hash_options.get('jar'))
+            return THive(database, table, table_comparator, hash_options['hs2'], hash_options.get('jar'),
+                         hash_options.get('engine'))
         else:
             raise ValueError("The database type %s is currently not supported" % typedb)
 
+    def get_connection_key(self):
+        """Return the identifier of the server, that tells which connections can be reused for this table
+
+        :rtype: tuple
+        :returns: the identifier of the server, or None if the connections of this type of table cannot be reused
+        """
+        return None
+
+    def acquire_connection(self):
+        """Return the connection used to launch the queries on this table
+
+        If the TableComparator has a pool of connections (see TableComparator.set_connection_pool()), the connection is
+        taken from it. Otherwise a new connection is created (see _create_connection()).
+
+        :rtype: object
+        :returns: the connection
+        """
+        key = self.get_connection_key()
+        if self.tc.connection_pool is None or key is None:
+            return self._create_connection()
+        return self.tc.connection_pool.acquire(key, self._create_connection)
+
+    def release_connection(self, reusable=True):
+        """Give back the connection of this table to the pool of the TableComparator, or close it if there is no pool
+
+        The table must not be used anymore. This is done for the tables of the TableComparators created for the
+        partitions and for the workers, which are only used for a part of the run (see
+        TableComparator.release_connections()).
+
+        :type reusable: bool
+        :param reusable: False to close the connection even if there is a pool (for instance after an error)
+        """
+        connection = getattr(self, "connection", None)
+        if connection is None:
+            return
+        self.connection = None
+        key = self.get_connection_key()
+        if self.tc.connection_pool is not None and key is not None:
+            self.tc.connection_pool.release(key, connection, reusable)
+        else:
+            connection_pool.close_connection(connection)
+
     @abstractmethod
     def get_type(self):
         """Return the (string) type of the database (Hive, BigQuery)"""
@@ -200,19 +269,294 @@ class _Table(ABC):
     def set_group_by_column(self, col):
         self._group_by_column = col
 
-    @abstractmethod
     def get_ddl_columns(self):
         """ Return the columns of this table
 
         The list of the column is an attribute of the class. If it already exists, then it is directly returned.
-        Otherwise, a connection is made to the database to get the schema of the table and at the same time the
-        attribute (list) partition is filled.
+        Otherwise, the schema is taken from the metadata cache if the table has not been modified since, or a
+        connection is made to the database to get the schema of the table. At the same time the attribute (list)
+        partition is filled.
 
         :rtype: list of dict
         :returns: list of {"name": "type"} dictionaries that represent the columns of this table
         """
+        if len(self._ddl_columns) > 0:
+            return self._ddl_columns
+
+        self.filter_columns_from_cli(self.load_schema())
+
+        return self._ddl_columns
+
+    def load_schema(self):
+        """Take the schema of the table from the metadata cache, or from the database, and fill the attribute (list)
+        partition
+
+        Contrary to get_ddl_columns(), the columns are not filtered with the options given by the user.
+
+        :rtype: list of dict
+        :returns: all the columns of the table
+        """
+        cache = self.tc.metadata_cache
+        entry = None
+        if cache is not None:
+            entry = cache.get(self.get_id_string(), self.get_table_version())
+        if entry is not None:
+            logging.debug("The schema of %s is taken from the metadata cache", self.get_id_string())
+            all_columns = entry["columns"]
+            self._ddl_partitions = entry["partitions"]
+        else:
+            all_columns, self._ddl_partitions = self.fetch_ddl_columns()
+            if cache is not None:
+                cache.set(self.get_id_string(), self.get_table_version(), all_columns, self._ddl_partitions)
+        return all_columns
+
+    @abstractmethod
+    def fetch_ddl_columns(self):
+        """ Connect to the database to get the schema of the table
+
+        :rtype: tuple
+        :returns: ``(all_columns, partitions)``, where ``all_columns`` is the list of {"name", "type"} dictionaries
+                    that represent the columns of this table, and ``partitions`` the ones that represent the columns
+                    used to partition it
+        """
         pass
 
+    def get_table_version(self):
+        """Return a string that changes each time the table is modified (its DDL or its data)
+
+        It is used to know if the information we have cached about this table is still valid. The version is only
+        fetched once, and then kept in an attribute.
+
+        :rtype: str
+        :returns: the version of the table
+        """
+        if self._table_version is None:
+            self._table_version = self.fetch_table_version()
+            logging.debug("The version of %s is: %s", self.get_id_string(), self._table_version)
+        return self._table_version
+
+    def is_data_version_known(self):
+        """Tell if the version of the table (see get_table_version()) changes for sure each time its data is modified
+
+        If it is not the case, the results of the queries on the table are not kept in the result cache, since they
+        could not be invalidated when the data changes.
+
+        :rtype: bool
+        :returns: True if the version can be trusted for the data of the table
+        """
+        return True
+
+    @abstractmethod
+    def fetch_table_version(self):
+        """Connect to the database to get some metadata that changes each time the table is modified (last modification
+        time, size...)
+
+        :rtype: str
+        :returns: the version of the table
+        """
+        pass
+
+    def get_partition_values(self, column):
+        """Return the distinct values of the column used to split the comparison into partitions
+
+        The WHERE condition of the table is taken into account. The NULL values are ignored.
+
+        :type column: str
+        :param column: the column that partitions the table (usually a date)
+
+        :rtype: list of str
+        :returns: the distinct values of the column
+        """
+        where_condition = ""
+        if self.where_condition is not None:
+            where_condition = "WHERE " + self.where_condition
+        rows = []
+        self.launch_query_rows_result("SELECT DISTINCT %s FROM %s %s" % (column, self.full_name, where_condition), rows,
+                                      "count")
+        if None in [row[0] for row in rows]:
+            logging.warning("Some rows of %s have a NULL value in the column %s. They are not compared in the "
+                            "partitions mode", self.get_id_string(), column)
+        return [str(row[0]) for row in rows if row[0] is not None]
+
+    @abstractmethod
+    def get_metadata_row_count(self):
+        """Return the number of rows of the table according to its metadata (statistics), without scanning it
+
+        :rtype: int
+        :returns: the number of rows, or None if it is unknown, or if the metadata cannot be trusted (statistics not
+                    accurate, WHERE condition on the table...)
+        """
+        pass
+
+    @abstractmethod
+    def get_metadata_partition_row_counts(self, column, values):
+        """Return the number of rows of some partitions according to the metadata, without scanning the table
+
+        :type column: str
+        :param column: the column that partitions the table
+
+        :type values: list of str
+        :param values: the values of the partitions
+
+        :rtype: dict
+        :returns: the number of rows for each value of partition (None if unknown or if the metadata cannot be trusted)
+        """
+        pass
+
+    @abstractmethod
+    def get_table_size(self):
+        """Return the size of the data of the table according to its metadata, to know if it is small enough to have
+        its checksums computed locally (see use_local_checksums())
+
+        :rtype: int
+        :returns: the size in bytes, or None if it is unknown or if the checksums must always be computed by the
+                    database
+        """
+        pass
+
+    def estimate_query_bytes(self, query):
+        """Return the number of bytes that a query would process (and be billed for), without executing it
+
+        :type query: str
+        :param query: the query
+
+        :rtype: int
+        :returns: the number of bytes, or None if the database does not bill the queries by the bytes they process
+        """
+        return None
+
+    def get_sql_scan_source(self, extra_condition=None):
+        """Return the source (table and conditions) of the queries that scan the whole table (Count and sha queries)
+
+        It contains the WHERE condition of the table and, in the quick-check mode (see TableComparator.set_quick_check()
+        ), the condition that only keeps a subset of the Group By values. When the storage of the table allows it, a
+        sampling clause is also added so that the data of the other Group By values is not even read.
+
+        :type extra_condition: str
+        :param extra_condition: if defined, another condition the rows must match (see
+                get_sql_incremental_condition())
+
+        :rtype: str
+        :returns: the source to put after the FROM keyword. Example: ``db.table WHERE datedir='2017-05-01'``
+        """
+        source = self.full_name
+        conditions = []
+        if self.where_condition is not None:
+            conditions.append(self.where_condition)
+        if extra_condition is not None:
+            conditions.append(extra_condition)
+        if self.tc.quick_check_modulo is not None:
+            modulo, residue = self.tc.quick_check_modulo, self.tc.quick_check_residue
+            sample_clause = self.get_sql_quick_check_sample_clause(modulo, residue)
+            if sample_clause != "":
+                source += " " + sample_clause
+            conditions.append(self.get_sql_quick_check_condition(modulo, residue))
+        if len(conditions) > 1 and self.where_condition is not None:
+            conditions[0] = "(%s)" % conditions[0]
+        if len(conditions) > 0:
+            source += " WHERE " + " AND ".join(conditions)
+        return source
+
+    @abstractmethod
+    def get_sql_quick_check_condition(self, modulo, residue):
+        """Return the SQL condition that only keeps a subset of the Group By values (for the quick-check mode)
+
+        The rows are kept if the (positive) hash of their Group By value, modulo ``modulo``, is equal to ``residue``.
+        Both tables thus keep exactly the same rows (all the rows of the chosen values of the Group By column), so the
+        Count and sha comparisons of each bucket stay consistent.
+
+        :type modulo: int
+        :param modulo: 1 row out of ``modulo`` is kept
+
+        :type residue: int
+        :param residue: the residue that identifies the subset
+
+        :rtype: str
+        :returns: the SQL condition
+        """
+        pass
+
+    def get_sql_quick_check_sample_clause(self, modulo, residue):
+        """Return the sampling clause (put after the name of the table) that prunes the data that is not in the subset
+        of the quick-check mode. The default implementation returns a void string (no pruning possible)
+
+        :type modulo: int
+        :param modulo: 1 row out of ``modulo`` is kept
+
+        :type residue: int
+        :param residue: the residue that identifies the subset
+
+        :rtype: str
+        :returns: the sampling clause, or a void string
+        """
+        return ""
+
+    def get_sql_incremental_condition(self, column, low, high):
+        """Return the SQL condition that keeps the rows modified after a watermark, and up to another one
+
+        :type column: str
+        :param column: the incremental column (the time of the last modification of each row)
+
+        :type low: object
+        :param low: the watermark of the previous comparison (see incremental.normalize_watermark()), None to keep all
+                the rows up to ``high`` (the rows without value in the column are then kept too)
+
+        :type high: object
+        :param high: the watermark of this comparison
+
+        :rtype: str
+        :returns: the SQL condition
+        """
+        condition = "%s <= %s" % (column, incremental.get_sql_watermark_literal(high))
+        if low is None:
+            return "(%s IS NULL OR %s)" % (column, condition)
+        return "%s > %s AND %s" % (column, incremental.get_sql_watermark_literal(low), condition)
+
+    def get_incremental_watermark(self, column, low=None):
+        """Return the highest value of the incremental column in the table
+
+        :type column: str
+        :param column: the incremental column
+
+        :type low: object
+        :param low: if defined, the watermark of the previous comparison: only the higher values are read, so that the
+                database can skip the older data (ORC stripes, partitions...)
+
+        :rtype: object
+        :returns: the value (see incremental.normalize_watermark()), or None if the column has no value (higher than
+                ``low``)
+        """
+        condition = None
+        if low is not None:
+            condition = "%s > %s" % (column, incremental.get_sql_watermark_literal(low))
+        rows = []
+        self.launch_query_rows_result("SELECT max(%s) FROM %s" % (column, self.get_sql_scan_source(condition)), rows,
+                                      "count")
+        if len(rows) == 0 or rows[0][0] is None:
+            return None
+        return incremental.normalize_watermark(rows[0][0])
+
+    def get_sql_partition_condition(self, column, value):
+        """Return the SQL condition that restricts the table to one partition
+
+        :type column: str
+        :param column: the column that partitions the table
+
+        :type value: str
+        :param value: the value of the partition
+
+        :rtype: str
+        :returns: the SQL condition, for instance: ``datedir = '2017-05-01'``
+        """
+        numeric_types = ("tinyint", "smallint", "int", "integer", "bigint", "float", "double", "decimal", "numeric")
+        col_type = "string"
+        for col in self.get_ddl_columns() + self._ddl_partitions:
+            if col["name"] == column:
+                col_type = col["type"]
+        if col_type.split("(")[0] in numeric_types:
+            return "%s = %s" % (column, value)
+        return "%s = '%s'" % (column, value.replace("'", "\\'"))
+
     def get_groupby_column(self):
         """Return a column that seems to have a good distribution in order to do interesting GROUP BY queries with it
 
@@ -231,6 +575,26 @@ class _Table(ABC):
 
         query, selected_columns = self.get_sample_query()
 
+        cache = self.tc.metadata_cache
+        sample_key = "%s|%s|%i|%s|%s" % (self.where_condition, ",".join([x["name"] for x in selected_columns]),
+                                         self.tc.sample_rows_number, self.tc.max_percent_most_frequent_value_in_column,
+                                         self.tc.sample_percent)
+        if cache is not None:
+            entry = cache.get(self.get_id_string(), self.get_table_version())
+            if entry is not None and sample_key in entry["group_by_columns"]:
+                self._group_by_column = entry["group_by_columns"][sample_key]
+                logging.info("Column to do a GROUP BY is %s (taken from the metadata cache)", self._group_by_column)
+                return self._group_by_column
+
+        if self.tc.budget is not None and self.tc.sample_percent is None:
+            number_bytes = self.estimate_query_bytes(query)
+            if number_bytes is not None and number_bytes > self.tc.budget.get_remaining():
+                # the LIMIT of the sample query does not reduce the bytes billed, but the block sampling does
+                logging.warning("The sample query on %s would process %s, more than the remaining budget, so only %s%% "
+                                "of the table is read", self.get_id_string(), budget.format_bytes(number_bytes),
+                                self.tc.budget_sample_percent)
+                query = self.get_sample_query(percent=self.tc.budget_sample_percent)[0]
+
         #  Get a sample from the table and fill Counters to each column
         logging.info("Analyzing the columns %s with a sample of %i values", str([x["name"] for x in selected_columns]),
                      self.tc.sample_rows_number)
@@ -238,7 +602,13 @@ class _Table(ABC):
             col["Counter"] = Counter()  # col: {"name","type"} dictionary. New "counter" key is to track distribution
 
         self.get_column_statistics(query, selected_columns)
+        if self.tc.sample_percent is not None and sum(selected_columns[0]["Counter"].values()) == 0:
+            logging.warning("The sample of %s%% of %s is void (small table?), so the first rows are taken instead",
+                            self.tc.sample_percent, self.get_id_string())
+            self.get_column_statistics(self.get_sample_query(False)[0], selected_columns)
         self.find_best_distributed_column(selected_columns)
+        if cache is not None:
+            cache.set_group_by_column(self.get_id_string(), self.get_table_version(), sample_key, self._group_by_column)
 
         return self._group_by_column
 
@@ -269,7 +639,10 @@ class _Table(ABC):
         :param selected_columns: list of the few columns selected in the sample query. It has the format:
                 {"name": col_name, "type": col_type, "Counter": frequency_of_values}
         """
-        max_frequent_number = self.tc.sample_rows_number * self.tc.max_percent_most_frequent_value_in_column // 100
+        sample_size = self.tc.sample_rows_number
+        if self.tc.sample_percent is not None:  # the block sampling may return less rows than expected
+            sample_size = min(sample_size, sum(selected_columns[0]["Counter"].values()))
+        max_frequent_number = sample_size * self.tc.max_percent_most_frequent_value_in_column // 100
         current_lowest_weight = sys.maxint
         highest_first = max_frequent_number
 
@@ -344,6 +717,43 @@ class _Table(ABC):
                     all_columns.append(col)
             self._ddl_columns = list(all_columns)
 
+    @abstractmethod
+    def get_sql_bucket_expression(self):
+        """Return the SQL expression that computes the bucket (the hash of the Group By column modulo
+        number_of_group_by) of a row
+
+        The expressions must give the same result for all the types of databases, otherwise the buckets of the 2 tables
+        could not be compared.
+
+        :rtype: str
+        :returns: the SQL expression of the bucket
+        """
+        pass
+
+    @abstractmethod
+    def get_sql_column_value(self, col):
+        """Return the SQL expression that normalizes the value of a column before computing its checksum
+
+        The goal of this normalization is to get the same string representation for a same value in all the types of
+        databases (same representation of NULL, of decimal numbers...).
+
+        :type col: dict
+        :param col: the description of the column, with the format: {"name": col_name, "type": col_type}
+
+        :rtype: str
+        :returns: the SQL expression of the normalized value
+        """
+        pass
+
+    def get_sql_key_value(self):
+        """Return the SQL expression of the (string) value of the Group By column, used to tie a checksum to its row
+
+        :rtype: str
+        :returns: the SQL expression of the value of the Group By column
+        """
+        return "CASE WHEN %s IS NULL THEN 'n_key' ELSE cast( %s as STRING) END" % (self.get_groupby_column(),
+                                                                                   self.get_groupby_column())
+
     @abstractmethod
     def create_sql_groupby_count(self):
         """ Return a SQL query where we count the number of rows for each Group of hash() on the groupby_column
@@ -373,14 +783,110 @@ class _Table(ABC):
         pass
 
     @abstractmethod
-    def create_sql_intermediate_checksums(self):
+    def create_sql_bucket_index(self, columns, buckets_values):
+        """ Return a SQL query that selects the bucket and some columns of the rows that match some specific buckets
+
+        The results of this query are stored in the bucket index (see create_bucket_index()). The bucket is named
+        ``hcbq_bucket``, and the columns keep their names so that the other queries can be launched on the index as on
+        the table.
+
+        :type columns: list of str
+        :param columns: the names of the columns we want to copy
+
+        :type buckets_values: str
+        :param buckets_values: the list of values (separated by ",") of the buckets we want to copy
+
+        :rtype: str
+        :returns: SQL query to create the bucket index
+        """
+        pass
+
+    def get_sql_bucket_source(self, buckets_values):
+        """Return the SQL expression of the bucket and the source of the rows that match some specific buckets
+
+        If all those buckets are in the bucket index (see create_bucket_index()), only this small table is read.
+        Otherwise, the bucket of each row of the whole table must be computed.
+
+        :type buckets_values: str
+        :param buckets_values: the list of values (separated by ",") of the buckets we want to fetch
+
+        :rtype: tuple of str
+        :returns: ``(bucket_expression, source)``, where ``source`` is the name of the table followed by the WHERE
+                    clause that keeps the rows of those buckets
+        """
+        if self.bucket_index is not None \
+                and set(int(x) for x in buckets_values.split(",")).issubset(self.bucket_index_buckets):
+            return "hcbq_bucket", "%s WHERE hcbq_bucket IN (%s)" % (self.bucket_index, buckets_values)
+        where_condition = ""
+        if self.where_condition is not None:
+            where_condition = self.where_condition + " AND "
+        bucket_expression = self.get_sql_bucket_expression()
+        return bucket_expression, "%s WHERE %s%s IN (%s)" % (self.full_name, where_condition, bucket_expression,
+                                                             buckets_values)
+
+    def create_bucket_index(self, buckets):
+        """Copy the rows of some buckets in a temporary table, so that the drill-down queries only read those rows
+
+        Without this index, each query that shows the differences (see create_sql_show_bucket_columns() and
+        create_sql_column_checksums()) reads the whole table to compute the bucket of each row, and only keeps the rows
+        of a few buckets. The index is created with one last read of the whole table, after which the queries of all
+        the column blocks only read the index.
+
+        :type buckets: list of int
+        :param buckets: the buckets we want to copy
+
+        :rtype: str
+        :returns: the name of the bucket index, that must be deleted with delete_temporary_table()
+        """
+        columns = [col["name"] for col in self.get_ddl_columns()]
+        if self.get_groupby_column() not in columns:
+            columns.append(self.get_groupby_column())  # needed to show the rows and to compute their checksums
+        buckets_values = ",".join(map(str, sorted(buckets)))
+        self.bucket_index = self.create_temporary_table(self.create_sql_bucket_index(columns, buckets_values))
+        self.bucket_index_buckets = set(buckets)
+        logging.debug("The bucket index of %s is %s", self.get_id_string(), self.bucket_index)
+        return self.bucket_index
+
+    def set_bucket_index(self, table_name, buckets):
+        """Use an existing bucket index (for instance created by a previous execution of the run)
+
+        :type table_name: str
+        :param table_name: the name of the bucket index (see create_bucket_index())
+
+        :type buckets: list of int
+        :param buckets: the buckets whose rows are in the index
+        """
+        self.bucket_index = table_name
+        self.bucket_index_buckets = set(buckets)
+
+    @abstractmethod
+    def create_sql_column_checksums(self, columns, buckets_values):
+        """ Return a SQL query that computes, for some specific buckets, one checksum for each of the given columns
+
+        The query returns the bucket, the number of rows in this bucket, and then one aggregated checksum per column (in
+        the same order as ``columns``). Since only some few buckets and columns are considered, this query is much
+        lighter than the one generated by create_sql_intermediate_checksums.
+
+        :type columns: list of dict
+        :param columns: the columns we want to check, with the format: {"name": col_name, "type": col_type}
+
+        :type buckets_values: str
+        :param buckets_values: the list of values (separated by ",") of the buckets we want to check
+
+        :rtype: str
+        :returns: SQL query to compute the checksums of each column
+        """
+        pass
+
+    @abstractmethod
+    def create_sql_intermediate_checksums(self, buckets_values=None):
         """Build and return the query that generates all the checksums to make the final comparison
 
         The query will have the following schema:
 
     WITH blocks AS (
-        SELECT MOD( hash2( column), 100000) as gb, sha1(concat( col0, col1, col2, col3, col4)) as block_0,
-          sha1(concat( col5, col6, col7, col8, col9)) as block_1, ... as block_N FROM table
+        SELECT MOD( hash2( column), 100000) as gb, sha1(concat( column, col0, col1, col2, col3, col4)) as block_0,
+          sha1(concat( column, col5, col6, col7, col8, col9)) as block_1, ... as block_N FROM table
     ),
     full_lines AS (
         SELECT gb, sha1(concat( block_0, |, block_1...) as row_sha, block_0, block_1 ... FROM blocks
@@ -388,11 +894,81 @@ class _Table(ABC):
     SELECT gb, sha1(concat(list<row_sha>)) as sline, sha1(concat(list<block_0>)) as sblock_1,
         sha1(concat(list<block_1>)) as sblock_2 ... as sblock_N FROM GROUP BY gb
 
+        :type buckets_values: str
+        :param buckets_values: if defined, the list of values (separated by ",") of the only buckets we want to compute
+
         :rtype: str
         :returns: the SQL query with the Group By and the shas
         """
         pass
 
+    @abstractmethod
+    def create_sql_row_values(self):
+        """Build and return the query that returns the normalized values of all the rows, to compute the checksums
+        locally (see the local_checksums module)
+
+        It is a simple projection (without any Group By) of the values that are concatenated in the query of
+        create_sql_intermediate_checksums(): ``gb, key_value, value_column_1, value_column_2...``, all of them being
+        strings (converted in the same way as by the concatenation of that query) except the bucket.
+
+        :rtype: str
+        :returns: the SQL query
+        """
+        pass
+
+    @abstractmethod
+    def create_sql_iblt(self, number_cells):
+        """Build and return the query that computes the Invertible Bloom Lookup Table of the rows (see iblt module)
+
+        The key of each row is derived from the sha1 of all its column blocks, and is added in 3 cells. The query
+        returns one row per cell: ``(cell, count, key_sum, check_sum)``.
+
+        :type number_cells: int
+        :param number_cells: the number of cells of the table
+
+        :rtype: str
+        :returns: the SQL query
+        """
+        pass
+
+    @abstractmethod
+    def create_sql_additive_checksums(self, column, low, high):
+        """Build and return the query that computes the additive checksums of the rows modified between 2 watermarks
+
+        The query returns one row per bucket: ``(gb, count, key_sum)``, where ``key_sum`` is the sum of the keys of the
+        rows (as computed for the IBLT). Unlike the sha1 of the buckets, those checksums can be added and subtracted, so
+        that the checksums of the modified rows can be folded into the ones of the previous comparisons (see
+        TableComparator.perform_step_incremental()).
+
+        :type column: str
+        :param column: the incremental column
+
+        :type low: object
+        :param low: the watermark of the previous comparison (see get_sql_incremental_condition())
+
+        :type high: object
+        :param high: the watermark of this comparison
+
+        :rtype: str
+        :returns: the SQL query
+        """
+        pass
+
+    @abstractmethod
+    def create_sql_show_rows_by_keys(self, columns, keys):
+        """Build and return the query that fetches the rows having some keys (as computed for the IBLT)
+
+        :type columns: list of str
+        :param columns: the names of the columns to fetch
+
+        :type keys: list of int
+        :param keys: the keys of the rows
+
+        :rtype: str
+        :returns: the SQL query
+        """
+        pass
+
     @abstractmethod
     def delete_temporary_table(self, table_name):
         """Drop the temporary table if needed (if it is not automatically deleted by the system)
@@ -402,8 +978,49 @@ class _Table(ABC):
         """
         pass
 
+    def delete_stale_temporary_tables(self, max_age, excluded_tables=()):
+        """Delete the temporary tables left by the previous runs (that crashed, or that were not resumed...)
+
+        Most of the databases delete the temporary tables by themselves, so nothing is done by default.
+
+        :type max_age: int
+        :param max_age: only the tables created more than this number of seconds ago are deleted
+
+        :type excluded_tables: list of str
+        :param excluded_tables: the names (<database>.<table>) of the tables that must be kept whatever their age
+
+        :rtype: list of str
+        :returns: the names of the deleted tables
+        """
+        return []
+
+    @abstractmethod
+    def create_temporary_table(self, query):
+        """Launch the query and store its results in a new temporary table
+
+        :type query: str
+        :param query: query to execute
+
+        :rtype: str
+        :returns: the name of the temporary table (<database>.<table>), that must be deleted with
+                    delete_temporary_table()
+        """
+        pass
+
+    @abstractmethod
+    def temporary_table_exists(self, table_name):
+        """Check if a temporary table (created by launch_query_with_intermediate_table) still exists
+
+        :type table_name: str
+        :param table_name: name of the table (<database>.<table>)
+
+        :rtype: bool
+        :returns: True if the table can still be queried
+        """
+        pass
+
     @abstractmethod
-    def launch_query_dict_result(self, query, result_dic, all_columns_from_2=False):
+    def launch_query_dict_result(self, query, result_dic, all_columns_from_2=False, query_type="count"):
         """Launch the SQL query and stores the results of the 1st and 2nd columns in the dictionary
 
         The 1st column of each row is stored as the key of the dictionary, the 2nd column is for the value. This method
@@ -420,11 +1037,15 @@ class _Table(ABC):
                                     if we want the value of the dictionary to only have the 1st column (take care:
                                     columns start counting with 0).
                                     (default: False)
+
+        :type query_type: str
+        :param query_type: the kind of query ("count", "drilldown" or "fetch"), so that the engine can adapt its
+                            settings to it (see THive.get_query_settings())
         """
         pass
 
     @abstractmethod
-    def launch_query_csv_compare_result(self, query, rows):
+    def launch_query_csv_compare_result(self, query, rows, query_type="drilldown"):
         """Launch the SQL query and stores the rows in an array with some kind of CSV formatting
 
         The only reason for the "CSV formatting" (separation of columns with "|") is to help in comparing the rows with
@@ -435,6 +1056,24 @@ class _Table(ABC):
 
         :type rows: list of str
         :param rows: the (void) array that will store the rows
+
+        :type query_type: str
+        :param query_type: the kind of query (see launch_query_dict_result())
+        """
+        pass
+
+    @abstractmethod
+    def launch_query_rows_result(self, query, rows, query_type="drilldown"):
+        """Launch the SQL query and stores the raw rows (as tuples, without any formatting) in an array
+
+        :type query: str
+        :param query: query to execute
+
+        :type rows: list of tuple
+        :param rows: the (void) array that will store the rows
+
+        :type query_type: str
+        :param query_type: the kind of query (see launch_query_dict_result())
         """
         pass
 
@@ -453,7 +1092,268 @@ class _Table(ABC):
         :param result: dictionary to store the result
         """
 
-    def get_sample_query(self):
+    def launch_query_block_shas(self, temp_table, buckets_values, result_dic):
+        """Fetch, from the temporary table created by launch_query_with_intermediate_table, the shas of each column
+        block for some buckets
+
+        :type temp_table: str
+        :param temp_table: the name of the temporary table
+
+        :type buckets_values: str
+        :param buckets_values: the list of values (separated by ",") of the buckets we want to fetch
+
+        :type result_dic: dict
+        :param result_dic: dictionary to store the list of the block shas of each bucket
+        """
+        if temp_table is None and self.use_local_checksums():
+            checksums = self.compute_local_checksums()
+            for bucket in [int(x) for x in buckets_values.split(",") if x.strip() != ""]:
+                if bucket in checksums:
+                    result_dic[bucket] = checksums[bucket][2]
+            return
+        if temp_table is None:  # the sha results were taken from the result cache, without their temporary table
+            self.launch_query_dict_result(self.create_sql_intermediate_checksums(buckets_values), result_dic, True,
+                                          "sha")
+            return
+        query = "SELECT * FROM %s WHERE gb IN (%s)" % (temp_table, buckets_values)
+        logging.debug("Query to find differences in bucket_blocks is: %s", query)
+        self.launch_query_dict_result(query, result_dic, True, "fetch")
+
+    def share_results(self):
+        """Keep in memory the results of the Count and sha queries, to share them between several comparisons
+
+        This is used when the table is compared with several destination tables at the same time (see
+        TableComparator.perform_step_destinations()): each query is only executed once, by the first comparison that
+        needs it, and the other ones wait for its results. The temporary tables of the shared sha queries must then be
+        deleted by the caller (see get_shared_temporary_tables()). The comparisons still use the same connection, so
+        the shared queries and all their other queries on this table must be executed with connection_lock acquired.
+        """
+        self._shared_results = {}
+
+    def _get_shared_results(self, query, launch):
+        """Return the results of a query, executing it only if no other comparison has done it (see share_results())
+
+        :type query: str
+        :param query: the query, that identifies the results
+
+        :type launch: function
+        :param launch: the function (without argument) that executes the query and returns its results
+
+        :rtype: object
+        :returns: the results returned by ``launch``
+        """
+        with self._shared_lock:
+            entry = self._shared_results.get(query)
+            owner = entry is None
+            if owner:
+                entry = self._shared_results[query] = {"done": threading.Event()}
+        if owner:
+            try:
+                with self.connection_lock:
+                    entry["results"] = launch()
+            finally:
+                entry["done"].set()
+        else:
+            logging.debug("Waiting for the results of the query on %s, launched by another comparison",
+                          self.get_id_string())
+            entry["done"].wait()
+        return entry["results"]
+
+    def get_shared_temporary_tables(self):
+        """Return the temporary tables created by the shared sha queries (see share_results())
+
+        :rtype: list of tuple
+        :returns: the ``(table_name, table_object)`` tuples of the tables to delete
+        """
+        with self._shared_lock:
+            entries = list(self._shared_results.values()) if self._shared_results is not None else []
+        return [x for entry in entries if isinstance(entry.get("results"), dict) for x in entry["results"]["cleaning"]]
+
+    def launch_cached_query_dict_result(self, query, result_dic):
+        """Same as launch_query_dict_result(), but the results are taken from the result cache if the same query was
+        already executed on the same version of the table
+
+        :type query: str
+        :param query: query to execute
+
+        :type result_dic: dict
+        :param result_dic: dictionary to store the result
+        """
+        if self._shared_results is not None:
+            def launch():
+                counts = compact.BucketArray()
+                try:
+                    self._launch_cached_query_dict_result(query, counts)
+                except:
+                    counts["error"] = sys.exc_info()[1]
+                return counts
+
+            result_dic.copy_from(self._get_shared_results(query, launch))
+            return
+        self._launch_cached_query_dict_result(query, result_dic)
+
+    def _launch_cached_query_dict_result(self, query, result_dic):
+        """See launch_cached_query_dict_result()"""
+        if self.use_local_checksums():
+            self.launch_local_counts(result_dic)
+            return
+        cache = self.tc.result_cache
+        if cache is None or not self.is_data_version_known():
+            self.launch_query_dict_result(query, result_dic)
+            return
+        entry = cache.get(self.get_id_string(), self.get_table_version(), query)
+        if entry is not None:
+            logging.info("The results of the query on %s are taken from the result cache", self.get_id_string())
+            for key, value in entry["rows"]:
+                result_dic[key] = value
+            return
+        self.launch_query_dict_result(query, result_dic)
+        if "error" not in result_dic:
+            cache.set(self.get_id_string(), self.get_table_version(), query,
+                      {"rows": [[key, value] for key, value in result_dic.items()]})
+
+    def launch_cached_query_with_intermediate_table(self, query, result):
+        """Same as launch_query_with_intermediate_table(), but the results are taken from the result cache if the same
+        query was already executed on the same version of the table
+
+        The temporary table is reused if it still exists. Otherwise, the shas of the column blocks are computed again
+        for the only buckets with differences (see launch_query_block_shas()).
+
+        :type query: str
+        :param query: query to execute
+
+        :type result: dict
+        :param result: dictionary to store the result
+        """
+        table_id = self.get_id_string()
+        if self._shared_results is not None:
+            def launch():
+                shas = {"cleaning": [], "names_sha_tables": {},
+                        "sha_dictionaries": {table_id: compact.BucketArray(digests=True)}}
+                try:
+                    self._launch_cached_query_with_intermediate_table(query, shas)
+                except:
+                    shas["error"] = sys.exc_info()[1]
+                return shas
+
+            shas = self._get_shared_results(query, launch)
+            if "error" in shas:
+                result["error"] = shas["error"]
+                return
+            if table_id in shas["names_sha_tables"]:
+                result["names_sha_tables"][table_id] = shas["names_sha_tables"][table_id]
+            result["sha_dictionaries"][table_id].copy_from(shas["sha_dictionaries"][table_id])
+            return
+        self._launch_cached_query_with_intermediate_table(query, result)
+
+    def _launch_cached_query_with_intermediate_table(self, query, result):
+        """See launch_cached_query_with_intermediate_table()"""
+        if self.use_local_checksums():
+            self.launch_local_shas(result)
+            return
+        cache = self.tc.result_cache
+        if cache is None or not self.is_data_version_known():
+            self.launch_query_with_intermediate_table(query, result)
+            return
+        table_id = self.get_id_string()
+        entry = cache.get(table_id, self.get_table_version(), query)
+        if entry is not None:
+            logging.info("The results of the sha query on %s are taken from the result cache", table_id)
+            temp_table = entry["temp_table"]
+            if temp_table is not None and not self.temporary_table_exists(temp_table):
+                temp_table = None
+            result["names_sha_tables"][table_id] = temp_table
+            for key, value in entry["rows"]:
+                result["sha_dictionaries"][table_id][key] = value
+            return
+        self.launch_query_with_intermediate_table(query, result)
+        if "error" not in result:
+            cache.set(table_id, self.get_table_version(), query,
+                      {"temp_table": result["names_sha_tables"].get(table_id),
+                       "rows": [[key, value] for key, value in result["sha_dictionaries"][table_id].items()]})
+
+    def use_local_checksums(self):
+        """Tell if the counts and the checksums of this table are computed locally instead of by the database
+
+        This is the case for the tables smaller than TableComparator.local_checksums_max_size, for which the latency of
+        the queries (for instance the startup of the MapReduce jobs) would be much longer than the time needed to read
+        them.
+
+        The size of the files can be much smaller than the values to fetch (compressed ORC files...), so the number of
+        rows of the metadata must also be known, and the number of values must also be below that limit.
+
+        :rtype: bool
+        :returns: True if the checksums are computed locally
+        """
+        if self.tc.local_checksums_max_size is None:
+            return False
+        size = self.get_table_size()
+        if size is None or size > self.tc.local_checksums_max_size:
+            return False
+        number_rows = self.get_metadata_row_count()
+        if number_rows is None:
+            logging.debug("The number of rows of %s is unknown, so its checksums are computed by the database",
+                          self.get_id_string())
+            return False
+        number_values = number_rows * (len(self.get_ddl_columns()) + 2)  # the bucket and the key are also fetched
+        if number_values * local_checksums.BYTES_PER_VALUE > self.tc.local_checksums_max_size:
+            logging.debug("%s has too many values (%i) to have its checksums computed locally", self.get_id_string(),
+                          number_values)
+            return False
+        return True
+
+    def compute_local_checksums(self):
+        """Fetch the normalized values of all the rows and compute the count and the checksums of each bucket
+
+        The checksums are only computed once, and then kept in memory (the table is small).
+
+        :rtype: dict
+        :returns: the ``(count, row_sha_gb, [block_0_gb, block_1_gb...])`` tuple of each bucket
+        """
+        with self._local_lock:
+            if self._local_checksums is None:
+                logging.info("%s is small (%i bytes), so its checksums are computed locally", self.get_id_string(),
+                             self.get_table_size())
+                rows = []
+                self.launch_query_rows_result(self.create_sql_row_values(), rows, "fetch")
+                block_lengths = [len(block) for block in self.get_column_blocks(self.get_ddl_columns())]
+                self._local_checksums = local_checksums.compute_checksums(rows, block_lengths)
+                logging.debug("The checksums of the %i rows of %s have been computed locally", len(rows),
+                              self.get_id_string())
+        return self._local_checksums
+
+    def launch_local_counts(self, result_dic):
+        """Same as launch_query_dict_result() with the Group By Count query, but the counts are computed locally
+
+        :type result_dic: dict
+        :param result_dic: dictionary to store the number of rows of each bucket
+        """
+        try:
+            for bucket, checksums in self.compute_local_checksums().items():
+                result_dic[bucket] = checksums[0]
+        except:
+            result_dic["error"] = sys.exc_info()[1]
+            raise
+
+    def launch_local_shas(self, result):
+        """Same as launch_query_with_intermediate_table() with the sha query, but the checksums are computed locally
+
+        No temporary table is created: the shas of the column blocks are kept in memory (see launch_query_block_shas()).
+
+        :type result: dict
+        :param result: dictionary to store the result
+        """
+        table_id = self.get_id_string()
+        try:
+            checksums = self.compute_local_checksums()
+        except:
+            result["error"] = sys.exc_info()[1]
+            raise
+        result["names_sha_tables"][table_id] = None
+        for bucket, bucket_checksums in checksums.items():
+            result["sha_dictionaries"][table_id][bucket] = bucket_checksums[1]
+
+    def get_sample_query(self, use_sampling=True, percent=None):
         """ Build a SQL query to get some sample lines with limited amount of columns
 
         We limit the number of columns to a small number (ex: 10) because it is usually unnecessary to look at all
@@ -461,6 +1361,16 @@ class _Table(ABC):
         What is more, in BigQuery we are billed by the number of columns we read so we need to avoid reading
         hundreds of columns just like what we have for big tables.
 
+        If a sample percentage is configured, only a random fraction of the storage blocks of the table is read (see
+        get_sql_sample_clause()), instead of the first rows. This is cheaper and gives a sample less biased when the
+        data is clustered.
+
+        :type use_sampling: bool
+        :param use_sampling: False if we want to read the first rows, even if a sample percentage is configured
+
+        :type percent: float
+        :param percent: the percentage of the table to read, if different from the configured one
+
         :rtype: tuple
         :returns: ``(query, selected_columns)``, where ``query`` is the sample SQL query; ``selected_columns`` is the
                     list of columns that are fetched
@@ -472,9 +1382,27 @@ class _Table(ABC):
         where_condition = ""
         if self.where_condition is not None:
             where_condition = "WHERE " + self.where_condition
-        query = query[:-1] + " FROM %s %s LIMIT %i" % (self.full_name, where_condition, self.tc.sample_rows_number)
+        sample_clause = ""
+        if percent is None:
+            percent = self.tc.sample_percent
+        if use_sampling and percent is not None:
+            sample_clause = self.get_sql_sample_clause(percent)
+        query = query[:-1] + " FROM %s %s %s LIMIT %i" % (self.full_name, sample_clause, where_condition,
+                                                          self.tc.sample_rows_number)
         return query, selected_columns
 
+    @abstractmethod
+    def get_sql_sample_clause(self, percent):
+        """Return the SQL clause (put just after the name of the table) to only read a fraction of the table
+
+        :type percent: float
+        :param percent: the percentage of the table to read
+
+        :rtype: str
+        :returns: the sampling clause, for instance: ``TABLESAMPLE SYSTEM (1 PERCENT)``
+        """
+        pass
+
     def get_column_blocks(self, ddl):
         """Returns the list of a column blocks for a specific DDL (see function create_sql_intermediate_checksums)
 
@@ -508,6 +1436,7 @@ class TableComparator(object):
         self.sample_column_number = 10
         self.max_percent_most_frequent_value_in_column = None
         self.number_of_most_frequent_values_to_weight = 50
+        self.sample_percent = None  # if defined, the sample is taken from this percentage of the table (block sampling)
 
         self.number_of_group_by = 100000  # 7999 is the limit if you want to manually download the data from BQ. This
         # limit does not apply in this script because we fetch the data with the Python API instead.
@@ -523,6 +1452,39 @@ class TableComparator(object):
         # 201 * 40000 * 29 / 1024 /1024 = 222 MB, which should fit into the Heap of a task process
         self.block_size = 5  # 5 columns means that when we want to debug we have enough context. But it small enough to
         #  avoid being charged too much by Google when querying on it
+        self._metadata_counts_differ = None  # see check_metadata_row_counts()
+        self.quick_check_modulo = None  # if defined, only 1 Group By value out of quick_check_modulo is compared
+        self.quick_check_residue = None
+        self.number_compared_buckets = None  # number of Group By values compared in the last Count or sha step
+        self.iblt_cells = 30000  # number of cells of the IBLT, see perform_step_iblt()
+        self.iblt_max_rows_shown = 1000  # the rows of the other differences are not fetched
+        self.full_diff_max_rows = None  # if defined, all the columns of the rows with differences are extracted (up to
+        # this number of rows per table) and compared locally, instead of showing the column blocks one by one
+        self.max_block_differences = 10000  # number of buckets with differences whose column blocks are searched
+        self.reverify_checkpoint = None  # if defined, the RunCheckpoint of the run whose column blocks with
+        # differences are verified again (see perform_step_reverify())
+        self.incremental_column = None  # if defined, only the rows modified since the last comparison are compared
+        self.incremental_state = None  # the IncrementalState of the comparison (see perform_step_incremental())
+        self.localize_columns = True  # compute some checksums per column to only show the columns with differences
+        self.use_bucket_index = False  # copy the rows of the buckets with differences before the drill-down queries
+        self.batch_report = None  # if defined, the file where all the column blocks with differences are written,
+        # without asking anything to the user (see show_results_batch_report())
+        self.batch_max_parallel = 4  # number of column blocks fetched at the same time for the batch report
+        self.comparator_factory = None  # function that creates a TableComparator with its own connections
+        self.metadata_cache = None  # if defined, the MetadataCache where the schemas and Group By columns are kept
+        self.result_cache = None  # if defined, the ResultCache where the results of the Count and sha queries are kept
+        self.budget = None  # if defined, the BytesBudget that limits the bytes processed by the BigQuery queries
+        self.budget_sample_percent = 1  # percentage of the table sampled when the sample query exceeds the budget
+        self.local_checksums_max_size = None  # if defined, the checksums of the tables smaller than this size (in
+        # bytes) are computed locally (see _Table.use_local_checksums())
+        self.checkpoint = None  # if defined, the RunCheckpoint where the results of each phase are persisted
+        self.report_dir = "/tmp"  # where the files that show the differences are written
+        self.report_prefix = ""  # prefix of the names of those files (see get_report_file())
+        self.open_browser = True  # show the HTML differences in a web browser
+        self.cleaning_threads = []  # the threads deleting the temporary tables, shared by the copies of this
+        # TableComparator (partitions, destinations...), see wait_for_cleaning()
+        self.connection_pool = None  # if defined, where the connections to the tables are taken (see
+        # _Table.acquire_connection())
         reload(sys)
         # below method really exists (don't know why PyCharm cannot see it) and is really needed
         # noinspection PyUnresolvedReferences
@@ -555,13 +1517,181 @@ class TableComparator(object):
     def set_max_percent_most_frequent_value_in_column(self, percent):
         """Set the max_percent_most_frequent_value_in_column value
 
-        If in one sample a column has a value whose frequency is higher than this percentage, then this column is not
-        considered as a suitable column to do the Group By
+        If in one sample a column has a value whose frequency is higher than this percentage, then this column is not
+        considered as a suitable column to do the Group By
+
+        :type percent: float
+        :param percent: the percentage value
+        """
+        self.max_percent_most_frequent_value_in_column = percent
+
+    def set_sample_percent(self, percent):
+        """Set the percentage of the table read (with block sampling) to get the sample used to find the Group By column
+
+        :type percent: float
+        :param percent: the percentage of the table to read
+        """
+        self.sample_percent = percent
+
+    def set_quick_check(self, modulo, residue):
+        """Only compare a subset of the Group By values: the ones whose hash modulo ``modulo`` is equal to ``residue``
+
+        :type modulo: int
+        :param modulo: 1 Group By value out of ``modulo`` is compared
+
+        :type residue: int
+        :param residue: the residue that identifies the subset (between 0 and modulo - 1)
+        """
+        self.quick_check_modulo = modulo
+        self.quick_check_residue = residue
+
+    def set_iblt_cells(self, number_cells):
+        """Set the number of cells of the Invertible Bloom Lookup Table
+
+        About 1.3 cells are needed for each row that is different, so this must be increased if many rows are expected
+        to be different.
+
+        :type number_cells: int
+        :param number_cells: the number of cells
+        """
+        self.iblt_cells = number_cells
+
+    def set_full_diff_max_rows(self, max_rows):
+        """Activate the extraction of all the columns of the rows with differences, and their local comparison
+
+        :type max_rows: int
+        :param max_rows: the maximum number of rows we accept to fetch from each table
+        """
+        self.full_diff_max_rows = max_rows
+
+    def set_metadata_cache(self, cache):
+        """Set the cache where the schemas and the Group By columns of the tables are persisted
+
+        :type cache: :class:`MetadataCache`
+        :param cache: the cache object
+        """
+        self.metadata_cache = cache
+
+    def set_result_cache(self, cache):
+        """Set the cache where the results of the Count and sha queries are persisted
+
+        :type cache: :class:`ResultCache`
+        :param cache: the cache object
+        """
+        self.result_cache = cache
+
+    def set_budget(self, bytes_budget):
+        """Set the budget of the bytes processed by the BigQuery queries of the run
+
+        :type bytes_budget: :class:`BytesBudget`
+        :param bytes_budget: the budget object (shared with the comparators of the partitions)
+        """
+        self.budget = bytes_budget
+
+    def set_local_checksums_max_size(self, size):
+        """Set the size below which the counts and the checksums of a table are computed locally
+
+        :type size: int
+        :param size: the maximum size of the table (in bytes), or None to always compute the checksums in the databases
+        """
+        self.local_checksums_max_size = size
+
+    def set_checkpoint(self, checkpoint):
+        """Set the checkpoint where the results of each phase of the run are persisted, to be able to resume it
+
+        :type checkpoint: :class:`RunCheckpoint`
+        :param checkpoint: the checkpoint object
+        """
+        self.checkpoint = checkpoint
+
+    def set_report_files(self, directory, prefix, open_browser):
+        """Set where the files that show the differences (HTML, sorted rows, reports...) are written
+
+        :type directory: str
+        :param directory: the directory of the files
+
+        :type prefix: str
+        :param prefix: the prefix of the names of the files, so that several runs can write their files in the same
+                directory (see service.py)
+
+        :type open_browser: bool
+        :param open_browser: False to not show the HTML differences in a web browser (when nobody can look at them)
+        """
+        self.report_dir = directory
+        self.report_prefix = prefix
+        self.open_browser = open_browser
+
+    def get_report_file(self, name):
+        """Return the path of a file that shows the differences (see set_report_files())
+
+        :type name: str
+        :param name: the name of the file, for instance ``count_diff.html``
+
+        :rtype: str
+        :returns: the path of the file
+        """
+        return os.path.join(self.report_dir, self.report_prefix + name)
+
+    def set_connection_pool(self, pool):
+        """Set the pool where the connections to the tables are taken, to reuse the connections of previous runs
+
+        :type pool: :class:`ConnectionLease`
+        :param pool: the connections of the pool taken by this run (see connection_pool.py)
+        """
+        self.connection_pool = pool
+
+    def set_localize_columns(self, localize):
+        """Define if we look for the specific columns with differences inside a column block, before showing them
+
+        :type localize: bool
+        :param localize: True to launch the (light) queries that compute one checksum per column (default: True)
+        """
+        self.localize_columns = localize
+
+    def set_use_bucket_index(self, use):
+        """Define if the rows of the buckets with differences are copied in a bucket index before being shown
+
+        :type use: bool
+        :param use: True to create the bucket indexes (see create_bucket_indexes())
+        """
+        self.use_bucket_index = use
+
+    def set_batch_report(self, file_name, max_parallel, comparator_factory):
+        """Write all the column blocks with differences in a report, instead of showing them one by one
+
+        :type file_name: str
+        :param file_name: the path of the report
+
+        :type max_parallel: int
+        :param max_parallel: the maximum number of column blocks fetched at the same time
+
+        :type comparator_factory: function
+        :param comparator_factory: function without argument that returns a new TableComparator, with the same
+                configuration but its own connections to the tables (see create_worker_comparator())
+        """
+        self.batch_report = file_name
+        self.batch_max_parallel = max_parallel
+        self.comparator_factory = comparator_factory
+
+    def set_incremental(self, column, state):
+        """Only compare the rows modified since the last comparison (see perform_step_incremental())
+
+        :type column: str
+        :param column: the incremental column, which contains the time of the last modification of each row
+
+        :type state: :class:`IncrementalState`
+        :param state: the state saved by the last comparison
+        """
+        self.incremental_column = column
+        self.incremental_state = state
+
+    def set_reverify(self, checkpoint):
+        """Only verify again the column blocks and the buckets that presented some differences in a previous run
 
-        :type percent: float
-        :param percent: the percentage value
+        :type checkpoint: :class:`RunCheckpoint`
+        :param checkpoint: the checkpoint of the previous run (see perform_step_reverify())
         """
-        self.max_percent_most_frequent_value_in_column = percent
+        self.reverify_checkpoint = checkpoint
 
     def compare_groupby_count(self):
         """Runs a light query on Hive and BigQuery to check if the counts match, using the ideal column estimated before
@@ -580,10 +1710,12 @@ class TableComparator(object):
         src_query = self.tsrc.create_sql_groupby_count()
         dst_query = self.tdst.create_sql_groupby_count()
 
-        result = {"src_count_dict": {}, "dst_count_dict": {}}
-        t_src = threading.Thread(name='srcGroupBy-' + self.tsrc.get_type(), target=self.tsrc.launch_query_dict_result,
+        result = {"src_count_dict": compact.BucketArray(), "dst_count_dict": compact.BucketArray()}
+        t_src = threading.Thread(name='srcGroupBy-' + self.tsrc.get_type(),
+                                 target=self.tsrc.launch_cached_query_dict_result,
                                  args=(src_query, result["src_count_dict"]))
-        t_dst = threading.Thread(name='dstGroupBy-' + self.tdst.get_type(), target=self.tdst.launch_query_dict_result,
+        t_dst = threading.Thread(name='dstGroupBy-' + self.tdst.get_type(),
+                                 target=self.tdst.launch_cached_query_dict_result,
                                  args=(dst_query, result["dst_count_dict"]))
         t_src.start()
         t_dst.start()
@@ -606,19 +1738,12 @@ class TableComparator(object):
             small_dict = result["src_count_dict"]
             big_small_bucket = (self.tdst, self.tsrc)
 
-        differences = Counter()
-        skew = Counter()
-        for (k, v) in big_dict.iteritems():
-            if k not in small_dict:
-                differences[k] = -v  # we want to see the differences where we have less lines to compare
-            elif v != small_dict[k]:
-                differences[k] = - abs(v - small_dict[k])
-            # we check the skew even if some differences were found above and we will never enter the sha computation,
-            # so that the developer can fix at early stage
-            max_value = max(v, small_dict.get(k))
-            if max_value > self.skew_threshold:
-                skew[k] = max_value
-        summary_differences = [(k, -v, big_dict[k]) for (k, v) in differences.most_common()]
+        self.number_compared_buckets = len(big_dict)
+        # the differences are sorted from the smallest one, because we want to see the differences where we have less
+        # lines to compare. We check the skew even if some differences were found and we will never enter the sha
+        # computation, so that the developer can fix at early stage
+        summary_differences, skew_buckets = compact.count_differences(big_dict, small_dict, self.skew_threshold)
+        skew = Counter(dict(skew_buckets))
         if len(skew) > 0:
             logging.warning("Some important skew (threshold: %i) was detected in the Group By column %s. The top values"
                             " are: %s", self.skew_threshold, self.tsrc.get_groupby_column(), str(skew.most_common(10)))
@@ -714,7 +1839,7 @@ class TableComparator(object):
         sorted_file = {}
         for instance in ("big_rows", "small_rows"):
             result[instance].sort()
-            sorted_file[instance] = "/tmp/count_diff_" + instance
+            sorted_file[instance] = self.get_report_file("count_diff_" + instance)
             with open(sorted_file[instance], "w") as f:
                 f.write("\n".join(result[instance]))
 
@@ -723,12 +1848,13 @@ class TableComparator(object):
         diff_string = difflib.HtmlDiff().make_file(result["big_rows"], result["small_rows"], bigtable.get_id_string() +
                                                    column_description, smalltable.get_id_string() + column_description,
                                                    context=False, numlines=30)
-        html_file = "/tmp/count_diff.html"
+        html_file = self.get_report_file("count_diff.html")
         with open(html_file, "w") as f:
             f.write(diff_string)
         logging.debug("Sorted results of the queries are in the files %s and %s. HTML differences are in %s",
                       sorted_file["big_rows"], sorted_file["small_rows"], html_file)
-        webbrowser.open("file://" + html_file, new=2)
+        if self.open_browser:
+            webbrowser.open("file://" + html_file, new=2)
 
     def compare_shas(self):
         """Runs the final queries on Hive and BigQuery to check if the checksum match and return the list of differences
@@ -749,14 +1875,14 @@ class TableComparator(object):
         # table to delete>, corresponding _Table object). "names_sha_tables" contains all the temporary tables generated
         # even the BigQuery cached table that does not need to be deleted. "sha_dictionaries" contains the results.
         result = {"cleaning": [], "names_sha_tables": {}, "sha_dictionaries": {
-            self.tsrc.get_id_string(): {},
-            self.tdst.get_id_string(): {}
+            self.tsrc.get_id_string(): compact.BucketArray(digests=True),
+            self.tdst.get_id_string(): compact.BucketArray(digests=True)
         }}
         t_src = threading.Thread(name='shaBy-' + self.tsrc.get_id_string(),
-                                 target=self.tsrc.launch_query_with_intermediate_table,
+                                 target=self.tsrc.launch_cached_query_with_intermediate_table,
                                  args=(tsrc_query, result))
         t_dst = threading.Thread(name='shaBy-' + self.tdst.get_id_string(),
-                                 target=self.tdst.launch_query_with_intermediate_table,
+                                 target=self.tdst.launch_cached_query_with_intermediate_table,
                                  args=(tdst_query, result))
         t_src.start()
         t_dst.start()
@@ -777,13 +1903,12 @@ class TableComparator(object):
                      "%s: %i).\nMake sure to first execute the 'count' verification step!"
                      % (self.tsrc.get_id_string(), src_num_gb, self.tdst.get_id_string(), dst_num_gb))
 
-        list_differences = []
-        for (k, v) in result["sha_dictionaries"][self.tdst.get_id_string()].iteritems():
-            if k not in result["sha_dictionaries"][self.tsrc.get_id_string()]:
-                sys.exit("The Group By value %s appears in %s but not in %s.\nMake sure to first execute the "
-                         "'count' verification step!" % (k, self.tdst.get_id_string(), self.tsrc.get_id_string()))
-            elif v != result["sha_dictionaries"][self.tsrc.get_id_string()][k]:
-                list_differences.append(k)
+        self.number_compared_buckets = src_num_gb
+        list_differences, missing = compact.digest_differences(result["sha_dictionaries"][self.tsrc.get_id_string()],
+                                                               result["sha_dictionaries"][self.tdst.get_id_string()])
+        if len(missing) > 0:
+            sys.exit("The Group By value %s appears in %s but not in %s.\nMake sure to first execute the "
+                     "'count' verification step!" % (missing[0], self.tdst.get_id_string(), self.tsrc.get_id_string()))
 
         if len(list_differences) != 0:
             logging.info("We found %i differences in sha verification", len(list_differences))
@@ -811,21 +1936,18 @@ class TableComparator(object):
 
         :raises: IOError if the query has some execution errors
         """
-        subset_differences = str(differences[:10000])[1:-1]  # let's choose quite a big number (instead of just looking
-        # at some few (5 for instance) differences for 2 reasons: 1) by fetching more rows we will find estimate
-        # better which column blocks fail often 2) we have less possibilities to face some 'permutations' problems
+        subset_differences = str(differences[:self.max_block_differences])[1:-1]  # let's choose quite a big number
+        # (instead of just looking at some few (5 for instance) differences for 2 reasons: 1) by fetching more rows we
+        # will find estimate better which column blocks fail often 2) we have less possibilities to face some
+        # 'permutations' problems
         logging.debug("The sha differences that we consider are: %s", str(subset_differences))
 
-        src_query = "SELECT * FROM %s WHERE gb IN (%s)" % (temp_tables[self.tsrc.get_id_string()], subset_differences)
-        dst_query = "SELECT * FROM %s WHERE gb IN (%s)" % (temp_tables[self.tdst.get_id_string()], subset_differences)
-        logging.debug("queries to find differences in bucket_blocks are: \n%s\n%s", src_query, dst_query)
-
         src_sha_lines = {}  # key=gb, values=list of shas from the blocks (not the one of the whole line)
         dst_sha_lines = {}
-        t_src = threading.Thread(name='srcFetchShaDifferences', target=self.tsrc.launch_query_dict_result,
-                                 args=(src_query, src_sha_lines, True))
-        t_dst = threading.Thread(name='dstFetchShaDifferences', target=self.tdst.launch_query_dict_result,
-                                 args=(dst_query, dst_sha_lines, True))
+        t_src = threading.Thread(name='srcFetchShaDifferences', target=self.tsrc.launch_query_block_shas,
+                                 args=(temp_tables[self.tsrc.get_id_string()], subset_differences, src_sha_lines))
+        t_dst = threading.Thread(name='dstFetchShaDifferences', target=self.tdst.launch_query_block_shas,
+                                 args=(temp_tables[self.tdst.get_id_string()], subset_differences, dst_sha_lines))
         t_src.start()
         t_dst.start()
         t_src.join()
@@ -836,14 +1958,17 @@ class TableComparator(object):
         column_blocks = self.tsrc.get_column_blocks(self.tsrc.get_ddl_columns())
         # noinspection PyUnusedLocal
         map_colblocks_bucketrows = [[] for x in range(len(column_blocks))]
+        buckets_without_block = []
         for bucket_row, dst_blocks in dst_sha_lines.iteritems():
             src_blocks = src_sha_lines[bucket_row]
+            found_block = False
             for idx, sha in enumerate(dst_blocks):
                 if sha != src_blocks[idx]:
                     column_blocks_most_differences[idx] += 1
                     map_colblocks_bucketrows[idx].append(bucket_row)
-        logging.debug("Block columns with most differences are: %s. Which correspond to those bucket rows: %s",
-                      column_blocks_most_differences, map_colblocks_bucketrows)
+                    found_block = True
+            if not found_block:
+                buckets_without_block.append(bucket_row)
 
         # collisions could happen for instance with those 2 "rows" (1st column is the Group BY value, 2nd column is the
         # value of a column in the data, 3rd column is the value of another column which belongs to another 'block
@@ -854,15 +1979,80 @@ class TableComparator(object):
         # ## DST table:
         # bucket1   0   A
         # bucket1   1   B
-        # In such case, the 'grouped sha of each column' will be always the same. But the sha-lines will be different
-        # That leads to a bad situation where the program says that there are some differences but it  is not possible
-        # to show them on the the web page (which is quite confusing for the user running the program).
-        if len(column_blocks_most_differences) == 0:
-            raise RuntimeError("Program faced some collisions when trying to assess which blocks of columns were not"
-                               "correct. Please contact the developer to ask for a fix")
+        # If the checksums of the blocks only contained the values of their columns, the 'grouped sha of each column'
+        # would be always the same, while the sha-lines would be different. This is why each block also contains the
+        # value of the Group By column: the values cannot "move" between rows anymore without changing the blocks.
+        # The only remaining case is when several rows share the same Group By value. Then we cannot know which block
+        # is different, and we consider all the blocks for those buckets, instead of failing (and losing the results
+        # of the expensive sha queries).
+        if len(buckets_without_block) > 0:
+            logging.warning("The column blocks with differences could not be found for %i buckets (several rows share "
+                            "the same Group By value), so all the column blocks are considered for those buckets",
+                            len(buckets_without_block))
+            for idx in range(len(column_blocks)):
+                column_blocks_most_differences[idx] += len(buckets_without_block)
+                map_colblocks_bucketrows[idx].extend(buckets_without_block)
+        logging.debug("Block columns with most differences are: %s. Which correspond to those bucket rows: %s",
+                      column_blocks_most_differences, map_colblocks_bucketrows)
 
         return column_blocks_most_differences, map_colblocks_bucketrows
 
+    def get_columns_with_differences(self, columns, buckets_values):
+        """Return the columns (among the ones of a column block) that present some differences in the given buckets
+
+        A checksum is computed for each column, restricted to the buckets with differences, so that we can pinpoint
+        which columns of the block are really different.
+
+        :type columns: list of dict
+        :param columns: the columns of the column block, with the format: {"name": col_name, "type": col_type}
+
+        :type buckets_values: str
+        :param buckets_values: the list of values (separated by ",") of the buckets with differences
+
+        :rtype: list of dict
+        :returns: the columns with some differences. If no column could be found (collisions), then all the columns of
+                the block are returned
+        """
+        src_query = self.tsrc.create_sql_column_checksums(columns, buckets_values)
+        dst_query = self.tdst.create_sql_column_checksums(columns, buckets_values)
+
+        src_column_shas = {}  # key=gb, values=list of shas of each column
+        dst_column_shas = {}
+        t_src = threading.Thread(name='srcFetchColumnShas', target=self.tsrc.launch_query_dict_result,
+                                 args=(src_query, src_column_shas, True, "drilldown"))
+        t_dst = threading.Thread(name='dstFetchColumnShas', target=self.tdst.launch_query_dict_result,
+                                 args=(dst_query, dst_column_shas, True, "drilldown"))
+        t_src.start()
+        t_dst.start()
+        t_src.join()
+        t_dst.join()
+
+        for column_shas in (src_column_shas, dst_column_shas):
+            if "error" in column_shas:
+                logging.warning("Could not compute the checksums of each column (%s), so all the columns of the block "
+                                "are shown", column_shas["error"])
+                return columns
+
+        differing_indexes = set()
+        for bucket_row in set(src_column_shas.keys()) | set(dst_column_shas.keys()):
+            src_shas = src_column_shas.get(bucket_row)
+            dst_shas = dst_column_shas.get(bucket_row)
+            for idx in range(len(columns)):
+                if src_shas is None or dst_shas is None or src_shas[idx] != dst_shas[idx]:
+                    differing_indexes.add(idx)
+
+        if len(differing_indexes) == 0:
+            logging.debug("No specific column could be found with differences, so all the columns of the block are "
+                          "shown")
+            return columns
+
+        columns_with_differences = [col for idx, col in enumerate(columns) if idx in differing_indexes]
+        list_names = ",".join([x["name"] for x in columns_with_differences])
+        logging.info("The columns with differences are: %s", list_names)
+        print("If those differences are expected, you can exclude those columns with: --ignore-columns '%s'"
+              % list_names)
+        return columns_with_differences
+
     def get_sql_final_differences(self, column_blocks_most_differences, map_colblocks_bucketrows, index):
         """Return the queries to get the real data for the differences found in the last compare_shas() step
 
@@ -886,10 +2076,13 @@ class TableComparator(object):
         """
         column_block_most_different = column_blocks_most_differences.most_common(index)[index - 1][0]
         column_blocks = self.tsrc.get_column_blocks(self.tsrc.get_ddl_columns())
-        # buckets otherwise we might want to take a second block
-        list_column_to_check = " ,".join([x["name"] for x in column_blocks[column_block_most_different]])
         # let's display just 10 buckets in error max
         list_hashs = " ,".join(map(str, map_colblocks_bucketrows[column_block_most_different][:10]))
+        columns = column_blocks[column_block_most_different]
+        if self.localize_columns:
+            columns = self.get_columns_with_differences(columns, list_hashs)
+        # buckets otherwise we might want to take a second block
+        list_column_to_check = " ,".join([x["name"] for x in columns])
 
         src_final_sql = self.tsrc.create_sql_show_bucket_columns(list_column_to_check, list_hashs)
         dst_final_sql = self.tdst.create_sql_show_bucket_columns(list_column_to_check, list_hashs)
@@ -897,8 +2090,65 @@ class TableComparator(object):
 
         return src_final_sql, dst_final_sql, list_column_to_check
 
+    def create_bucket_indexes(self, column_blocks_most_differences, map_colblocks_bucketrows, tables_to_clean):
+        """Copy, for each table, the rows of all the buckets that the drill-down may show in a bucket index
+
+        Each column block shown reads the whole tables twice (see get_columns_with_differences() and
+        get_sql_final_differences()), only to keep the rows of some buckets. With the indexes, the whole tables are read
+        only once, and then the queries of all the column blocks only read the (small) indexes.
+
+        The indexes are not created for the snapshots (which do not contain the rows) and for the tables whose
+        checksums are computed locally (which are small anyway). If the creation fails, the drill-down queries read
+        the whole table, as usual.
+
+        :type column_blocks_most_differences: :class:`Counter`
+        :param column_blocks_most_differences: the Counter of the column blocks with most differences (see
+                get_column_blocks_most_differences())
+
+        :type map_colblocks_bucketrows: list of list
+        :param map_colblocks_bucketrows: the buckets with differences of each column block (see
+                get_column_blocks_most_differences())
+
+        :type tables_to_clean: list
+        :param tables_to_clean: the temporary tables to delete at the end of the sha step. The indexes are added to it
+        """
+        tables = {"src": self.tsrc, "dst": self.tdst}
+        phase = self.get_checkpoint_phase("bucket_index")
+        if phase is not None:
+            if all(tables[side].temporary_table_exists(name) for side, name in phase["indexes"].items()):
+                for side, name in phase["indexes"].items():
+                    tables[side].set_bucket_index(name, phase["buckets"])
+                    tables_to_clean.append((name, tables[side]))
+                return
+            logging.warning("The bucket indexes do not exist anymore, so they are created again")
+            self.checkpoint.remove_phases(["bucket_index"])
+
+        buckets = set()
+        for column_block in column_blocks_most_differences:
+            # the same buckets as in get_sql_final_differences()
+            buckets.update(int(x) for x in map_colblocks_bucketrows[column_block][:10])
+
+        def create(table):
+            try:
+                return table.create_bucket_index(buckets)
+            except:
+                logging.warning("The bucket index of %s could not be created (%s), so the drill-down queries read the "
+                                "whole table", table.get_id_string(), sys.exc_info()[1])
+                return None
+
+        sides = [side for side, table in sorted(tables.items())
+                 if table.get_type() != "snapshot" and not table.use_local_checksums()]
+        logging.info("Copying the rows of the %i buckets with differences in some bucket indexes", len(buckets))
+        names = run_in_parallel([(side + "BucketIndex", create, (tables[side],)) for side in sides], 2)
+        indexes = {}
+        for side, name in zip(sides, names):
+            if name is not None:
+                indexes[side] = name
+                tables_to_clean.append((name, tables[side]))
+        self.save_checkpoint_phase("bucket_index", {"indexes": indexes, "buckets": sorted(buckets)})
+
     @staticmethod
-    def display_html_diff(result, file_name, col_description):
+    def display_html_diff(result, file_name, col_description, open_browser=True):
         """Show the difference of the analysis in a graphical webpage
 
          :type result: dict
@@ -909,6 +2159,9 @@ class TableComparator(object):
 
          :type col_description: str
          :param col_description: "," separated list of the 5 extra columns from the column block we show in the diff
+
+         :type open_browser: bool
+         :param open_browser: False to only write the HTML file, without showing it in a web browser
          """
         sorted_file = {}
         keys = result.keys()
@@ -925,7 +2178,8 @@ class TableComparator(object):
             f.write(diff_html)
         logging.debug("Sorted results of the queries are in the files %s and %s. HTML differences are in %s",
                       sorted_file[keys[0]], sorted_file[keys[1]], html_file)
-        webbrowser.open("file://" + html_file, new=2)
+        if open_browser:
+            webbrowser.open("file://" + html_file, new=2)
 
     def show_results_final_differences(self, src_sql, dst_sql, list_extra_columns):
         """If any differences found in the shas analysis step, then show them in a webpage
@@ -955,16 +2209,241 @@ class TableComparator(object):
         col_description = "</br>hash(%s) , %s , %s" \
                           % (self.tsrc.get_groupby_column(), self.tsrc.get_groupby_column(), list_extra_columns)
 
-        self.display_html_diff(result, "/tmp/sha_diff", col_description)
+        self.display_html_diff(result, self.get_report_file("sha_diff"), col_description, self.open_browser)
 
         return False  # no need to execute the script further since errors have already been spotted
 
+    def show_results_batch_report(self, column_blocks_most_differences, map_colblocks_bucketrows):
+        """Fetch the rows of all the column blocks with differences at the same time and write them in a report
+
+        This is the non-interactive version of the drill-down of perform_step_sha(): the column blocks are not shown one
+        by one in a web page, waiting for the user before fetching the next one. Instead, the queries of all the column
+        blocks are launched concurrently (at most batch_max_parallel blocks at the same time), and a single text report
+        is written, with one section per column block (in the same order as in the drill-down).
+
+        The connections cannot be shared by several queries at the same time, so the additional workers are
+        TableComparators with their own connections (see comparator_factory).
+
+        :type column_blocks_most_differences: :class:`Counter`
+        :param column_blocks_most_differences: the Counter of the column blocks with most differences (see
+                get_column_blocks_most_differences())
+
+        :type map_colblocks_bucketrows: list of list
+        :param map_colblocks_bucketrows: the buckets with differences of each column block (see
+                get_column_blocks_most_differences())
+        """
+        src_id = self.tsrc.get_id_string()
+        dst_id = self.tdst.get_id_string()
+        most_common = column_blocks_most_differences.most_common()
+        number_workers = max(1, min(self.batch_max_parallel, len(most_common)))
+        logging.info("Fetching the %i column blocks with differences, %i at the same time", len(most_common),
+                     number_workers)
+        workers = [self]
+        if number_workers > 1:
+            workers += run_in_parallel([("worker%i" % idx, self.comparator_factory, ())
+                                        for idx in range(1, number_workers)], number_workers)
+        workers_lock = threading.Lock()
+
+        def fetch(index):
+            with workers_lock:
+                worker = workers.pop()
+            try:
+                src_sql, dst_sql, list_columns = worker.get_sql_final_differences(column_blocks_most_differences,
+                                                                                  map_colblocks_bucketrows, index)
+                result = {src_id: [], dst_id: []}
+                run_in_parallel([("src" + threading.current_thread().name, worker.tsrc.launch_query_csv_compare_result,
+                                  (src_sql, result[src_id])),
+                                 ("dst" + threading.current_thread().name, worker.tdst.launch_query_csv_compare_result,
+                                  (dst_sql, result[dst_id]))], 2)
+                return list_columns, result, None
+            except:
+                logging.warning("The rows of the column block %i could not be fetched: %s", index, sys.exc_info()[1])
+                return None, None, sys.exc_info()[1]
+            finally:
+                with workers_lock:
+                    workers.append(worker)
+
+        try:
+            sections = run_in_parallel([("block%i" % idx, fetch, (idx,)) for idx in range(1, len(most_common) + 1)],
+                                       number_workers)
+        finally:
+            for worker in workers:
+                if worker is not self:
+                    worker.release_connections()
+
+        lines = ["Differences between %s and %s: %i column blocks with differences"
+                 % (src_id, dst_id, len(most_common)),
+                 "Each row is shown as: ^ hash(%s) | %s | <columns> $"
+                 % (self.tsrc.get_groupby_column(), self.tsrc.get_groupby_column())]
+        for idx, ((column_block, _), (list_columns, result, error)) in enumerate(zip(most_common, sections)):
+            number_buckets = len(map_colblocks_bucketrows[column_block])
+            lines.append("")
+            lines.append("=== Column block %i/%i (%i buckets with differences, %i shown): %s ==="
+                         % (idx + 1, len(most_common), number_buckets, min(number_buckets, 10),
+                            list_columns if error is None else "?"))
+            if error is not None:
+                lines.append("The rows could not be fetched: %s" % error)
+                continue
+            diff = list(difflib.unified_diff(sorted(result[src_id]), sorted(result[dst_id]), src_id, dst_id, n=0,
+                                             lineterm=""))
+            if len(diff) == 0:
+                lines.append("No differences were found in the rows fetched")
+            lines.extend(diff)
+
+        with open(self.batch_report, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        print("The %i column blocks with differences have been written in %s" % (len(most_common), self.batch_report))
+
+    def show_results_full_differences(self, sha_differences):
+        """Fetch all the columns of the rows with differences and compare them locally, column by column
+
+        Instead of showing the column blocks one by one (see get_sql_final_differences), all the columns of all the
+        buckets with differences are extracted from both tables (up to full_diff_max_rows rows per table). The rows are
+        saved locally and matched on their Group By value, so that we can report for each column how many rows differ.
+
+        :type sha_differences: list
+        :param sha_differences: the list of Group By values which present different row checksums
+        """
+        import local_diff
+
+        all_columns = [x["name"] for x in self.tsrc.get_ddl_columns()]
+        list_columns = " ,".join(all_columns)
+        list_hashs = " ,".join(map(str, sha_differences[:10000]))  # same limit as in get_column_blocks_most_differences
+        src_id = self.tsrc.get_id_string()
+        dst_id = self.tdst.get_id_string()
+        queries = {}
+        for table in (self.tsrc, self.tdst):
+            queries[table.get_id_string()] = table.create_sql_show_bucket_columns(list_columns, list_hashs) \
+                + " LIMIT %i" % self.full_diff_max_rows
+
+        logging.info("Extracting all the %i columns of %i buckets with differences", len(all_columns),
+                     min(len(sha_differences), 10000))
+        result = {src_id: [], dst_id: []}
+        t_src = threading.Thread(name='srcFullDifferences', target=self.tsrc.launch_query_rows_result,
+                                 args=(queries[src_id], result[src_id]))
+        t_dst = threading.Thread(name='dstFullDifferences', target=self.tdst.launch_query_rows_result,
+                                 args=(queries[dst_id], result[dst_id]))
+        t_src.start()
+        t_dst.start()
+        t_src.join()
+        t_dst.join()
+
+        for instance in (src_id, dst_id):
+            if len(result[instance]) >= self.full_diff_max_rows:
+                logging.warning("The limit of %i rows was reached for %s: the comparison is only partial. Consider "
+                                "raising it with the '--full-diff-max-rows' option", self.full_diff_max_rows, instance)
+
+        key_columns = ["_bucket", "_key"]
+        column_names = key_columns + all_columns
+        frames = {}
+        for instance in (src_id, dst_id):
+            frames[instance] = local_diff.build_frame(result[instance], column_names)
+            local_diff.save_frame(frames[instance], self.get_report_file("full_diff_" + instance + ".pkl"))
+
+        report = local_diff.compare_frames(frames[src_id], frames[dst_id], key_columns, all_columns)
+        text_report = local_diff.format_report(report, src_id, dst_id)
+        report_file = self.get_report_file("full_diff.txt")
+        with open(report_file, "w") as f:
+            f.write(text_report)
+        print(text_report)
+        logging.debug("The report of the differences is in %s", report_file)
+
+        columns_with_differences = [x[0] for x in report["columns"]]
+        if len(columns_with_differences) > 0:
+            print("If those differences are expected, you can exclude those columns with: --ignore-columns '%s'"
+                  % ",".join(columns_with_differences))
+
+    def get_checkpoint_phase(self, name):
+        """Return the results of a phase saved by a previous execution of this run, if any
+
+        :type name: str
+        :param name: name of the phase
+
+        :rtype: dict
+        :returns: the results of the phase, or None if the phase has not been done yet (or if no checkpoint is used)
+        """
+        if self.checkpoint is None or not self.checkpoint.has_phase(name):
+            return None
+        logging.debug("The results of the phase '%s' are taken from the checkpoint of the run", name)
+        return self.checkpoint.get_phase(name)
+
+    def save_checkpoint_phase(self, name, results):
+        """Save the results of a phase in the checkpoint of the run (if a checkpoint is used)
+
+        :type name: str
+        :param name: name of the phase
+
+        :type results: dict
+        :param results: the results of the phase. Must be serializable in JSON
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.save_phase(name, results)
+
     def synchronise_tables(self):
         """Ensure that some specific properties between the 2 tables have the same values, like the Group By column"""
+        phase = self.get_checkpoint_phase("synchronise")
+        if phase is not None:
+            self.tsrc._ddl_columns = phase["columns"]
+            self.tsrc._group_by_column = phase["group_by_column"]
+
+        def prepare_source():
+            self.tsrc.get_ddl_columns()
+            self.tsrc.get_groupby_column()
+
+        if len(self.tdst._ddl_columns) == 0:  # the destination uses the columns of the source, but its own partitions
+            run_in_parallel([("srcSchema", prepare_source, ()), ("dstSchema", self.tdst.load_schema, ())], 2)
+        else:
+            prepare_source()
         self.tdst._ddl_columns = self.tsrc.get_ddl_columns()
         # a check DDL comparison
         self.tdst._group_by_column = self.tsrc.get_groupby_column()  # the Group By must use the same column for both
         # tables
+        if phase is None:
+            self.save_checkpoint_phase("synchronise", {
+                "columns": [{"name": x["name"], "type": x["type"]} for x in self.tsrc.get_ddl_columns()],
+                "group_by_column": self.tsrc.get_groupby_column()})
+
+    def check_metadata_row_counts(self):
+        """Compare the numbers of rows of the 2 tables given by their metadata, to report a difference without any scan
+
+        The result is kept, so the metadata are only fetched once.
+
+        :rtype: bool
+        :returns: True if the metadata show that the tables do not have the same number of rows
+        """
+        if self._metadata_counts_differ is None:
+            src_rows, dst_rows = run_in_parallel([("srcMetadataCount", self.tsrc.get_metadata_row_count, ()),
+                                                  ("dstMetadataCount", self.tdst.get_metadata_row_count, ())], 2)
+            self._metadata_counts_differ = src_rows is not None and dst_rows is not None and src_rows != dst_rows
+            if self._metadata_counts_differ:
+                print("According to their metadata, the tables do not have the same number of rows (%s: %i - %s: %i)"
+                      % (self.tsrc.get_id_string(), src_rows, self.tdst.get_id_string(), dst_rows))
+            elif src_rows is not None and dst_rows is not None:
+                logging.info("According to their metadata, both tables have %i rows", src_rows)
+        return self._metadata_counts_differ
+
+    def find_partitions_metadata_differences(self, column, partitions):
+        """Return the partitions whose numbers of rows are different according to the metadata of the 2 tables
+
+        :type column: str
+        :param column: the column that partitions the tables
+
+        :type partitions: list of str
+        :param partitions: the values of the partitions
+
+        :rtype: dict
+        :returns: the ``(source rows, destination rows)`` tuple of each partition with a difference
+        """
+        src_counts, dst_counts = run_in_parallel([
+            ("srcMetadataCount", self.tsrc.get_metadata_partition_row_counts, (column, partitions)),
+            ("dstMetadataCount", self.tdst.get_metadata_partition_row_counts, (column, partitions))], 2)
+        differences = {}
+        for value in partitions:
+            src_rows = src_counts[value]
+            dst_rows = dst_counts[value]
+            if src_rows is not None and dst_rows is not None and src_rows != dst_rows:
+                differences[value] = (src_rows, dst_rows)
+        return differences
 
     def perform_step_count(self):
         """Execute the Count comparison of the 2 tables
@@ -972,8 +2451,16 @@ class TableComparator(object):
         :rtype: bool
         :returns: True if we haven't found differences yet and further analysis is needed
         """
+        self.check_metadata_row_counts()  # a difference can be reported before the (long) Count queries
         self.synchronise_tables()
-        diff, big_small = self.compare_groupby_count()
+        phase = self.get_checkpoint_phase("count")
+        if phase is not None:
+            diff = [tuple(x) for x in phase["differences"]]
+            big_small = (self.tsrc, self.tdst) if phase["biggest_table"] == "src" else (self.tdst, self.tsrc)
+        else:
+            diff, big_small = self.compare_groupby_count()
+            self.save_checkpoint_phase("count", {"differences": diff,
+                                                 "biggest_table": "src" if big_small[0] is self.tsrc else "dst"})
 
         if len(diff) == 0:
             print("No differences were found when doing a Count on the tables %s and %s and grouping by on the "
@@ -983,46 +2470,921 @@ class TableComparator(object):
         self.show_results_count(diff, big_small)
         return False  # no need to execute the script further since errors have already been spotted
 
+    def estimate_step_bytes(self, step_name, queries):
+        """Return (and log) the number of bytes that the queries of a step would process in total
+
+        :type step_name: str
+        :param step_name: the name of the step, for the logs
+
+        :type queries: list of tuple
+        :param queries: the ``(table, query)`` of each query of the step
+
+        :rtype: int
+        :returns: the number of bytes (0 if none of the databases bills by the bytes processed)
+        """
+        total_bytes = 0
+        for table, query in queries:
+            number_bytes = table.estimate_query_bytes(query)
+            if number_bytes is not None:
+                logging.debug("The %s query on %s would process %s", step_name, table.get_id_string(),
+                              budget.format_bytes(number_bytes))
+                total_bytes += number_bytes
+        logging.info("Estimated cost of the %s step: %s processed in BigQuery", step_name,
+                     budget.format_bytes(total_bytes))
+        return total_bytes
+
+    def plan_steps_within_budget(self, do_count, do_sha, use_iblt=False, other_destinations=()):
+        """Estimate the bytes processed by the Count and sha steps, and only keep the steps that fit in the budget
+
+        The sha (or IBLT) step reads all the columns, so it is much more expensive than the Count step. When the budget
+        is too small for both, only the Count comparison is done (just like with '--just-count'). The program stops if
+        even the Count step does not fit in the budget. When the tables are compared partition by partition, the
+        queries on the whole tables give an upper bound of the bytes processed by the queries of all the partitions.
+
+        :type do_count: bool
+        :param do_count: True if the Count step was asked
+
+        :type do_sha: bool
+        :param do_sha: True if the sha (or IBLT) step was asked
+
+        :type use_iblt: bool
+        :param use_iblt: True if the IBLT step is executed instead of the sha step
+
+        :type other_destinations: list of :class:`_Table`
+        :param other_destinations: the other destination tables, when the source is compared with several destinations
+                (see perform_step_destinations()). The queries of the source are only executed once
+
+        :rtype: tuple
+        :returns: ``(do_count, do_sha)``, the steps to execute
+        """
+        self.synchronise_tables()
+        tables = [self.tsrc, self.tdst]
+        for table in other_destinations:  # synchronised like the first destination, to build their queries
+            table._ddl_columns = self.tsrc.get_ddl_columns()
+            table._group_by_column = self.tsrc.get_groupby_column()
+            tables.append(table)
+        count_bytes = self.estimate_step_bytes("Count", [(t, t.create_sql_groupby_count()) for t in tables])
+        sha_bytes = 0
+        if do_sha:
+            sha_bytes = self.estimate_step_bytes("IBLT" if use_iblt else "sha", [
+                (t, t.create_sql_iblt(self.iblt_cells) if use_iblt else t.create_sql_intermediate_checksums())
+                for t in tables])
+        remaining = self.budget.get_remaining()
+        if do_sha and (count_bytes if do_count else 0) + sha_bytes > remaining:
+            if count_bytes > remaining:
+                sys.exit("Neither the Count step (%s) nor the %s step (%s) fit in the remaining budget of %s (see "
+                         "--max-bytes-billed)" % (budget.format_bytes(count_bytes), "IBLT" if use_iblt else "sha",
+                                                  budget.format_bytes(sha_bytes), budget.format_bytes(remaining)))
+            logging.warning("The %s step would exceed the remaining budget of %s, so only the Count comparison is done "
+                            "(just like with '--just-count')", "IBLT" if use_iblt else "sha",
+                            budget.format_bytes(remaining))
+            return True, False
+        if do_count and count_bytes > remaining:
+            sys.exit("The Count step would process %s, more than the remaining budget of %s (see --max-bytes-billed)"
+                     % (budget.format_bytes(count_bytes), budget.format_bytes(remaining)))
+        return do_count, do_sha
+
+    def compare_partition(self, do_count, do_sha, write_report=False):
+        """Compare the 2 tables (restricted to one partition) without any interaction, and return a summary
+
+        Contrary to perform_step_count() and perform_step_sha(), the differences are not shown and the temporary tables
+        are directly deleted. This is used when several partitions (or several destinations) are compared at the same
+        time (see perform_step_partitions() and perform_step_destinations()).
+
+        :type do_count: bool
+        :param do_count: True if the Count comparison must be done
+
+        :type do_sha: bool
+        :param do_sha: True if the sha comparison must be done (if no differences were found in the Count comparison)
+
+        :type write_report: bool
+        :param write_report: True to write the column blocks with differences found by the sha comparison in the batch
+                report (see show_results_batch_report()), before the temporary tables are deleted
+
+        :rtype: dict
+        :returns: the summary ``{"status": status, "buckets": differences}``, where ``status`` is "equal", "count" or
+                    "sha" (the step where the differences were found) and ``differences`` is the list of Group By
+                    values (buckets) with differences. The summary also contains the ``"report"`` file, if it was
+                    written
+        """
+        if do_count:
+            diff, _ = self.compare_groupby_count()
+            if len(diff) != 0:
+                return {"status": "count", "buckets": [x[0] for x in diff]}
+        if do_sha:
+            sha_differences, temporary_tables, tables_to_clean = self.compare_shas()
+            if len(sha_differences) == 0:
+                self.clean_step_sha(tables_to_clean)
+                return {"status": "equal", "buckets": []}
+            result = {"status": "sha", "buckets": sha_differences}
+            if write_report:
+                try:
+                    with self.tsrc.connection_lock:  # the source may be shared with other comparisons (see
+                        # perform_step_destinations()), which must wait for the end of the queries of the report
+                        cb_most_diff, map_cb_bucketrows = self.get_column_blocks_most_differences(sha_differences,
+                                                                                                  temporary_tables)
+                        self.show_results_batch_report(cb_most_diff, map_cb_bucketrows)
+                    result["report"] = self.batch_report
+                except Exception:  # the differences were found anyway
+                    logging.warning("The report of the differences could not be written: %s", sys.exc_info()[1])
+            self.clean_step_sha(tables_to_clean)
+            return result
+        return {"status": "equal", "buckets": []}
+
+    def discover_partitions(self, column):
+        """Return all the values of the partition column that appear in the source or in the destination table
+
+        :type column: str
+        :param column: the column that partitions the tables
+
+        :rtype: list of str
+        :returns: the sorted values of the partitions
+        """
+        logging.info("Discovering the partitions of the column %s", column)
+        src_values, dst_values = run_in_parallel([("srcPartitions", self.tsrc.get_partition_values, (column,)),
+                                                  ("dstPartitions", self.tdst.get_partition_values, (column,))], 2)
+        partitions = sorted(set(src_values) | set(dst_values))
+        logging.info("%i partitions were found", len(partitions))
+        return partitions
+
+    def perform_step_partitions(self, column, partitions, comparator_factory, max_parallel, do_count, do_sha):
+        """Compare the tables partition by partition, each partition being an independent comparison
+
+        The partitions are compared in parallel (but with a limited number at the same time). The result of each
+        partition is saved in the checkpoint of the run as soon as it is known, so that resuming the run only compares
+        again the partitions that failed.
+
+        :type column: str
+        :param column: the column that partitions the tables
+
+        :type partitions: list of str
+        :param partitions: the values of the partitions to compare. If None, they are discovered from both tables
+
+        :type comparator_factory: function
+        :param comparator_factory: function that receives the value of a partition and returns a new TableComparator
+                                    whose tables are restricted to this partition
+
+        :type max_parallel: int
+        :param max_parallel: the maximum number of partitions that are compared at the same time
+
+        :type do_count: bool
+        :param do_count: True if the Count comparison must be done
+
+        :type do_sha: bool
+        :param do_sha: True if the sha comparison must be done
+
+        :rtype: bool
+        :returns: True if no differences (nor errors) were found in any partition
+        """
+        self.synchronise_tables()
+        if partitions is None:
+            partitions = self.discover_partitions(column)
+
+        results = {}
+        todo = []
+        for value in partitions:
+            phase = self.get_checkpoint_phase("partition:" + value)
+            if phase is not None:
+                results[value] = phase
+            else:
+                todo.append(value)
+        metadata_differences = self.find_partitions_metadata_differences(column, todo)
+        if len(metadata_differences) > 0:
+            # no need to scan the other partitions for now: the differences of those partitions must be fixed first
+            print("According to the metadata, %i partitions do not have the same number of rows:"
+                  % len(metadata_differences))
+            for value in todo:
+                if value in metadata_differences:
+                    print("%s: %i rows in %s - %i rows in %s" % (value, metadata_differences[value][0],
+                                                                 self.tsrc.get_id_string(),
+                                                                 metadata_differences[value][1],
+                                                                 self.tdst.get_id_string()))
+                else:
+                    results[value] = {"status": "skipped", "buckets": []}
+            todo = [value for value in todo if value in metadata_differences]
+            print("Only those partitions are compared now")
+        logging.info("Comparing %i partitions (%i at the same time)", len(todo), max_parallel)
+
+        def compare(value):
+            partition_tc = None
+            try:
+                partition_tc = comparator_factory(value)
+                result = partition_tc.compare_partition(do_count or value in metadata_differences, do_sha)
+            except (Exception, SystemExit):  # an error in one partition must not stop the other ones
+                error = sys.exc_info()[1]
+                logging.error("The comparison of the partition %s failed: %s", value, error)
+                if partition_tc is not None:
+                    partition_tc.release_connections(False)  # a query may have been interrupted
+                return {"status": "error", "error": str(error), "buckets": []}
+            partition_tc.release_connections()
+            self.save_checkpoint_phase("partition:" + value, result)
+            return result
+
+        tasks = [("partition-" + value, compare, (value,)) for value in todo]
+        for value, result in zip(todo, run_in_parallel(tasks, max_parallel)):
+            results[value] = result
+
+        self.show_results_partitions(column, partitions, results)
+        return all(results[value]["status"] == "equal" for value in partitions)
+
     @staticmethod
-    def clean_step_sha(tables_to_clean):
+    def show_results_partitions(column, partitions, results):
+        """Print the result of each partition, and a summary merging the results of all the partitions
+
+        :type column: str
+        :param column: the column that partitions the tables
+
+        :type partitions: list of str
+        :param partitions: the values of the partitions, in the order they must be shown
+
+        :type results: dict
+        :param results: the summary of each partition (see compare_partition())
+        """
+        descriptions = {"equal": "no differences",
+                        "skipped": "not compared yet (other partitions have different numbers of rows)",
+                        "count": "%i Group By values with a different number of rows",
+                        "sha": "%i Group By values with different checksums"}
+        width = max([len(column)] + [len(value) for value in partitions])
+        print("%s  Result" % column.ljust(width))
+        differing_buckets = set()
+        for value in partitions:
+            result = results[value]
+            if result["status"] == "error":
+                description = "error: " + result["error"]
+            elif result["status"] in ("equal", "skipped"):
+                description = descriptions[result["status"]]
+            else:
+                description = descriptions[result["status"]] % len(result["buckets"])
+            differing_buckets.update(result["buckets"])
+            print("%s  %s" % (value.ljust(width), description))
+
+        statuses = Counter(results[value]["status"] for value in partitions)
+        print("\n%i partitions without differences, %i partitions with differences, %i partitions in error, %i "
+              "partitions not compared" % (statuses["equal"], statuses["count"] + statuses["sha"], statuses["error"],
+                                           statuses["skipped"]))
+        if len(differing_buckets) > 0:
+            print("In total, %i distinct Group By values present some differences. To see them, run again the script "
+                  "adding the\ncondition on %s to the --source-where and --destination-where options"
+                  % (len(differing_buckets), column))
+        if statuses["error"] > 0:
+            print("The partitions in error can be compared again with the option --resume")
+
+    def perform_step_destinations(self, destinations, max_parallel, do_count, do_sha):
+        """Compare the source table with several destination tables, executing the queries on the source only once
+
+        The Count and sha queries of the source are shared by the comparisons of all the destinations (see
+        _Table.share_results()), which are done in parallel (but with a limited number at the same time). They all use
+        the columns and the Group By column of the source. Just like for the partitions, the result of each destination
+        is saved in the checkpoint of the run as soon as it is known.
+
+        :type destinations: list of tuple
+        :param destinations: the ``(definition, table)`` of each destination table, where ``definition`` is the name
+                            given on the command line
+
+        :type max_parallel: int
+        :param max_parallel: the maximum number of destinations that are compared at the same time
+
+        :type do_count: bool
+        :param do_count: True if the Count comparison must be done
+
+        :type do_sha: bool
+        :param do_sha: True if the sha comparison must be done
+
+        :rtype: bool
+        :returns: True if no differences (nor errors) were found with any destination
+        """
+        self.synchronise_tables()
+        self.tsrc.share_results()
+        self.tsrc.use_local_checksums()  # some metadata of the source are fetched before its connection is shared
+        if self.result_cache is not None:
+            self.tsrc.get_table_version()
+
+        results = {}
+        todo = []
+        for definition, table in destinations:
+            phase = self.get_checkpoint_phase("destination:" + definition)
+            if phase is not None:
+                results[definition] = phase
+            else:
+                todo.append((definition, table))
+        logging.info("Comparing %s with %i destinations (%i at the same time)", self.tsrc.get_id_string(), len(todo),
+                     max_parallel)
+
+        def compare(index, definition, table):
+            comparator = copy.copy(self)
+            comparator.set_checkpoint(None)  # the results of the destinations are saved by this TableComparator
+            comparator.set_tdst(table)
+            # the differences of each destination are written in its own report, while the temporary tables of the
+            # shared queries on the source still exist. Its queries are executed one after the other, and the reports
+            # of the destinations are written one at a time, since they all use the connection of the source
+            if self.batch_report is not None:
+                root, extension = os.path.splitext(self.batch_report)
+                comparator.set_batch_report("%s_%i%s" % (root, index, extension), 1, None)
+            else:
+                comparator.set_batch_report(self.get_report_file("destination_%i.txt" % index), 1, None)
+            try:
+                comparator.synchronise_tables()
+                result = comparator.compare_partition(do_count, do_sha, True)
+            except (Exception, SystemExit):  # an error with one destination must not stop the other ones
+                error = sys.exc_info()[1]
+                logging.error("The comparison with %s failed: %s", definition, error)
+                return {"status": "error", "error": str(error), "buckets": []}
+            self.save_checkpoint_phase("destination:" + definition, result)
+            return result
+
+        numbers = dict((definition, idx + 1) for idx, (definition, _) in enumerate(destinations))
+        tasks = [("destination-%i" % idx, compare, (numbers[definition], definition, table))
+                 for idx, (definition, table) in enumerate(todo)]
+        for (definition, _), result in zip(todo, run_in_parallel(tasks, max_parallel)):
+            results[definition] = result
+        self.clean_step_sha(self.tsrc.get_shared_temporary_tables())
+
+        self.show_results_destinations([x[0] for x in destinations], results)
+        return all(x["status"] == "equal" for x in results.values())
+
+    def show_results_destinations(self, definitions, results):
+        """Print the result of the comparison of the source table with each destination table
+
+        :type definitions: list of str
+        :param definitions: the names of the destination tables (as given on the command line), in the order they must
+                            be shown
+
+        :type results: dict
+        :param results: the summary of each destination (see compare_partition())
+        """
+        descriptions = {"equal": "no differences",
+                        "count": "%i Group By values with a different number of rows",
+                        "sha": "%i Group By values with different checksums"}
+        width = max(len(x) for x in definitions)
+        print("Comparison of %s with %i destinations:" % (self.tsrc.get_id_string(), len(definitions)))
+        for definition in definitions:
+            result = results[definition]
+            if result["status"] == "error":
+                description = "error: " + result["error"]
+            elif result["status"] == "equal":
+                description = descriptions["equal"]
+            else:
+                description = descriptions[result["status"]] % len(result["buckets"])
+            if result.get("report") is not None:
+                description += " (see %s)" % result["report"]
+            print("%s  %s" % (definition.ljust(width), description))
+
+        statuses = Counter(results[x]["status"] for x in definitions)
+        print("\n%i destinations without differences, %i destinations with differences, %i destinations in error"
+              % (statuses["equal"], statuses["count"] + statuses["sha"], statuses["error"]))
+        if statuses["count"] > 0:
+            print("To see the differences of the numbers of rows, run again the script with the source and only one of "
+                  "those destinations")
+        if statuses["error"] > 0:
+            print("The destinations in error can be compared again with the option --resume")
+
+    def save_snapshot(self, file_name):
+        """Compute the counts and the shas of each Group By value of the source table, and save them in a snapshot file
+
+        The snapshot can then be used as the source table of later comparisons (see snapshot module), so that the
+        source table does not have to be scanned again.
+
+        :type file_name: str
+        :param file_name: the path of the snapshot file
+        """
+        import snapshot
+        table = self.tsrc
+        table_id = table.get_id_string()
+        table.get_groupby_column()  # the schema and the Group By column must be known before launching the queries
+        logging.info("Executing the 'Group By' Count and 'shas' queries on %s to save its snapshot", table_id)
+
+        counts = {}
+        result = {"cleaning": [], "names_sha_tables": {}, "sha_dictionaries": {table_id: {}}}
+        sha_rows = []
+        try:
+            # one after the other: both queries use the connection of the table, which cannot be shared by 2 threads
+            table.launch_query_dict_result(table.create_sql_groupby_count(), counts)
+            table.launch_query_with_intermediate_table(table.create_sql_intermediate_checksums(), result)
+            table.launch_query_rows_result("SELECT * FROM %s" % result["names_sha_tables"][table_id], sha_rows,
+                                           "fetch")
+        finally:
+            self.clean_step_sha(result["cleaning"])
+
+        snapshot.write_snapshot(file_name, table, counts, sha_rows)
+        print("The snapshot of %s has been saved in %s. It can be compared with another table by giving "
+              "'snapshot/%s' as the source table" % (table_id, file_name, file_name))
+
+    def perform_step_iblt(self):
+        """Find the rows that are only in one of the tables, with an Invertible Bloom Lookup Table (see iblt module)
+
+        Each table returns a fixed number of cells (whatever its size), that are subtracted and "peeled" locally to
+        recover the keys of the rows that are different. Those rows are then fetched with a single query on each
+        table, without having to drill down in the buckets.
+        """
+        import iblt
+        self.synchronise_tables()
+        logging.info("Executing the IBLT queries (%i cells) for %s and %s", self.iblt_cells, self.tsrc.get_id_string(),
+                     self.tdst.get_id_string())
+        src_rows = []
+        dst_rows = []
+        run_in_parallel([
+            ("srcIblt", self.tsrc.launch_query_rows_result, (self.tsrc.create_sql_iblt(self.iblt_cells), src_rows,
+                                                              "sha")),
+            ("dstIblt", self.tdst.launch_query_rows_result, (self.tdst.create_sql_iblt(self.iblt_cells), dst_rows,
+                                                              "sha"))], 2)
+        cells = iblt.subtract(iblt.build_cells(src_rows), iblt.build_cells(dst_rows))
+        src_keys, dst_keys, complete = iblt.peel(cells, self.iblt_cells)
+
+        if complete and len(src_keys) == 0 and len(dst_keys) == 0:
+            print("IBLT queries were done and no differences were found: the tables %s and %s are equal!"
+                  % (self.tsrc.get_id_string(), self.tdst.get_id_string()))
+            sys.exit(0)
+
+        print("%i rows are only in %s and %i rows are only in %s (a row with different values appears in both tables)"
+              % (sum(src_keys.values()), self.tsrc.get_id_string(), sum(dst_keys.values()),
+                 self.tdst.get_id_string()))
+        if not complete:
+            print("There are too many differences to recover all of them with %i cells (%i cells could not be "
+                  "decoded).\nIncrease the number of cells with the '--iblt-cells' option, or use the default sha "
+                  "comparison" % (self.iblt_cells, len(cells)))
+        self.show_results_iblt(sorted(src_keys.keys()), sorted(dst_keys.keys()))
+        sys.exit(1)
+
+    def show_results_iblt(self, src_keys, dst_keys):
+        """Fetch the rows that were found by the IBLT comparison and show them in a webpage
+
+        :type src_keys: list of int
+        :param src_keys: the keys of the rows that are only in the source table
+
+        :type dst_keys: list of int
+        :param dst_keys: the keys of the rows that are only in the destination table
+        """
+        gb_column = self.tsrc.get_groupby_column()
+        columns = [gb_column] + [col["name"] for col in self.tsrc.get_ddl_columns() if col["name"] != gb_column]
+        src_id = self.tsrc.get_id_string()
+        dst_id = self.tdst.get_id_string()
+        result = {src_id: [], dst_id: []}
+        tasks = []
+        for name, table, keys in (("srcIbltRows", self.tsrc, src_keys), ("dstIbltRows", self.tdst, dst_keys)):
+            if len(keys) > 0:
+                query = table.create_sql_show_rows_by_keys(columns, keys[:self.iblt_max_rows_shown])
+                tasks.append((name, table.launch_query_csv_compare_result, (query, result[table.get_id_string()])))
+        run_in_parallel(tasks, 2)
+
+        self.display_html_diff(result, self.get_report_file("iblt_diff"), "</br>" + " , ".join(columns),
+                               self.open_browser)
+
+    def clean_step_sha(self, tables_to_clean):
         """Delete temporary table if needed
 
+        The tables are deleted in the background, so that the deletions are not on the critical path (for instance, the
+        comparison of the next partition can start). The program still waits for the end of the deletions before
+        exiting, and the service waits for them before giving back the connections (see wait_for_cleaning()). If a
+        deletion fails, the table is eventually deleted by the next runs (see _Table.delete_stale_temporary_tables()).
+
         :type tables_to_clean: dict
         :param tables_to_clean: contains the name of the tables that need to be deleted, and the table object
+
+        :rtype: list of :class:`threading.Thread`
+        :returns: the threads that delete the tables
         """
+        def delete(table_name, table_object):
+            try:
+                table_object.delete_temporary_table(table_name)
+            except:
+                logging.warning("The temporary table %s could not be deleted: %s", table_name, sys.exc_info()[1])
+
+        threads = []
         for table_name, table_object in tables_to_clean:
-            table_object.delete_temporary_table(table_name)
+            thread = threading.Thread(name="clean-" + table_name, target=delete, args=(table_name, table_object))
+            thread.start()
+            threads.append(thread)
+        self.cleaning_threads.extend(threads)
+        return threads
+
+    def wait_for_cleaning(self):
+        """Wait for the end of the deletions of the temporary tables started by this run (see clean_step_sha())
+
+        The deletions use the connections of the tables, so they must be finished before those connections are used
+        by another run (see service.py).
+        """
+        for thread in self.cleaning_threads:
+            thread.join()
+
+    def release_connections(self, reusable=True):
+        """Give back the connections of the 2 tables, once this TableComparator is not used anymore
+
+        This is needed for the TableComparators created for a partition or a worker, which have their own connections
+        (see create_partition_comparator() and create_worker_comparator()). The deletions of the temporary tables use
+        those connections, so they are waited for first.
+
+        :type reusable: bool
+        :param reusable: False to close the connections instead (see _Table.release_connection())
+        """
+        self.wait_for_cleaning()
+        for table in (self.tsrc, self.tdst):
+            table.release_connection(reusable)
+
+    def load_sha_phase(self):
+        """Return the results of the sha comparison saved by a previous execution of this run, if they are still valid
+
+        The results are only valid if the temporary tables that were created still exist. Otherwise, the results of the
+        sha comparison (and of the phases that depend on it) are forgotten.
+
+        :rtype: tuple
+        :returns: ``(list_differences, names_sha_tables, tables_to_clean)`` (see compare_shas()), or None if no valid
+                    results could be found
+        """
+        phase = self.get_checkpoint_phase("sha")
+        if phase is None:
+            return None
+
+        tables = {"src": self.tsrc, "dst": self.tdst}
+        for table_name, side in phase["cleaning"]:
+            if not tables[side].temporary_table_exists(table_name):
+                logging.warning("The temporary table %s does not exist anymore, so the sha queries must be launched "
+                                "again", table_name)
+                self.checkpoint.remove_phases(["sha", "blocks", "bucket_index", "drilldown"])
+                return None
+        for side, table in tables.items():
+            if table.get_id_string() not in phase["names_sha_tables"]:
+                self.checkpoint.remove_phases(["sha", "blocks", "bucket_index", "drilldown"])
+                return None
+        tables_to_clean = [(table_name, tables[side]) for table_name, side in phase["cleaning"]]
+        self.number_compared_buckets = phase["number_compared_buckets"]
+        return phase["differences"], phase["names_sha_tables"], tables_to_clean
+
+    @staticmethod
+    def get_difference_rate_upper_bound(number_values, confidence=0.95):
+        """Return the upper bound of the rate of values with differences, when none was found in a random sample
+
+        If a proportion p of the values had some differences, the probability of not seeing any of them in a random
+        sample of n values would be (1 - p)^n. The bound is the value of p for which this probability is equal to
+        1 - confidence (about 3/n for a confidence of 95%: the "rule of three").
+
+        :type number_values: int
+        :param number_values: the number of values of the sample, all without differences
+
+        :type confidence: float
+        :param confidence: the confidence of the bound
+
+        :rtype: float
+        :returns: the upper bound of the rate of values with differences (between 0 and 1)
+        """
+        if number_values == 0:
+            return 1.0
+        return 1 - (1 - confidence) ** (1.0 / number_values)
+
+    def show_results_quick_check(self):
+        """Show the result of a quick check where no differences were found, with its confidence bound
+
+        The sampled values are the ones of the Group By column. Their number is unknown, but each compared bucket
+        contains at least one of them: using the number of buckets gives a conservative bound.
+        """
+        number_buckets = self.number_compared_buckets or 0
+        gb_column = self.tsrc.get_groupby_column()
+        print("Quick check done on 1/%i of the values of the column %s (subset %i): no differences were found in the %i"
+              " buckets compared." % (self.quick_check_modulo, gb_column, self.quick_check_residue, number_buckets))
+        print("The tables %s and %s are very likely equal: with a confidence of 95%%, less than %.3g%% of the values of"
+              " %s have\nsome differences. Run the script without '--quick-check' to be sure."
+              % (self.tsrc.get_id_string(), self.tdst.get_id_string(),
+                 100 * TableComparator.get_difference_rate_upper_bound(number_buckets), gb_column))
 
     def perform_step_sha(self):
         """Execute the Sha comparison of the 2 tables"""
         self.synchronise_tables()
-        sha_differences, temporary_tables, tables_to_clean = self.compare_shas()
+        sha_results = self.load_sha_phase()
+        if sha_results is None:
+            sha_results = self.compare_shas()
+            self.save_checkpoint_phase("sha", {
+                "differences": sha_results[0], "names_sha_tables": sha_results[1],
+                "cleaning": [(table_name, "src" if table_object is self.tsrc else "dst")
+                             for table_name, table_object in sha_results[2]],
+                "number_compared_buckets": self.number_compared_buckets})
+        sha_differences, temporary_tables, tables_to_clean = sha_results
+        if len(sha_differences) == 0 and self.quick_check_modulo is not None:
+            self.show_results_quick_check()
+            self.clean_step_sha(tables_to_clean)
+            sys.exit(0)
         if len(sha_differences) == 0:
             print("Sha queries were done and no differences were found: the tables %s and %s are equal!"
                   % (self.tsrc.get_id_string(), self.tdst.get_id_string()))
-            TableComparator.clean_step_sha(tables_to_clean)
+            self.clean_step_sha(tables_to_clean)
             sys.exit(0)
 
-        cb_most_diff, map_cb_bucketrows = self.get_column_blocks_most_differences(sha_differences, temporary_tables)
+        if self.full_diff_max_rows is not None:
+            self.show_results_full_differences(sha_differences)
+            self.clean_step_sha(tables_to_clean)
+            sys.exit(1)
+
+        phase = self.get_checkpoint_phase("blocks")
+        if phase is not None:
+            cb_most_diff = Counter(dict((int(k), v) for k, v in phase["counts"].items()))
+            map_cb_bucketrows = phase["map"]
+        else:
+            cb_most_diff, map_cb_bucketrows = self.get_column_blocks_most_differences(sha_differences,
+                                                                                      temporary_tables)
+            # the columns of the blocks are saved too, so that the run can be verified again (see
+            # perform_step_reverify()): the blocks that are not in the counts were equal
+            self.save_checkpoint_phase("blocks", {
+                "counts": dict(cb_most_diff), "map": map_cb_bucketrows,
+                "columns": [[col["name"] for col in block]
+                            for block in self.tsrc.get_column_blocks(self.tsrc.get_ddl_columns())],
+                "complete": len(sha_differences) <= self.max_block_differences})
+        self.show_results_column_blocks(cb_most_diff, map_cb_bucketrows, tables_to_clean)
+
+    def show_results_column_blocks(self, cb_most_diff, map_cb_bucketrows, tables_to_clean):
+        """Show the differences of the column blocks, one by one (or all of them in the batch report), and exit
+
+        :type cb_most_diff: :class:`Counter`
+        :param cb_most_diff: the Counter of the column blocks with most differences (see
+                get_column_blocks_most_differences())
+
+        :type map_cb_bucketrows: list of list
+        :param map_cb_bucketrows: the buckets with differences of each column block
+
+        :type tables_to_clean: list
+        :param tables_to_clean: the temporary tables to delete at the end
+        """
+        if self.use_bucket_index:
+            self.create_bucket_indexes(cb_most_diff, map_cb_bucketrows, tables_to_clean)
+
+        if self.batch_report is not None:
+            self.show_results_batch_report(cb_most_diff, map_cb_bucketrows)
+            self.clean_step_sha(tables_to_clean)
+            sys.exit(1)
 
-        for idx_cb in range(1, len(cb_most_diff) + 1):
-            if idx_cb > 1:
+        phase = self.get_checkpoint_phase("drilldown")
+        first_idx_cb = 1 if phase is None else phase["shown"] + 1
+        for idx_cb in range(first_idx_cb, len(cb_most_diff) + 1):
+            if idx_cb > first_idx_cb:
                 answer = raw_input('Do you want to see more differences? [Y/n]: ')
                 # Yes being the default, we only exit in case of properly pushing 'n'
                 if answer == 'n':
+                    if self.checkpoint is not None and len(tables_to_clean) > 0 \
+                            and raw_input('Do you want to keep the temporary tables, to see the other differences '
+                                          'later on? [y/N]: ') == 'y':
+                        print("You can see the other differences later on with the option: --resume %s"
+                              % self.checkpoint.run_id)
+                        sys.exit(1)
                     break
 
             queries = self.get_sql_final_differences(cb_most_diff, map_cb_bucketrows, idx_cb)
             print("Showing differences for columns " + queries[2])
             self.show_results_final_differences(queries[0], queries[1], queries[2])
+            self.save_checkpoint_phase("drilldown", {"shown": idx_cb})
+
+        self.clean_step_sha(tables_to_clean)
+        sys.exit(1)
+
+    def perform_step_reverify(self):
+        """Compute again the checksums of the column blocks that were different in a previous run, only in the buckets
+        where they were different
 
-        TableComparator.clean_step_sha(tables_to_clean)
+        The previous run saved (see perform_step_sha()) the columns of each column block and, for the blocks with
+        differences, the buckets where they were different: the other blocks were equal. After a fix, only those blocks
+        and buckets are checked again, with one query per table that computes the checksum of each of their columns in
+        each of their buckets (see create_sql_column_checksums()). The bytes read are thus proportional to what was
+        different (BigQuery bills the columns that are read). The remaining differences are shown as in the sha step.
+        """
+        self.synchronise_tables()
+        previous = self.reverify_checkpoint
+        if not previous.has_phase("blocks"):
+            if previous.has_phase("sha") and len(previous.get_phase("sha")["differences"]) == 0:
+                print("No differences were found by the run %s: there is nothing to verify again" % previous.run_id)
+                sys.exit(0)
+            sys.exit("The run %s cannot be verified again because it did not find the column blocks with differences "
+                     "(its sha step was not done, or not finished)" % previous.run_id)
+        previous_blocks = previous.get_phase("blocks")
+        column_blocks = self.tsrc.get_column_blocks(self.tsrc.get_ddl_columns())
+        if previous_blocks.get("columns", [[col["name"] for col in block] for block in column_blocks]) \
+                != [[col["name"] for col in block] for block in column_blocks]:
+            sys.exit("The columns of the tables have changed since the run %s, so they must be compared again without "
+                     "'--reverify'" % previous.run_id)
+        previous_counts = dict((int(k), v) for k, v in previous_blocks["counts"].items())
+        if len(previous_counts) == 0:
+            print("All the column blocks were equal in the run %s: there is nothing to verify again" % previous.run_id)
+            sys.exit(0)
+        if not previous_blocks.get("complete", True):
+            logging.warning("The run %s found too many differences to save all of them: only the first %i buckets "
+                            "with differences are verified again", previous.run_id, self.max_block_differences)
+
+        phase = self.get_checkpoint_phase("blocks")
+        if phase is not None:
+            cb_most_diff = Counter(dict((int(k), v) for k, v in phase["counts"].items()))
+            map_cb_bucketrows = phase["map"]
+        else:
+            columns = []  # all the columns of the blocks with differences, and the block of each one
+            column_block_indexes = []
+            buckets = set()
+            for block in sorted(previous_counts):
+                columns.extend(column_blocks[block])
+                column_block_indexes.extend([block] * len(column_blocks[block]))
+                buckets.update(int(x) for x in previous_blocks["map"][block])
+            logging.info("Verifying again the %i column blocks (%i columns) with differences in the run %s, in %i "
+                         "buckets. The %i other column blocks were equal", len(previous_counts), len(columns),
+                         previous.run_id, len(buckets), len(column_blocks) - len(previous_counts))
+            buckets_values = ",".join(map(str, sorted(buckets)))
+            src_query = self.tsrc.create_sql_column_checksums(columns, buckets_values)
+            dst_query = self.tdst.create_sql_column_checksums(columns, buckets_values)
+
+            src_column_shas = {}  # key=gb, values=list of shas of each column
+            dst_column_shas = {}
+            t_src = threading.Thread(name='srcReverifyShas', target=self.tsrc.launch_query_dict_result,
+                                     args=(src_query, src_column_shas, True, "drilldown"))
+            t_dst = threading.Thread(name='dstReverifyShas', target=self.tdst.launch_query_dict_result,
+                                     args=(dst_query, dst_column_shas, True, "drilldown"))
+            t_src.start()
+            t_dst.start()
+            t_src.join()
+            t_dst.join()
+            for column_shas in (src_column_shas, dst_column_shas):
+                if "error" in column_shas:
+                    sys.exit(column_shas["error"])
+
+            cb_most_diff = Counter()
+            map_cb_bucketrows = [[] for x in range(len(column_blocks))]
+            for bucket_row in sorted(set(src_column_shas.keys()) | set(dst_column_shas.keys())):
+                src_shas = src_column_shas.get(bucket_row)
+                dst_shas = dst_column_shas.get(bucket_row)
+                blocks = set(column_block_indexes[idx] for idx in range(len(columns))
+                             if src_shas is None or dst_shas is None or src_shas[idx] != dst_shas[idx])
+                for block in blocks:
+                    cb_most_diff[block] += 1
+                    map_cb_bucketrows[block].append(bucket_row)
+            self.number_compared_buckets = len(buckets)
+            self.save_checkpoint_phase("blocks", {
+                "counts": dict(cb_most_diff), "map": map_cb_bucketrows,
+                "columns": [[col["name"] for col in block] for block in column_blocks],
+                "complete": previous_blocks.get("complete", True)})
+
+        for block in sorted(previous_counts):
+            print("Column block %s: %s" % (",".join([col["name"] for col in column_blocks[block]]),
+                                           "%i buckets still with differences" % cb_most_diff[block]
+                                           if block in cb_most_diff else "now equal"))
+        if len(cb_most_diff) == 0:
+            print("The column blocks with differences in the run %s are now equal in %s and %s" % (
+                previous.run_id, self.tsrc.get_id_string(), self.tdst.get_id_string()))
+            # only a part of the tables was read: this must not be taken for the result of a full comparison
+            logging.warning("The other column blocks, equal in the run %s, were not verified again: run the script "
+                            "without '--reverify' to check that the whole tables are equal", previous.run_id)
+            sys.exit(EXIT_CODE_FIXED)
+        self.show_results_column_blocks(cb_most_diff, map_cb_bucketrows, [])
+
+    def perform_step_incremental(self):
+        """Compare the rows modified since the last comparison, and deduce if the whole tables are equal
+
+        For each bucket, the additive checksums (number of rows and sum of their keys, see
+        _Table.create_sql_additive_checksums()) of the rows whose incremental column is between the watermark of the
+        last comparison and the current one (the lowest of the highest values of the 2 tables, so that the rows not
+        yet copied are left for the next comparison) are computed in both tables. The first comparison reads all the
+        rows up to the current watermark.
+
+        The differences between the checksums of the 2 tables are folded into the ones saved by the last comparison.
+        When a row is replaced, its new version has a new value in the incremental column, but the old version cannot
+        be read anymore to subtract its checksum. In the buckets that were equal, the old versions were the same in
+        both tables, so their checksums cancel out and the differences of the modified rows are the ones of the whole
+        buckets. In the buckets that were already different, this is not known anymore, so they are kept as different
+        until all the rows are compared again (see IncrementalState.reset()). The rows deleted, or modified without
+        updating the incremental column, cannot be seen.
+        """
+        state = self.incremental_state
+        column = self.incremental_column
+        if state.watermark is not None and self.tsrc._group_by_column is None:
+            # the sampling may choose another column as the data changes, but the saved differences are per bucket
+            self.tsrc._group_by_column = state.group_by_column
+        self.synchronise_tables()
+        columns = [col["name"] for col in self.tsrc.get_ddl_columns()]
+        if state.watermark is not None \
+                and (state.columns != columns or state.group_by_column != self.tsrc.get_groupby_column()):
+            logging.warning("The columns or the Group By column have changed since the last incremental comparison, so "
+                            "all the rows are compared again")
+            state.reset()
+
+        low = state.watermark
+        watermarks = run_in_parallel([("srcWatermark", self.tsrc.get_incremental_watermark, (column, low)),
+                                      ("dstWatermark", self.tdst.get_incremental_watermark, (column, low))], 2)
+        if low is not None:
+            watermarks = [low if x is None else x for x in watermarks]  # no rows modified since the last comparison
+        elif watermarks == [None, None]:
+            sys.exit("The column %s has no value in %s and %s, so the tables cannot be compared incrementally"
+                     % (column, self.tsrc.get_id_string(), self.tdst.get_id_string()))
+        high = min(x for x in watermarks if x is not None)  # all the rows of the other table are then different
+        if low is not None and high <= low:
+            logging.info("No rows were modified since the last incremental comparison (up to %s)", low)
+        else:
+            logging.info("Executing the incremental queries for %s and %s on the rows with %s in (%s, %s]",
+                         self.tsrc.get_id_string(), self.tdst.get_id_string(), column, low, high)
+            results = run_in_parallel(
+                [(name, self.launch_query_additive_checksums, (table, column, low, high))
+                 for name, table in (("srcIncremental", self.tsrc), ("dstIncremental", self.tdst))], 2)
+            src_checksums, dst_checksums = results
+            logging.info("%i rows were compared in %s, and %i in %s",
+                         sum(x[0] for x in src_checksums.values()), self.tsrc.get_id_string(),
+                         sum(x[0] for x in dst_checksums.values()), self.tdst.get_id_string())
+            for bucket in set(src_checksums.keys()) | set(dst_checksums.keys()):
+                if str(bucket) in state.differences:
+                    continue  # the replaced rows may not be the same in both tables: the difference is kept
+                difference = [x - y for x, y in zip(src_checksums.get(bucket, (0, 0)),
+                                                    dst_checksums.get(bucket, (0, 0)))]
+                if difference != [0, 0]:
+                    state.differences[str(bucket)] = difference
+            state.watermark = high
+            state.columns = columns
+            state.group_by_column = self.tsrc.get_groupby_column()
+            state.save()
+
+        if len(state.differences) == 0:
+            print("Incremental comparison done up to %s (%s): no differences were found in the rows of %s and %s "
+                  "modified up to this value.\nThe deleted rows, and the rows modified without updating %s, are not "
+                  "compared: use --incremental-reset from time to time to compare again all the rows"
+                  % (state.watermark, column, self.tsrc.get_id_string(), self.tdst.get_id_string(), column))
+            sys.exit(0)
+        buckets = sorted(int(x) for x in state.differences)
+        print("Incremental comparison done up to %s (%s): %i buckets present some differences (%s)"
+              % (state.watermark, column, len(buckets), ",".join(map(str, buckets[:10]))))
+        print("To see them, compare the tables without --incremental-column. Once they are fixed, use "
+              "--incremental-reset to compare again all the rows")
         sys.exit(1)
 
+    @staticmethod
+    def launch_query_additive_checksums(table, column, low, high):
+        """Return the additive checksums of the rows of a table modified between 2 watermarks
+
+        :type table: :class:`_Table`
+        :param table: the table
+
+        :type column: str
+        :param column: the incremental column
+
+        :type low: object
+        :param low: the watermark of the previous comparison
+
+        :type high: object
+        :param high: the watermark of this comparison
+
+        :rtype: dict
+        :returns: for each bucket, the tuple ``(count, key_sum)``
+        """
+        rows = []
+        table.launch_query_rows_result(table.create_sql_additive_checksums(column, low, high), rows, "count")
+        return dict((int(gb), (int(count), int(key_sum))) for gb, count, key_sum in rows)
+
+
+def run_in_parallel(tasks, max_parallel):
+    """Execute some functions in separated threads (at most max_parallel at the same time) and return their results
+
+    :type tasks: list of tuple
+    :param tasks: each task is described by a tuple ``(name, function, args)``, where ``name`` is the name given to the
+            thread, and ``args`` the tuple of the arguments given to the function
+
+    :type max_parallel: int
+    :param max_parallel: the maximum number of threads executing at the same time
+
+    :rtype: list
+    :returns: the results of the functions, in the same order as the tasks
+
+    :raises: the first exception (including SystemExit) raised by one of the functions, once all the threads are done
+    """
+    results = [None] * len(tasks)
+    errors = []
+    semaphore = threading.BoundedSemaphore(max_parallel)
+
+    def execute(index, function, arguments):
+        try:
+            results[index] = function(*arguments)
+        except BaseException:
+            errors.append(sys.exc_info())
+            logging.debug("Error in thread %s", threading.current_thread().name, exc_info=errors[-1])
+        finally:
+            semaphore.release()
+
+    threads = []
+    for idx, (name, function, args) in enumerate(tasks):
+        semaphore.acquire()
+        thread = threading.Thread(name=name, target=execute, args=(idx, function, args))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        reraise(errors[0])
+    return results
+
+
+def reraise(exc_info):
+    """Raise again an exception caught in another thread, with the traceback of that thread
+
+    :type exc_info: tuple
+    :param exc_info: the ``(type, value, traceback)`` returned by sys.exc_info() in the thread
+    """
+    if sys.version_info[0] >= 3:
+        raise exc_info[1].with_traceback(exc_info[2])
+    exec("raise exc_info[0], exc_info[1], exc_info[2]")  # the syntax of Python 2 only
 
-def parse_arguments():
+
+def parse_arguments(argv=None):
     """Parse the arguments received on the command line and returns the args element of argparse
 
+    :type argv: list of str
+    :param argv: the arguments to parse (by default, the ones of the command line)
+
     :rtype: namespace
     :returns: The object that contains all the configuration of the command line
     """
@@ -1030,15 +3392,20 @@ def parse_arguments():
                                      formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument("source", help="the original (correct version) table\n"
                                        "The format must have the following format: <type>/<database>.<table>\n"
-                                       "<type> can be: bq or hive\n ")
-    parser.add_argument("destination", help="the destination table that needs to be compared\n"
-                                            "Format follows the one for the source table")
+                                       "<type> can be: bq or hive\n"
+                                       "A snapshot saved with '--save-snapshot' is given with: snapshot/<path>\n ")
+    parser.add_argument("destination", nargs="*", help="the destination table that needs to be compared\n"
+                                                       "Format follows the one for the source table\n"
+                                                       "Several destination tables can be given: the queries on the "
+                                                       "source\ntable are then only executed once")
 
     parser.add_argument("-s", "--source-options", help="options for the source table\nFor Hive that could be: {'jar': "
                                                        "'hdfs://hdp/user/sluangsay/lib/hcbq.jar', 'hs2': "
                                                        "'master-003.bol.net'}\nExample for BigQuery: {'project': "
                                                        "'myGoogleCloudProject'}")
-    parser.add_argument("-d", "--destination-options", help="options for the destination table")
+    parser.add_argument("-d", "--destination-options", action="append",
+                        help="options for the destination table. With several destination tables, it can be given "
+                             "once\nper destination (in the same order), or once for all of them")
 
     parser.add_argument("--source-where", help="the WHERE condition we want to apply for the source table\n"
                                                "Could be useful in case of partitioned tables\n"
@@ -1071,6 +3438,10 @@ def parse_arguments():
                         help="try to transform the CP1252 encoding from the (string) columns in argument into "
                              "Google's UTF8 encoding (Experimental). Example: 'column1,column14,column23'")
 
+    parser.add_argument("--sample-percent", type=float,
+                        help="take the sample used to find the Group By column from a random percentage of the table\n"
+                             "(TABLESAMPLE) instead of its first rows. Example: 0.1")
+
     parser.add_argument("--group-by-column",
                         help="the column in argument is enforced to be the Group By column. Can be useful if the sample"
                              "query does not manage to find a good Group By column and we need to avoid some skew")
@@ -1078,12 +3449,125 @@ def parse_arguments():
     group_step = parser.add_mutually_exclusive_group()
     group_step.add_argument("--just-count", help="only perform the Count check", action="store_true")
     group_step.add_argument("--just-sha", help="only perform the final sha check", action="store_true")
+    group_step.add_argument("--iblt", action="store_true",
+                            help="instead of the sha check, find directly the rows that are different with an "
+                                 "Invertible\nBloom Lookup Table (no drill down in the buckets)")
+    group_step.add_argument("--quick-check", type=int, metavar="K",
+                            help="only compare a random subset of 1 Group By value out of K (much cheaper), and give "
+                                 "a\nconfidence bound on the rate of differences that could have been missed")
+
+    parser.add_argument("--iblt-cells", type=int, default=30000,
+                        help="number of cells of the IBLT with the '--iblt' option (default: 30 000). About 1.3 cells "
+                             "are\nneeded for each row with differences")
+
+    parser.add_argument("--full-diff", help="when some differences are found in the sha step, extract all the columns "
+                                            "of the rows with differences\nand compare them locally (requires pandas)"
+                                            " instead of showing the column blocks one by one", action="store_true")
+    parser.add_argument("--full-diff-max-rows", type=int, default=100000,
+                        help="maximum number of rows fetched from each table with the '--full-diff' option "
+                             "(default: 100 000)")
+
+    parser.add_argument("--no-column-localization", action="store_true",
+                        help="when showing a column block with differences, show all its columns instead of first "
+                             "launching\nsome light queries to find out which columns of the block are different")
+    parser.add_argument("--bucket-index", action="store_true",
+                        help="before showing the differences, copy the rows of the buckets with differences in a "
+                             "small\ntemporary table, so that the queries of each column block do not read the whole "
+                             "tables")
+    parser.add_argument("--batch-report", metavar="FILE",
+                        help="instead of showing the column blocks with differences one by one (asking before each "
+                             "one),\nfetch all of them at the same time (see '--max-parallel') and write them in a "
+                             "single\ntext report. Useful for the runs without any terminal (schedulers...)")
+
+    parser.add_argument("--cache-dir", default=os.path.join(os.path.expanduser("~"), ".hive_compared_bq"),
+                        help="the local directory where the cached information about the tables is stored\n"
+                             "(default: ~/.hive_compared_bq)")
+    group_cache = parser.add_mutually_exclusive_group()
+    group_cache.add_argument("--refresh-metadata-cache", action="store_true",
+                             help="ignore the cached schemas and Group By columns of the tables, and fetch them again")
+    group_cache.add_argument("--no-metadata-cache", action="store_true",
+                             help="do not use (nor update) the cache of the schemas and Group By columns")
+    parser.add_argument("--result-cache", action="store_true",
+                        help="reuse the results of the Count and sha queries of a previous execution when the table "
+                             "has\nnot been modified since (and the query is the same)")
+    parser.add_argument("--result-cache-size", type=int, default=1000,
+                        help="maximum size (in MB) of the cache of the results, the least recently used ones being "
+                             "deleted\n(default: 1000)")
+    parser.add_argument("--temp-table-ttl", type=int, default=48,
+                        help="delete the temporary tables left in Hive by the previous runs (crashed, not resumed...) "
+                             "that\nwere created more than this number of hours ago. 0 to keep them (default: 48)")
+    parser.add_argument("--max-bytes-billed", type=int,
+                        help="maximum number of bytes processed (and billed) by all the BigQuery queries of the run. "
+                             "Each\nquery is first executed in 'dry run' mode to estimate its cost, and only the "
+                             "Count step\nis done if the sha step does not fit in the budget")
+    parser.add_argument("--local-max-size", type=int, default=32,
+                        help="the tables smaller than this size (in MB) are read, and their checksums are computed "
+                             "locally,\nto avoid the latency of the MapReduce jobs (only for Hive). 0 to always "
+                             "compute\nthe checksums in the databases (default: 32)")
+
+    parser.add_argument("--partition-column",
+                        help="compare the tables partition by partition, each partition (value of this column) being"
+                             " an\nindependent comparison. The partitions are compared in parallel")
+    parser.add_argument("--partitions",
+                        help="the values of the partitions to compare with the '--partition-column' option (by "
+                             "default,\nthey are discovered from both tables). Example: '2017-05-01,2017-05-02'")
+    parser.add_argument("--max-parallel", type=int, default=4,
+                        help="maximum number of partitions, destination tables (or column blocks with "
+                             "'--batch-report')\ncompared at the same time (default: 4)")
+
+    parser.add_argument("--save-snapshot", metavar="FILE",
+                        help="instead of comparing the tables, save the counts and the shas of the source table in a "
+                             "snapshot\nfile, that can later be given as the source table (no destination is needed)")
+
+    parser.add_argument("--resume", metavar="RUN_ID",
+                        help="resume a previous run (that crashed or that was stopped), reusing the results of the "
+                             "phases\nthat were finished (the other arguments must be the same as for that run)")
+    parser.add_argument("--incremental-column", metavar="COLUMN",
+                        help="only compare the rows modified since the last comparison, according to this column "
+                             "(the time\nof the last modification of each row), and fold their checksums into the "
+                             "ones saved by\nthat comparison. The first comparison reads all the rows")
+    parser.add_argument("--incremental-reset", action="store_true",
+                        help="with '--incremental-column', forget the previous comparisons and compare again all the "
+                             "rows")
+    parser.add_argument("--reverify", metavar="RUN_ID",
+                        help="after a fix, only verify again the column blocks and the buckets that presented some "
+                             "differences\nin a previous run (the other arguments must be the same as for that run)")
+    parser.add_argument("--run-ttl", type=int, default=30,
+                        help="delete the states of the previous runs (see --resume and --reverify) that were not "
+                             "modified for\nmore than this number of days. 0 to keep them (default: 30)")
 
     group_log = parser.add_mutually_exclusive_group()
     group_log.add_argument("-v", "--verbose", help="show debug information", action="store_true")
     group_log.add_argument("-q", "--quiet", help="only show important information", action="store_true")
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    args.destinations = args.destination
+    args.destination = args.destinations[0] if len(args.destinations) > 0 else None
+    if args.destination is None and args.save_snapshot is None:
+        parser.error("the destination table is required (unless --save-snapshot is used)")
+    options = args.destination_options or [None]
+    if len(options) not in (1, len(args.destinations)):
+        parser.error("the destination options must be given once, or once per destination table")
+    args.destinations_options = options if len(options) > 1 else options * max(1, len(args.destinations))
+    args.destination_options = args.destinations_options[0]
+    if len(args.destinations) > 1 \
+            and (args.save_snapshot is not None or args.iblt or args.partition_column is not None):
+        parser.error("the options --save-snapshot, --iblt and --partition-column cannot be used with several "
+                     "destination tables")
+    if args.reverify is not None and (len(args.destinations) > 1 or args.save_snapshot is not None or args.iblt
+                                      or args.just_count or args.full_diff or args.partition_column is not None):
+        parser.error("the options --save-snapshot, --iblt, --just-count, --full-diff and --partition-column (or "
+                     "several\ndestination tables) cannot be used with --reverify")
+    if args.incremental_reset and args.incremental_column is None:
+        parser.error("the option --incremental-reset requires --incremental-column")
+    if args.incremental_column is not None \
+            and (len(args.destinations) > 1 or args.save_snapshot is not None or args.iblt or args.just_count
+                 or args.quick_check is not None or args.full_diff or args.partition_column is not None
+                 or args.reverify is not None):
+        parser.error("the options --save-snapshot, --iblt, --just-count, --quick-check, --full-diff, "
+                     "--partition-column\nand --reverify (or several destination tables) cannot be used with "
+                     "--incremental-column")
+    return args
 
 
 def create_table_from_args(definition, options, where, args, tc):
@@ -1121,38 +3605,255 @@ def create_table_from_args(definition, options, where, args, tc):
     return table
 
 
-def main():
-    args = parse_arguments()
+def create_partition_comparator(tc, args, column, value):
+    """Create a new TableComparator, with the same configuration as ``tc``, but restricted to one partition
 
-    level_logging = logging.INFO
-    if args.verbose:
-        level_logging = logging.DEBUG
-    elif args.quiet:
-        level_logging = logging.WARNING
-    logging.basicConfig(level=level_logging, format='[%(levelname)s]\t[%(asctime)s]  (%(threadName)-10s) %(message)s', )
+    New connections are created for the tables, so that several partitions can be compared at the same time. They must
+    be given back with TableComparator.release_connections() once the partition is compared. The schema and the Group By
+    column are taken from ``tc``, which must already be synchronised.
 
-    logging.debug("Starting comparison program with arguments: %s", args)
+    :type tc: :class:`TableComparator`
+    :param tc: the TableComparator of the whole tables
+
+    :type args: :class:`ArgumentParser`
+    :param args: object containing all the arguments from the command line
+
+    :type column: str
+    :param column: the column that partitions the tables
+
+    :type value: str
+    :param value: the value of the partition
+
+    :rtype: :class:`TableComparator`
+    :returns: the TableComparator of the partition
+    """
+    partition_tc = copy.copy(tc)
+    partition_tc.set_checkpoint(None)  # the results of the partitions are saved by the main TableComparator
+    tables = []
+    try:
+        for table, definition, options, where in ((tc.tsrc, args.source, args.source_options, args.source_where),
+                                                  (tc.tdst, args.destination, args.destination_options,
+                                                   args.destination_where)):
+            condition = table.get_sql_partition_condition(column, value)
+            if where is not None:
+                condition = "(%s) AND %s" % (where, condition)
+            partition_table = create_table_from_args(definition, options, condition, args, partition_tc)
+            partition_table._ddl_columns = table.get_ddl_columns()
+            partition_table._ddl_partitions = table._ddl_partitions
+            partition_table._group_by_column = table.get_groupby_column()
+            tables.append(partition_table)
+    except:
+        for partition_table in tables:
+            partition_table.release_connection(False)
+        raise
+    partition_tc.set_tsrc(tables[0])
+    partition_tc.set_tdst(tables[1])
+    return partition_tc
+
+
+def create_worker_comparator(tc, args):
+    """Create a new TableComparator, with the same configuration and the same tables as ``tc``
+
+    New connections are created for the tables, so that several queries on the same table can be executed at the same
+    time (see TableComparator.show_results_batch_report()). They must be given back with
+    TableComparator.release_connections(). The schema, the Group By column and the bucket index are taken from ``tc``,
+    which must already be synchronised.
+
+    :type tc: :class:`TableComparator`
+    :param tc: the TableComparator of the run
+
+    :type args: :class:`ArgumentParser`
+    :param args: object containing all the arguments from the command line
+
+    :rtype: :class:`TableComparator`
+    :returns: the new TableComparator
+    """
+    worker_tc = copy.copy(tc)
+    worker_tc.set_checkpoint(None)  # the results are saved by the main TableComparator
+    tables = []
+    try:
+        for table, definition, options in ((tc.tsrc, args.source, args.source_options),
+                                           (tc.tdst, args.destination, args.destination_options)):
+            worker_table = create_table_from_args(definition, options, table.where_condition, args, worker_tc)
+            worker_table._ddl_columns = table.get_ddl_columns()
+            worker_table._ddl_partitions = table._ddl_partitions
+            worker_table._group_by_column = table.get_groupby_column()
+            worker_table.set_bucket_index(table.bucket_index, table.bucket_index_buckets)
+            tables.append(worker_table)
+    except:
+        for worker_table in tables:
+            worker_table.release_connection(False)
+        raise
+    worker_tc.set_tsrc(tables[0])
+    worker_tc.set_tdst(tables[1])
+    return worker_tc
+
+
+def run_comparison(args, tc=None, run_id=None):
+    """Execute the comparison described by the arguments of the command line
+
+    The result of the comparison is given by the exit code of the program, so this function always ends with a
+    SystemExit exception: 0 if the tables are equal, 1 if some differences were found, EXIT_CODE_FIXED if the
+    differences of a previous run are fixed (see perform_step_reverify()), and an error message otherwise.
+
+    :type args: :class:`ArgumentParser`
+    :param args: object containing all the arguments from the command line (see parse_arguments())
+
+    :type tc: :class:`TableComparator`
+    :param tc: the TableComparator to configure and execute (by default, a new one). The service gives its own one, to
+                share its pool of connections and to follow the progress of the run (see service.py)
 
+    :type run_id: str
+    :param run_id: the identifier of this run (by default, one made of the current time and of the process id). The
+                service gives the identifier of the job, since all its jobs are executed in the same process
+    """
     # Create the TableComparator that contains the definition of the 2 tables we want to compare
-    tc = TableComparator()
+    if tc is None:
+        tc = TableComparator()
     tc.set_max_percent_most_frequent_value_in_column(args.max_gb_percent)
-    source_table = create_table_from_args(args.source, args.source_options, args.source_where, args, tc)
-    destination_table = create_table_from_args(args.destination, args.destination_options, args.destination_where,
-                                               args, tc)
+    tc.set_sample_percent(args.sample_percent)
+    if not args.no_metadata_cache:
+        from metadata_cache import MetadataCache
+        tc.set_metadata_cache(MetadataCache(os.path.join(args.cache_dir, "metadata.json"),
+                                            args.refresh_metadata_cache))
+    if args.result_cache:
+        from result_cache import ResultCache
+        tc.set_result_cache(ResultCache(os.path.join(args.cache_dir, "results"), args.result_cache_size * 1024 * 1024))
+    if args.max_bytes_billed is not None:
+        tc.set_budget(budget.BytesBudget(args.max_bytes_billed))
+    if args.local_max_size > 0:
+        tc.set_local_checksums_max_size(args.local_max_size * 1024 * 1024)
+    # The connections to the tables (and their validation) are done at the same time, since each one may take some
+    # seconds (Kerberos authentication, round trips to Google Cloud...)
+    if args.save_snapshot is not None:
+        tc.set_tsrc(create_table_from_args(args.source, args.source_options, args.source_where, args, tc))
+        tc.save_snapshot(args.save_snapshot)
+        sys.exit(0)
+    tables = run_in_parallel(
+        [("srcCreate", create_table_from_args, (args.source, args.source_options, args.source_where, args, tc))] +
+        [("dstCreate" if idx == 0 else "dstCreate%i" % idx, create_table_from_args,
+          (definition, options, args.destination_where, args, tc))
+         for idx, (definition, options) in enumerate(zip(args.destinations, args.destinations_options))],
+        1 + len(args.destinations))
+    source_table, destination_table = tables[0], tables[1]
+    if "snapshot" in (source_table.get_type(), destination_table.get_type()) \
+            and (args.iblt or args.quick_check is not None or args.partition_column is not None
+                 or args.reverify is not None or args.incremental_column is not None):
+        sys.exit("The options --iblt, --quick-check, --partition-column, --reverify and --incremental-column cannot be "
+                 "used with a snapshot")
     if args.skew_threshold is not None:
         tc.set_skew_threshold(args.skew_threshold)
+    if args.full_diff:
+        tc.set_full_diff_max_rows(args.full_diff_max_rows)
+    tc.set_localize_columns(not args.no_column_localization)
+    tc.set_use_bucket_index(args.bucket_index)
+    if args.batch_report is not None:
+        tc.set_batch_report(args.batch_report, args.max_parallel, lambda: create_worker_comparator(tc, args))
     tc.set_tsrc(source_table)
     tc.set_tdst(destination_table)
 
-    # Step: count
-    if not args.just_sha:
+    from checkpoint import RunCheckpoint
+    runs_dir = os.path.join(args.cache_dir, "runs")
+    if args.resume is not None:
+        checkpoint = RunCheckpoint.load(runs_dir, args.resume)
+    else:
+        checkpoint = RunCheckpoint(runs_dir, run_id)
+    description = {
+        "source": args.source, "destination": ",".join(args.destinations), "source_where": args.source_where,
+        "destination_where": args.destination_where, "column_range": args.column_range, "columns": args.columns,
+        "ignore_columns": args.ignore_columns, "decodeCP1252_columns": args.decodeCP1252_columns,
+        "group_by_column": args.group_by_column, "partition_column": args.partition_column,
+        "partitions": args.partitions, "quick_check": args.quick_check}
+    checkpoint.check_description(description)
+    tc.set_checkpoint(checkpoint)
+    if args.reverify is not None:
+        previous_checkpoint = RunCheckpoint.load(runs_dir, args.reverify)
+        if previous_checkpoint.get_description() != checkpoint.get_description():
+            sys.exit("The run %s cannot be verified again because it was made with other parameters: %s"
+                     % (args.reverify, previous_checkpoint.get_description()))
+        tc.set_reverify(previous_checkpoint)
+    logging.info("The identifier of this run is %s (the run can be resumed with '--resume %s')", checkpoint.run_id,
+                 checkpoint.run_id)
+
+    if args.temp_table_ttl > 0:
+        # the temporary tables of this run (if it is resumed) are kept, whatever their age
+        phase = tc.get_checkpoint_phase("sha")
+        excluded_tables = [x[0] for x in phase["cleaning"]] if phase is not None else []
+        phase = tc.get_checkpoint_phase("bucket_index")
+        excluded_tables += phase["indexes"].values() if phase is not None else []
+        for table in tables:
+            sweeper = threading.Thread(name="sweep-" + table.get_type(), target=table.delete_stale_temporary_tables,
+                                       args=(args.temp_table_ttl * 3600, excluded_tables))
+            sweeper.daemon = True  # the deletions can be done again by the next runs
+            sweeper.start()
+    if args.run_ttl > 0:
+        RunCheckpoint.delete_old_runs(runs_dir, args.run_ttl * 86400,
+                                      [checkpoint.run_id] + [x for x in [args.reverify] if x is not None])
+
+    if args.quick_check is not None:
+        phase = tc.get_checkpoint_phase("quick_check")  # a resumed run must compare the same subset
+        residue = phase["residue"] if phase is not None else random.randrange(args.quick_check)
+        tc.save_checkpoint_phase("quick_check", {"residue": residue})
+        tc.set_quick_check(args.quick_check, residue)
+
+    if args.incremental_column is not None:
+        state = incremental.IncrementalState(os.path.join(args.cache_dir, "incremental"),
+                                             dict(description, incremental_column=args.incremental_column))
+        if not args.incremental_reset:
+            state.load()
+        tc.set_incremental(args.incremental_column, state)
+        tc.perform_step_incremental()
+
+    if args.reverify is not None:
+        tc.perform_step_reverify()
+
+    if args.iblt:
+        tc.set_iblt_cells(args.iblt_cells)
+    if tc.budget is not None:  # the partitions and the destinations are also compared within the budget
+        do_count, do_sha = tc.plan_steps_within_budget(not args.just_sha, not args.just_count, args.iblt, tables[2:])
+        args.just_sha = not do_count
+        args.just_count = not do_sha
+
+    if len(args.destinations) > 1:
+        no_differences = tc.perform_step_destinations(list(zip(args.destinations, tables[1:])), args.max_parallel,
+                                                      not args.just_sha, not args.just_count)
+        sys.exit(0 if no_differences else 1)
+
+    if args.partition_column is not None:
+        partitions = args.partitions.split(",") if args.partitions is not None else None
+        no_differences = tc.perform_step_partitions(
+            args.partition_column, partitions,
+            lambda value: create_partition_comparator(tc, args, args.partition_column, value), args.max_parallel,
+            not args.just_sha, not args.just_count)
+        sys.exit(0 if no_differences else 1)
+
+    # Step: count (even with --just-sha if the metadata already show that the numbers of rows are different)
+    if not args.just_sha or tc.check_metadata_row_counts():
         do_we_continue = tc.perform_step_count()
         if not do_we_continue:
             sys.exit(1)
 
     # Step: sha
-    if not args.just_count:
+    if args.iblt and not args.just_count:
+        tc.perform_step_iblt()
+    elif not args.just_count:
         tc.perform_step_sha()
+    sys.exit(0)
+
+
+def main():
+    args = parse_arguments()
+
+    level_logging = logging.INFO
+    if args.verbose:
+        level_logging = logging.DEBUG
+    elif args.quiet:
+        level_logging = logging.WARNING
+    logging.basicConfig(level=level_logging, format='[%(levelname)s]\t[%(asctime)s]  (%(threadName)-10s) %(message)s', )
+
+    logging.debug("Starting comparison program with arguments: %s", args)
+    run_comparison(args)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,175 @@
+"""
+
+Copyright 2017 bol.com. All Rights Reserved
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Invertible Bloom Lookup Table (IBLT) used to find the rows that are only in one of the tables.
+
+Each row is identified by a 60 bits key (the first 15 hexadecimal digits of the sha1 of the row). Each key is added in
+3 cells of the table, one in each third of the table, given by the 3 slices of 20 bits of the key. A cell contains the
+number of keys, the sum of the keys and the sum of their "checks" (a non linear function of the key). The sums are
+used instead of XOR because Hive does not have any XOR aggregate function. All of this is computed by the databases
+with a GROUP BY on the cell, so only ``number_cells`` rows are fetched from each table.
+
+Subtracting the cells of the 2 tables removes the rows that are present in both tables. The remaining keys are
+recovered by "peeling": a cell that contains a single key can be decoded, and this key is removed from its other
+cells, which may then become decodable too. With 3 cells per key, the peeling succeeds with a high probability if the
+number of differences is lower than about 80% of the number of cells.
+"""
+
+KEY_HEX_DIGITS = 15  # 60 bits, so that the key fits into a signed 64 bits integer in Hive and BigQuery
+SLICE_HEX_DIGITS = 5  # each slice of 20 bits of the key gives the index of a cell
+NUMBER_HASHES = 3  # number of cells where each key is added
+CHECK_PRIME = 2147483647  # the squares of the checks must fit into a signed 64 bits integer
+MAX_SUBTABLE_CELLS = 1 << 20  # a slice of the key can not address more cells
+
+
+def get_subtable_size(number_cells):
+    """Return the number of cells of each third of the table
+
+    :type number_cells: int
+    :param number_cells: the total number of cells of the table
+
+    :rtype: int
+    :returns: the number of cells addressed by each slice of the key
+
+    :raises: ValueError if the number of cells is not supported
+    """
+    size = number_cells // NUMBER_HASHES
+    if size < 1 or size > MAX_SUBTABLE_CELLS:
+        raise ValueError("The number of cells of the IBLT must be between %i and %i"
+                         % (NUMBER_HASHES, NUMBER_HASHES * MAX_SUBTABLE_CELLS))
+    return size
+
+
+def get_cell_indices(key, number_cells):
+    """Return the indices of the cells where the key is added (the same computation is done in SQL)
+
+    :type key: int
+    :param key: the key of the row
+
+    :type number_cells: int
+    :param number_cells: the total number of cells of the table
+
+    :rtype: list of int
+    :returns: the index of the cell in each third of the table
+    """
+    size = get_subtable_size(number_cells)
+    slice_bits = SLICE_HEX_DIGITS * 4
+    slices = [(key >> (slice_bits * (NUMBER_HASHES - 1 - i))) & ((1 << slice_bits) - 1) for i in range(NUMBER_HASHES)]
+    return [i * size + value % size for i, value in enumerate(slices)]
+
+
+def get_check(key):
+    """Return the check of a key (the same computation is done in SQL)
+
+    The check must not be linear, otherwise a sum of keys would always look like a single key.
+
+    :type key: int
+    :param key: the key of the row
+
+    :rtype: int
+    :returns: the check of the key
+    """
+    return (key % CHECK_PRIME) * (key % CHECK_PRIME) % CHECK_PRIME
+
+
+def build_cells(rows):
+    """Transform the rows returned by the IBLT query into the cells of the table
+
+    :type rows: list of tuple
+    :param rows: the rows ``(cell, count, key_sum, check_sum)`` returned by the query
+
+    :rtype: dict
+    :returns: the ``[count, key_sum, check_sum]`` list of each (non empty) cell
+    """
+    # the sums may be received as Decimal or as strings, depending on the database
+    return dict((int(row[0]), [int(row[1]), int(row[2]), int(row[3])]) for row in rows)
+
+
+def subtract(src_cells, dst_cells):
+    """Subtract the cells of the destination table from the ones of the source table
+
+    :type src_cells: dict
+    :param src_cells: the cells of the source table (see build_cells())
+
+    :type dst_cells: dict
+    :param dst_cells: the cells of the destination table
+
+    :rtype: dict
+    :returns: the difference of each cell, for the cells that are different
+    """
+    cells = {}
+    for index in set(src_cells) | set(dst_cells):
+        src_cell = src_cells.get(index, [0, 0, 0])
+        dst_cell = dst_cells.get(index, [0, 0, 0])
+        difference = [src_cell[i] - dst_cell[i] for i in range(3)]
+        if difference != [0, 0, 0]:
+            cells[index] = difference
+    return cells
+
+
+def _get_pure_key(index, cell, number_cells):
+    """Return ``(key, count)`` if the cell contains a single key (that may appear several times, for duplicated rows),
+    or None otherwise. The count is positive for the source table, negative for the destination table"""
+    count, key_sum, check_sum = cell
+    if count == 0 or key_sum % count != 0:
+        return None
+    key = key_sum // count
+    if key < 0 or key >= 1 << (KEY_HEX_DIGITS * 4) or check_sum != count * get_check(key) \
+            or index not in get_cell_indices(key, number_cells):
+        return None
+    return key, count
+
+
+def peel(cells, number_cells):
+    """Recover the keys that are only in one of the tables
+
+    :type cells: dict
+    :param cells: the difference of the cells of the 2 tables (see subtract()). This dictionary is emptied while
+                    peeling
+    :type number_cells: int
+    :param number_cells: the total number of cells of the table
+
+    :rtype: tuple
+    :returns: ``(src_keys, dst_keys, complete)``, where ``src_keys`` (and ``dst_keys``) is a dictionary of the keys only
+                in the source (destination) table with their number of occurrences; and ``complete`` is True if all
+                the differences could be recovered
+    """
+    src_keys = {}
+    dst_keys = {}
+    candidates = list(cells.keys())
+    while len(candidates) > 0:
+        index = candidates.pop()
+        if index not in cells:
+            continue
+        pure = _get_pure_key(index, cells[index], number_cells)
+        if pure is None:
+            continue
+        key, count = pure
+        if count > 0:
+            src_keys[key] = src_keys.get(key, 0) + count
+        else:
+            dst_keys[key] = dst_keys.get(key, 0) - count
+        for cell_index in get_cell_indices(key, number_cells):
+            cell = cells.setdefault(cell_index, [0, 0, 0])
+            cell[0] -= count
+            cell[1] -= count * key
+            cell[2] -= count * get_check(key)
+            if cell == [0, 0, 0]:
+                del cells[cell_index]
+            else:
+                candidates.append(cell_index)
+    return src_keys, dst_keys, len(cells) == 0
@@ -0,0 +1,121 @@
+"""
+
+Copyright 2017 bol.com. All Rights Reserved
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+
+def normalize_watermark(value):
+    """Return the value of the incremental column in a form that can be saved in JSON and put in the SQL queries
+
+    The timestamps fetched from BigQuery are converted into UTC and both databases can parse the resulting string. The
+    numbers are kept as they are.
+
+    :type value: object
+    :param value: the (maximum) value of the incremental column, as returned by the database
+
+    :rtype: object
+    :returns: the number, or the string, that represents the value
+    """
+    if isinstance(value, datetime.datetime):
+        if value.utcoffset() is not None:
+            value = value.replace(tzinfo=None) - value.utcoffset()
+        return value.strftime("%Y-%m-%d %H:%M:%S.%f")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, (int, long, float)):
+        return value
+    return str(value)
+
+
+def get_sql_watermark_literal(value):
+    """Return the SQL literal of a value of the incremental column (see normalize_watermark())"""
+    if isinstance(value, (int, long, float)):
+        return repr(value).rstrip("L")
+    return "'%s'" % value.replace("'", "\\'")
+
+
+class IncrementalState(object):
+    """The state of the incremental comparison of 2 tables, saved between the runs
+
+    The tables are compared with some additive checksums: for each bucket, the number of rows and the sum of the keys
+    of the rows, an integer derived from the sha1 of each row (see _Table.create_sql_additive_checksums()). Those
+    checksums do not depend on the order of the rows, so the checksums of the rows modified since the last run can be
+    compared on their own, and their differences folded into the ones of the previous runs (see
+    TableComparator.perform_step_incremental()).
+
+    The state contains the value of the incremental column up to which the rows have been compared (the watermark)
+    and, for each bucket with some differences, the differences of its checksums. The buckets without differences are
+    not saved. The state is identified by the description of the comparison (tables, WHERE conditions, columns...).
+
+    :type directory: str
+    :param directory: the directory where the states of all the incremental comparisons are stored
+
+    :type description: dict
+    :param description: what describes the comparison
+    """
+
+    def __init__(self, directory, description):
+        key = hashlib.sha1(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+        self.file_name = os.path.join(directory, key + ".json")
+        self.description = description
+        self.reset()
+
+    def reset(self):
+        """Forget the previous comparisons, so that the next one compares all the rows"""
+        self.watermark = None  # the rows whose incremental column is lower or equal have been compared
+        self.columns = None  # the names of the columns compared, and the Group By column
+        self.group_by_column = None
+        self.differences = {}  # key: bucket (str), value: differences of [count, key_sum] between the 2 tables
+
+    def load(self):
+        """Read the state saved by the last comparison, if any
+
+        :rtype: bool
+        :returns: True if a state was found
+        """
+        if not os.path.exists(self.file_name):
+            return False
+        try:
+            with open(self.file_name) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            logging.warning("The incremental state %s is corrupted, so all the rows are compared again",
+                            self.file_name)
+            return False
+        self.watermark = state["watermark"]
+        self.columns = state["columns"]
+        self.group_by_column = state["group_by_column"]
+        self.differences = state["differences"]
+        logging.info("The rows have already been compared up to %s (%i buckets with differences)", self.watermark,
+                     len(self.differences))
+        return True
+
+    def save(self):
+        """Write the state on disk (in an atomic way, so that a crash cannot corrupt it)"""
+        directory = os.path.dirname(self.file_name)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_file = self.file_name + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"description": self.description, "watermark": self.watermark, "columns": self.columns,
+                       "group_by_column": self.group_by_column, "differences": self.differences}, f)
+        os.rename(tmp_file, self.file_name)
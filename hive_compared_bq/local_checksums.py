@@ -0,0 +1,131 @@
+"""
+
+Copyright 2017 bol.com. All Rights Reserved
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Local computation of the counts and of the checksums of each bucket, for the small tables.
+
+Launching the Count and sha queries in Hive costs several MapReduce jobs, each one with tens of seconds of startup
+latency, which is much longer than the time needed to read a small table. For those tables, the database only returns
+the normalized values of each row (see _Table.create_sql_row_values(), a simple projection that Hive executes without
+any MapReduce job) and the checksums are computed here, in a pool of processes.
+
+The computations are exactly the ones of _Table.create_sql_intermediate_checksums(), and the values are converted into
+strings by the database with the same expressions as in that query, so that the results are identical to the ones of
+the database:
+
+* ``block_N`` = base64( sha1( key|value_1|value_2|...|value_5)), for each column block of each row
+* ``row_sha`` = base64( sha1( block_0 block_1 ... block_N)), the block shas being concatenated without separator
+* ``row_sha_gb`` (and each ``block_N_gb``) = base64( sha1( the sorted row_sha (or block_N) of the bucket, joined
+  with '|'))
+"""
+
+import base64
+import hashlib
+import multiprocessing
+
+MIN_ROWS_PER_PROCESS = 10000  # below that, starting the processes costs more than computing the shas
+BYTES_PER_VALUE = 16  # minimum size of each fetched value, to bound the number of values computed locally
+
+
+def _to_bytes(value):
+    """Return the UTF-8 representation of a value, as hashed by the SHA1() functions of the databases"""
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, type(u"")):
+        value = u"%s" % value
+    return value.encode("utf-8")
+
+
+def _sha(text):
+    """Return the base64 encoded sha1 of a byte string (``base64( unhex( SHA1( text)))`` in SQL)"""
+    return base64.b64encode(hashlib.sha1(text).digest())
+
+
+def _compute_buckets(arguments):
+    """Compute the counts and the checksums of some buckets (all the rows of a bucket must be given)
+
+    This function is executed in the processes of the pool, so it only takes one (picklable) argument.
+
+    :type arguments: tuple
+    :param arguments: ``(rows, block_lengths)`` (see compute_checksums())
+
+    :rtype: dict
+    :returns: the ``(count, row_sha_gb, [block_0_gb, block_1_gb...])`` tuple of each bucket
+    """
+    rows, block_lengths = arguments
+    buckets = {}
+    for row in rows:
+        key = _to_bytes(row[1])
+        blocks = []
+        position = 2
+        for length in block_lengths:
+            blocks.append(_sha(b"|".join([key] + [_to_bytes(x) for x in row[position:position + length]])))
+            position += length
+        bucket = buckets.get(row[0])
+        if bucket is None:
+            bucket = buckets[row[0]] = ([], [[] for _ in block_lengths])
+        bucket[0].append(_sha(b"".join(blocks)))
+        for idx, block in enumerate(blocks):
+            bucket[1][idx].append(block)
+
+    results = {}
+    for gb, (row_shas, block_shas) in buckets.items():
+        results[gb] = (len(row_shas), _sha(b"|".join(sorted(row_shas))).decode("ascii"),
+                       [_sha(b"|".join(sorted(shas))).decode("ascii") for shas in block_shas])
+    return results
+
+
+def compute_checksums(rows, block_lengths, processes=None):
+    """Compute the counts and the checksums of each bucket from the normalized values of the rows
+
+    The rows are split by bucket between the processes, so that each process computes the final checksums of its
+    buckets.
+
+    :type rows: list of tuple
+    :param rows: the rows ``(bucket, key_value, value_column_1, value_column_2...)`` returned by the query of
+                    _Table.create_sql_row_values()
+
+    :type block_lengths: list of int
+    :param block_lengths: the number of columns of each column block (see _Table.get_column_blocks())
+
+    :type processes: int
+    :param processes: the maximum number of processes to use (default: the number of CPUs)
+
+    :rtype: dict
+    :returns: the ``(count, row_sha_gb, [block_0_gb, block_1_gb...])`` tuple of each bucket
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(rows) // MIN_ROWS_PER_PROCESS))
+    if processes == 1:
+        return _compute_buckets((rows, block_lengths))
+
+    partitions = [[] for _ in range(processes)]
+    for row in rows:
+        partitions[hash(row[0]) % processes].append(row)
+    pool = multiprocessing.Pool(processes)
+    try:
+        partial_results = pool.map(_compute_buckets, [(partition, block_lengths) for partition in partitions])
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    results = {}
+    for partial_result in partial_results:
+        results.update(partial_result)
+    return results
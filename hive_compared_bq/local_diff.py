@@ -0,0 +1,143 @@
+"""
+
+Copyright 2017 bol.com. All Rights Reserved
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import pandas  # only needed for the '--full-diff' mode, this is why this module is imported lazily
+
+NULL_MARKER = "<NULL>"  # how a NULL value is represented once all the values have been normalized into strings
+OCCURRENCE_COLUMN = "_occurrence"  # technical column to match the rows that share the same key
+
+
+def build_frame(rows, column_names):
+    """Transform the rows fetched from a table into a DataFrame where all the values are normalized into strings
+
+    Hive and BigQuery do not return the same Python types for a same SQL type (Decimal vs float, long vs int...), so
+    we compare the string representations of the values, just like it is done when showing the differences in the
+    HTML page.
+
+    :type rows: list of tuple
+    :param rows: the rows fetched from the table
+
+    :type column_names: list of str
+    :param column_names: the names of the columns of those rows
+
+    :rtype: :class:`pandas.DataFrame`
+    :returns: the DataFrame with the normalized values
+    """
+    normalized = [[NULL_MARKER if value is None else str(value) for value in row] for row in rows]
+    return pandas.DataFrame.from_records(normalized, columns=column_names)
+
+
+def save_frame(frame, file_name):
+    """Save the DataFrame on local disk so that it can be analyzed later on (with pandas.read_pickle())
+
+    :type frame: :class:`pandas.DataFrame`
+    :param frame: the DataFrame to save
+
+    :type file_name: str
+    :param file_name: the path of the file
+    """
+    frame.to_pickle(file_name)
+    logging.debug("%i rows saved in %s", len(frame), file_name)
+
+
+def _add_occurrence(frame, key_columns):
+    """Number the rows sharing the same key, so that duplicated keys can be matched between the 2 tables
+
+    The rows are first sorted on all their columns, so that the n-th occurrence of a key in one table is matched with
+    the n-th occurrence of the same key in the other table.
+    """
+    frame = frame.sort_values(list(frame.columns)).reset_index(drop=True)
+    frame[OCCURRENCE_COLUMN] = frame.groupby(key_columns).cumcount()
+    return frame
+
+
+def compare_frames(src_frame, dst_frame, key_columns, value_columns, number_samples=5):
+    """Match the rows of the 2 DataFrames on their keys and count, for each column, how many rows are different
+
+    :type src_frame: :class:`pandas.DataFrame`
+    :param src_frame: the rows of the source table
+
+    :type dst_frame: :class:`pandas.DataFrame`
+    :param dst_frame: the rows of the destination table
+
+    :type key_columns: list of str
+    :param key_columns: the columns used to match the rows between the 2 tables
+
+    :type value_columns: list of str
+    :param value_columns: the columns that are compared
+
+    :type number_samples: int
+    :param number_samples: the maximum number of keys given as examples for each column with differences
+
+    :rtype: dict
+    :returns: a dictionary with the keys: "rows_matched", "only_in_src" and "only_in_dst" (number of rows), and
+                "columns", a list of ``(column, number_differences, samples)`` sorted by decreasing number of
+                differences, where ``samples`` is a list of ``(key, src_value, dst_value)``
+    """
+    join_columns = key_columns + [OCCURRENCE_COLUMN]
+    merged = pandas.merge(_add_occurrence(src_frame, key_columns), _add_occurrence(dst_frame, key_columns),
+                          on=join_columns, how="outer", suffixes=("_src", "_dst"), indicator=True)
+    matched = merged[merged["_merge"] == "both"]
+
+    report = {"rows_matched": len(matched),
+              "only_in_src": int((merged["_merge"] == "left_only").sum()),
+              "only_in_dst": int((merged["_merge"] == "right_only").sum()),
+              "columns": []}
+    for col in value_columns:
+        src_values = matched[col + "_src"]
+        dst_values = matched[col + "_dst"]
+        mask = (src_values != dst_values).values
+        number_differences = int(mask.sum())
+        if number_differences == 0:
+            continue
+        different = matched[mask].head(number_samples)
+        samples = [(tuple(row[k] for k in key_columns), row[col + "_src"], row[col + "_dst"])
+                   for _, row in different.iterrows()]
+        report["columns"].append((col, number_differences, samples))
+    report["columns"].sort(key=lambda x: -x[1])
+
+    return report
+
+
+def format_report(report, src_name, dst_name):
+    """Return a human readable (text) version of the report generated by compare_frames()
+
+    :type report: dict
+    :param report: the report generated by compare_frames()
+
+    :type src_name: str
+    :param src_name: the name of the source table
+
+    :type dst_name: str
+    :param dst_name: the name of the destination table
+
+    :rtype: str
+    :returns: the text of the report
+    """
+    lines = ["Rows matched: %i" % report["rows_matched"],
+             "Rows only in %s: %i" % (src_name, report["only_in_src"]),
+             "Rows only in %s: %i" % (dst_name, report["only_in_dst"])]
+    if len(report["columns"]) == 0:
+        lines.append("No differences were found in the values of the matched rows")
+    for col, number_differences, samples in report["columns"]:
+        lines.append("Column %s: %i rows with differences. Examples (key: %s value / %s value):"
+                     % (col, number_differences, src_name, dst_name))
+        for key, src_value, dst_value in samples:
+            lines.append("    %s: %s / %s" % (", ".join(key), src_value, dst_value))
+    return "\n".join(lines)
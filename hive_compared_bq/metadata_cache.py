@@ -0,0 +1,134 @@
+"""
+
+Copyright 2017 bol.com. All Rights Reserved
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import logging
+import os
+import threading
+
+
+def _copy_columns(columns):
+    """Return a copy of the description of the columns
+
+    Copies are needed because the columns of the tables may be enriched later on (see _Table.get_groupby_column()). The
+    values are also forced into 'str' to remove the unicode notation that comes from the JSON file.
+    """
+    return [{"name": str(col["name"]), "type": str(col["type"])} for col in columns]
+
+
+class MetadataCache(object):
+    """Persist on local disk the schema and the chosen Group By columns of the tables, to avoid fetching them again
+
+    Each entry is associated with a "version" of the table (built from its last modification time, see
+    _Table.get_table_version()). If the version of the table has changed, then the entry is considered as invalid.
+
+    :type file_name: str
+    :param file_name: the path of the JSON file where the cache is stored
+
+    :type refresh: bool
+    :param refresh: True if we want to ignore the existing entries (they are then overwritten with fresh ones)
+    """
+
+    def __init__(self, file_name, refresh=False):
+        self.file_name = file_name
+        self.refresh = refresh
+        self._lock = threading.Lock()  # the 2 tables may access the cache at the same time
+        self._entries = {}
+        if os.path.exists(file_name):
+            try:
+                with open(file_name) as f:
+                    self._entries = json.load(f)
+            except ValueError:
+                logging.warning("The metadata cache %s is corrupted and will be overwritten", file_name)
+
+    def get(self, table_id, version):
+        """Return the cached entry of a table if it is still valid
+
+        :type table_id: str
+        :param table_id: the string that fully identifies the table (see _Table.get_id_string())
+
+        :type version: str
+        :param version: the current version of the table
+
+        :rtype: dict
+        :returns: the entry ({"version", "columns", "partitions", "group_by_columns"}), or None if there is no valid
+                entry for this table
+        """
+        if self.refresh:
+            return None
+        with self._lock:
+            entry = self._entries.get(table_id)
+        if entry is None or entry["version"] != version:
+            logging.debug("No valid entry in the metadata cache for %s", table_id)
+            return None
+        return {"version": version, "columns": _copy_columns(entry["columns"]),
+                "partitions": _copy_columns(entry["partitions"]),
+                "group_by_columns": dict((k, str(v)) for k, v in entry["group_by_columns"].items())}
+
+    def set(self, table_id, version, columns, partitions):
+        """Register the schema of a table and save the cache on disk
+
+        :type table_id: str
+        :param table_id: the string that fully identifies the table
+
+        :type version: str
+        :param version: the current version of the table
+
+        :type columns: list of dict
+        :param columns: all the columns of the table, with the format: {"name": col_name, "type": col_type}
+
+        :type partitions: list of dict
+        :param partitions: the partition columns of the table, with the same format as ``columns``
+        """
+        with self._lock:
+            self._entries[table_id] = {"version": version, "columns": _copy_columns(columns),
+                                       "partitions": _copy_columns(partitions), "group_by_columns": {}}
+        self.save()
+
+    def set_group_by_column(self, table_id, version, sample_key, column):
+        """Register the Group By column chosen for a table, for a given configuration of the sample
+
+        :type table_id: str
+        :param table_id: the string that fully identifies the table
+
+        :type version: str
+        :param version: the current version of the table
+
+        :type sample_key: str
+        :param sample_key: description of the sample used to choose the column (WHERE condition, columns analyzed...)
+
+        :type column: str
+        :param column: the chosen Group By column
+        """
+        with self._lock:
+            entry = self._entries.get(table_id)
+            if entry is None or entry["version"] != version:
+                return  # the schema should have been registered before
+            entry["group_by_columns"][sample_key] = column
+        self.save()
+
+    def save(self):
+        """Write the cache on disk (in an atomic way, so that a crash cannot corrupt it)"""
+        directory = os.path.dirname(self.file_name)
+        if directory != "" and not os.path.exists(directory):
+            os.makedirs(directory)
+        with self._lock:
+            tmp_file = "%s.%i.tmp" % (self.file_name, os.getpid())
+            with open(tmp_file, "w") as f:
+                json.dump(self._entries, f)
+            os.rename(tmp_file, self.file_name)
@@ -0,0 +1,131 @@
+"""
+
+Copyright 2017 bol.com. All Rights Reserved
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+class ResultCache(object):
+    """Persist on local disk the results of the Count and sha queries, to avoid executing them again
+
+    Each entry is identified by the table, the version of the table (see _Table.get_table_version()) and the text of
+    the query, so that it is automatically invalidated when the table or the query (columns, WHERE condition...)
+    change. Each entry is stored in its own gzipped JSON file, whose modification time is updated each time the entry
+    is read: when the total size of the files exceeds ``max_size``, the least recently used entries are deleted.
+
+    :type directory: str
+    :param directory: the directory where the entries are stored
+
+    :type max_size: int
+    :param max_size: the maximum total size of the entries, in bytes
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()  # the 2 tables (and the partitions) may access the cache at the same time
+
+    def _get_file_name(self, table_id, version, query):
+        """Return the path of the file of an entry"""
+        key = hashlib.sha1(("%s\n%s\n%s" % (table_id, version, query)).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key + ".json.gz")
+
+    def get(self, table_id, version, query):
+        """Return the results cached for a query, if any
+
+        :type table_id: str
+        :param table_id: the string that fully identifies the table (see _Table.get_id_string())
+
+        :type version: str
+        :param version: the current version of the table
+
+        :type query: str
+        :param query: the text of the query
+
+        :rtype: dict
+        :returns: the results saved with set(), or None if there is no entry for this query
+        """
+        file_name = self._get_file_name(table_id, version, query)
+        with self._lock:
+            if not os.path.exists(file_name):
+                logging.debug("No entry in the result cache for the query on %s", table_id)
+                return None
+            try:
+                f = gzip.open(file_name, "rb")
+                try:
+                    entry = json.loads(f.read().decode("utf-8"))
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                logging.warning("The entry %s of the result cache is corrupted and is deleted", file_name)
+                os.remove(file_name)
+                return None
+            os.utime(file_name, None)  # this entry is now the most recently used one
+        if entry["table_id"] != table_id or entry["version"] != version or entry["query"] != query:
+            return None  # collision of the keys (very unlikely)
+        return entry["results"]
+
+    def set(self, table_id, version, query, results):
+        """Save the results of a query, and delete the least recently used entries if the cache is too big
+
+        :type table_id: str
+        :param table_id: the string that fully identifies the table
+
+        :type version: str
+        :param version: the current version of the table
+
+        :type query: str
+        :param query: the text of the query
+
+        :type results: dict
+        :param results: the results of the query. Must be serializable in JSON
+        """
+        file_name = self._get_file_name(table_id, version, query)
+        entry = {"table_id": table_id, "version": version, "query": query, "created": time.time(), "results": results}
+        with self._lock:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            tmp_file = "%s.%i.tmp" % (file_name, os.getpid())
+            f = gzip.open(tmp_file, "wb")
+            try:
+                f.write(json.dumps(entry).encode("utf-8"))
+            finally:
+                f.close()
+            os.rename(tmp_file, file_name)
+            self._evict()
+        logging.debug("The results of the query on %s have been saved in the result cache", table_id)
+
+    def _evict(self):
+        """Delete the least recently used entries until the total size of the cache is below its maximum size"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json.gz"):
+                path = os.path.join(self.directory, name)
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        total_size = sum(x[1] for x in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(path)
+            total_size -= size
+            logging.debug("The entry %s has been evicted from the result cache", path)
@@ -0,0 +1,392 @@
+"""
+
+Copyright 2017 bol.com. All Rights Reserved
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Long-running service that executes the comparisons (the "jobs") submitted through a local HTTP/JSON API.
+
+Each execution of hive_compared_bq.py pays the startup of the process, the imports and the creation of the connections
+(Kerberos authentication for Hive, BigQuery client...). The service executes all the jobs in the same process, keeping
+the connections of the finished jobs in a pool (see connection_pool.py) to reuse them. The jobs are queued, and only a
+limited number of jobs per type of database are executed at the same time, so that HiveServer2 is not overloaded.
+
+API:
+
+* ``POST /jobs`` with ``{"arguments": ["hive/db.table", "bq/dataset.table", "--just-count"]}`` (the same arguments as
+  on the command line, see hive_compared_bq.parse_arguments()): queues a job and returns its description
+* ``GET /jobs``: the descriptions of all the jobs
+* ``GET /jobs/<id>``: the description of a job: its status (queued, running, finished), its progress (the phases that
+  are finished, see RunCheckpoint), and its result once finished: "equal", "differences", "fixed" (see '--reverify')
+  or "error" (with the message)
+* ``GET /status``: the number of jobs in each status, and the statistics of the pool of connections
+
+The column blocks with differences cannot be shown interactively, so they are written in a report (see the
+'--batch-report' option), in the reports directory of the service unless another file is given.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from StringIO import StringIO
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from io import StringIO
+
+import hive_compared_bq
+from connection_pool import ConnectionLease, ConnectionPool
+
+_parse_lock = threading.Lock()  # sys.stderr is redirected while the arguments of a job are parsed
+
+
+def parse_job_arguments(arguments):
+    """Parse the arguments of a job, just like the ones of the command line
+
+    :type arguments: list of str
+    :param arguments: the arguments of the job
+
+    :rtype: namespace
+    :returns: The object that contains all the configuration of the job
+
+    :raises: ValueError if the arguments are invalid
+    """
+    if not isinstance(arguments, list) or not all(isinstance(x, (str, type(u""))) for x in arguments):
+        raise ValueError("The arguments must be a list of strings")
+    with _parse_lock:
+        stderr = sys.stderr
+        sys.stderr = StringIO()  # argparse writes its errors there before exiting
+        try:
+            return hive_compared_bq.parse_arguments([str(x) for x in arguments])
+        except SystemExit:
+            lines = sys.stderr.getvalue().strip().splitlines()  # the usage, and then the error itself
+            raise ValueError(lines[-1] if len(lines) > 0 else "The arguments are invalid")
+        finally:
+            sys.stderr = stderr
+
+
+def get_table_types(args):
+    """Return the types of the databases used by a job (hive, bq, snapshot)
+
+    :type args: namespace
+    :param args: the arguments of the job
+
+    :rtype: list of str
+    :returns: the sorted types of the source and destination tables
+    """
+    definitions = [args.source] + args.destinations
+    return sorted(set(x.split("/", 1)[0] for x in definitions))
+
+
+class Job(object):
+    """A comparison submitted to the service
+
+    :type job_id: str
+    :param job_id: the identifier of the job
+
+    :type arguments: list of str
+    :param arguments: the arguments of the job, as given to the API
+
+    :type args: namespace
+    :param args: the parsed arguments
+    """
+
+    def __init__(self, job_id, arguments, args):
+        self.id = job_id
+        self.arguments = arguments
+        self.args = args
+        self.table_types = get_table_types(args)
+        self.status = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None  # "equal", "differences", "fixed" or "error"
+        self.error = None
+        self.tc = None  # the TableComparator of the job, to follow its progress
+
+    def describe(self):
+        """Return the description of the job, as returned by the API
+
+        :rtype: dict
+        :returns: the description (status, progress, result...) of the job
+        """
+        description = {"id": self.id, "arguments": self.arguments, "status": self.status,
+                       "submitted": self.submitted, "started": self.started, "finished": self.finished}
+        if self.tc is not None and self.tc.checkpoint is not None:
+            description["run_id"] = self.tc.checkpoint.run_id
+            description["phases"] = self.tc.checkpoint.get_phase_names()
+        if self.status == "finished":
+            description["result"] = self.result
+            description["error"] = self.error
+            if self.args.batch_report is not None and os.path.exists(self.args.batch_report):
+                description["report"] = self.args.batch_report
+            if self.tc is not None:  # the other files that show the differences (HTML, sorted rows...)
+                description["files"] = sorted(os.path.join(self.tc.report_dir, x)
+                                              for x in os.listdir(self.tc.report_dir)
+                                              if x.startswith(self.tc.report_prefix))
+        return description
+
+
+class ComparisonService(object):
+    """Queue the jobs and execute them in threads, sharing a pool of connections
+
+    :type limits: dict
+    :param limits: the maximum number of jobs executed at the same time for each type of database (hive, bq). The
+                    other types (snapshot) are not limited
+
+    :type reports_dir: str
+    :param reports_dir: the directory where the reports of the column blocks with differences are written
+
+    :type pool: :class:`ConnectionPool`
+    :param pool: the pool of connections shared by the jobs
+
+    :type max_finished_jobs: int
+    :param max_finished_jobs: the number of finished jobs that are kept (the oldest ones are forgotten)
+    """
+
+    sweep_interval = 3600  # the stale temporary tables of a Hive database are deleted at most once per hour
+
+    def __init__(self, limits, reports_dir, pool, max_finished_jobs=1000):
+        self.limits = limits
+        self.reports_dir = reports_dir
+        self.pool = pool
+        self.max_finished_jobs = max_finished_jobs
+        self._jobs = {}
+        self._order = []  # the identifiers of the jobs, in the order of submission
+        self._queue = []
+        self._running = defaultdict(int)  # number of running jobs for each type of database
+        self._last_sweeps = {}  # key: Hive database, value: time of the last deletion of its stale temporary tables
+        self._condition = threading.Condition()
+        self._counter = 0
+
+    def submit(self, arguments):
+        """Queue a new job
+
+        :type arguments: list of str
+        :param arguments: the arguments of the job, like the ones of the command line
+
+        :rtype: :class:`Job`
+        :returns: the job
+
+        :raises: ValueError if the arguments are invalid
+        """
+        args = parse_job_arguments(arguments)
+        with self._condition:
+            self._counter += 1
+            job_id = "%s_%i" % (time.strftime("%Y%m%d_%H%M%S"), self._counter)
+            if args.save_snapshot is None and args.batch_report is None and not args.full_diff:
+                args.batch_report = os.path.join(self.reports_dir, job_id + ".txt")  # nobody can answer the questions
+            self._skip_recent_sweeps(args)
+            job = Job(job_id, arguments, args)
+            self._jobs[job_id] = job
+            self._order.append(job_id)
+            self._queue.append(job)
+            self._forget_old_jobs()
+            self._start_jobs()
+        logging.info("Job %s submitted: %s", job_id, " ".join(arguments))
+        return job
+
+    def _skip_recent_sweeps(self, args):
+        """Only delete the stale temporary tables of the Hive databases that were not swept recently by other jobs"""
+        now = time.time()
+        databases = [x.split(".", 1)[0] for x in [args.source] + args.destinations if x.startswith("hive/")]
+        if all(now - self._last_sweeps.get(x, 0) < self.sweep_interval for x in databases):
+            args.temp_table_ttl = 0
+        else:
+            for database in databases:
+                self._last_sweeps[database] = now
+
+    def _forget_old_jobs(self):
+        """Forget the oldest finished jobs, above max_finished_jobs"""
+        finished = [x for x in self._order if self._jobs[x].status == "finished"]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+            self._order.remove(job_id)
+
+    def _start_jobs(self):
+        """Start the queued jobs (in the order of submission) whose types of database are below their limit
+
+        Must be called with self._condition acquired.
+        """
+        for job in list(self._queue):
+            if all(self._running[x] < self.limits.get(x, sys.maxsize) for x in job.table_types):
+                self._queue.remove(job)
+                for table_type in job.table_types:
+                    self._running[table_type] += 1
+                job.status = "running"
+                job.started = time.time()
+                thread = threading.Thread(name="job-" + job.id, target=self._run, args=(job,))
+                thread.daemon = True
+                thread.start()
+
+    def _run(self, job):
+        """Execute a job, and then start the next queued jobs"""
+        lease = ConnectionLease(self.pool)
+        job.tc = hive_compared_bq.TableComparator()
+        job.tc.set_connection_pool(lease)
+        job.tc.set_report_files(self.reports_dir, job.id + "_", False)  # no browser, and no file shared by the jobs
+        exit_code = None
+        try:
+            hive_compared_bq.run_comparison(job.args, job.tc, job.id)  # 2 jobs may start in the same second
+        except SystemExit:
+            exit_code = sys.exc_info()[1].code
+        except:
+            logging.exception("The job %s failed", job.id)
+            exit_code = "%s" % sys.exc_info()[1]
+        if exit_code is None or exit_code == 0:
+            job.result = "equal"
+        elif exit_code == 1:
+            job.result = "differences"
+        elif exit_code == hive_compared_bq.EXIT_CODE_FIXED:
+            job.result = "fixed"  # only the differences of a previous run were compared again
+        else:
+            job.result = "error"
+            job.error = "%s" % exit_code
+        job.tc.wait_for_cleaning()  # the temporary tables are deleted with the connections that are given back
+        lease.release_all(job.result != "error")  # after an error, the state of the connections is unknown
+        logging.info("Job %s finished: %s", job.id, job.result)
+
+        with self._condition:
+            job.status = "finished"
+            job.finished = time.time()
+            for table_type in job.table_types:
+                self._running[table_type] -= 1
+            self._start_jobs()
+
+    def get_job(self, job_id):
+        """Return the description of a job (see Job.describe()), or None if it does not exist"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+        return job.describe() if job is not None else None
+
+    def get_jobs(self):
+        """Return the descriptions of all the jobs, in the order of submission"""
+        with self._condition:
+            jobs = [self._jobs[x] for x in self._order]
+        return [x.describe() for x in jobs]
+
+    def get_status(self):
+        """Return the number of jobs in each status and the statistics of the pool of connections"""
+        with self._condition:
+            statuses = defaultdict(int)
+            for job in self._jobs.values():
+                statuses[job.status] += 1
+            running = dict(self._running)
+        return {"jobs": dict(statuses), "running_per_type": running, "limits": self.limits,
+                "connections": self.pool.get_statistics()}
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """Handle the requests of the API (see the description of the module)"""
+
+    service = None  # the ComparisonService, set by main()
+
+    def _send(self, code, body):
+        content = json.dumps(body, indent=2, sort_keys=True).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path == "/jobs":
+            self._send(200, self.service.get_jobs())
+        elif self.path.startswith("/jobs/"):
+            job = self.service.get_job(self.path[len("/jobs/"):])
+            if job is None:
+                self._send(404, {"error": "Unknown job"})
+            else:
+                self._send(200, job)
+        elif self.path == "/status":
+            self._send(200, self.service.get_status())
+        else:
+            self._send(404, {"error": "Unknown path"})
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self._send(404, {"error": "Unknown path"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+            job = self.service.submit(body.get("arguments") if isinstance(body, dict) else None)
+        except ValueError:
+            self._send(400, {"error": "%s" % sys.exc_info()[1]})
+            return
+        self._send(201, job.describe())
+
+    def log_message(self, message_format, *args):
+        logging.debug("%s - " + message_format, self.address_string(), *args)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def parse_arguments():
+    """Parse the arguments received on the command line and returns the args element of argparse
+
+    :rtype: namespace
+    :returns: The object that contains all the configuration of the service
+    """
+    parser = argparse.ArgumentParser(description="Execute the comparisons submitted through a local HTTP/JSON API",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1", help="the address to listen to (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8089, help="the port to listen to (default: 8089)")
+    parser.add_argument("--max-hive-jobs", type=int, default=2,
+                        help="maximum number of jobs using Hive executed at the same time (default: 2)")
+    parser.add_argument("--max-bq-jobs", type=int, default=8,
+                        help="maximum number of jobs using BigQuery executed at the same time (default: 8)")
+    parser.add_argument("--max-idle-time", type=int, default=600,
+                        help="the connections unused for more than this number of seconds are closed instead of "
+                             "being\nreused (default: 600)")
+    parser.add_argument("--reports-dir", default=os.path.join(os.path.expanduser("~"), ".hive_compared_bq", "reports"),
+                        help="the directory where the column blocks with differences of each job are written\n"
+                             "(default: ~/.hive_compared_bq/reports)")
+    parser.add_argument("-v", "--verbose", help="show debug information", action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='[%(levelname)s]\t[%(asctime)s]  (%(threadName)-10s) %(message)s', )
+    if not os.path.exists(args.reports_dir):
+        os.makedirs(args.reports_dir)
+
+    pool = ConnectionPool(args.max_idle_time)
+    _RequestHandler.service = ComparisonService({"hive": args.max_hive_jobs, "bq": args.max_bq_jobs},
+                                                args.reports_dir, pool)
+    server = _ThreadingHTTPServer((args.host, args.port), _RequestHandler)
+    logging.info("Listening on http://%s:%i", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+
+Copyright 2017 bol.com. All Rights Reserved
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Snapshots of the "fingerprint" of a table: the number of rows, the row sha and the block shas of each Group By value
+(bucket), as computed by the Count and sha queries. A snapshot can later be used instead of the table it was taken
+from, so that an immutable source table does not have to be scanned again each time a new destination is validated.
+"""
+
+import gzip
+import json
+import logging
+import os
+import time
+# noinspection PyProtectedMember
+from hive_compared_bq import _Table
+
+FORMAT_NAME = "hive_compared_bq_snapshot"
+FORMAT_VERSION = 1  # to be increased each time the content of the file changes in an incompatible way
+
+
+def write_snapshot(file_name, table, counts, sha_rows):
+    """Save the fingerprint of a table in a (gzipped JSON) snapshot file
+
+    :type file_name: str
+    :param file_name: the path of the snapshot file
+
+    :type table: :class:`_Table`
+    :param table: the table the fingerprint was computed from
+
+    :type counts: dict
+    :param counts: the number of rows of each bucket (result of the Group By Count query)
+
+    :type sha_rows: list of tuple
+    :param sha_rows: the rows ``(bucket, row_sha, block_0_sha, block_1_sha...)`` of the sha query
+    """
+    shas = dict((int(row[0]), row[1:]) for row in sha_rows)
+    buckets = []
+    for bucket in sorted(set(int(k) for k in counts) | set(shas)):
+        row_shas = shas.get(bucket)
+        buckets.append([bucket, int(counts.get(bucket, 0)), None if row_shas is None else str(row_shas[0]),
+                        [] if row_shas is None else [str(x) for x in row_shas[1:]]])
+
+    content = {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "table": {"id": table.get_id_string(), "database": table.database, "table": table.table,
+                  "where_condition": table.where_condition, "version": table.get_table_version()},
+        "columns": [{"name": x["name"], "type": x["type"]} for x in table.get_ddl_columns()],
+        "partitions": [{"name": x["name"], "type": x["type"]} for x in table._ddl_partitions],
+        "group_by_column": table.get_groupby_column(),
+        "block_size": table.tc.block_size,
+        "number_of_group_by": table.tc.number_of_group_by,
+        "buckets": buckets
+    }
+    directory = os.path.dirname(file_name)
+    if directory != "" and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp_file = "%s.%i.tmp" % (file_name, os.getpid())
+    f = gzip.open(tmp_file, "wb")
+    try:
+        f.write(json.dumps(content).encode("utf-8"))
+    finally:
+        f.close()
+    os.rename(tmp_file, file_name)
+    logging.info("The snapshot of %s (%i buckets, %i rows) has been saved in %s", table.get_id_string(),
+                 len(buckets), sum(x[1] for x in buckets), file_name)
+
+
+def read_snapshot(file_name):
+    """Load a snapshot file
+
+    :type file_name: str
+    :param file_name: the path of the snapshot file
+
+    :rtype: dict
+    :returns: the content of the snapshot (see write_snapshot())
+
+    :raises: ValueError if the file is not a snapshot, or a snapshot in an unsupported version
+    """
+    if not os.path.exists(file_name):
+        raise ValueError("The snapshot file %s does not exist" % file_name)
+    f = gzip.open(file_name, "rb")
+    try:
+        content = json.loads(f.read().decode("utf-8"))
+    except (IOError, ValueError):
+        raise ValueError("The file %s is not a valid snapshot" % file_name)
+    finally:
+        f.close()
+    if not isinstance(content, dict) or content.get("format") != FORMAT_NAME:
+        raise ValueError("The file %s is not a valid snapshot" % file_name)
+    if content["version"] != FORMAT_VERSION:
+        raise ValueError("The snapshot %s has the version %s, but only the version %i is supported"
+                         % (file_name, content["version"], FORMAT_VERSION))
+    return content
+
+
+class TSnapshot(_Table):
+    """Snapshot implementation of the _Table object: the fingerprint of a table saved on local disk
+
+    A snapshot cannot execute any SQL: the "queries" it creates are just the names of the results it holds. The rows of
+    the table are not saved, so the differences that are found can only be shown for the other table.
+
+    :type file_name: str
+    :param file_name: the path of the snapshot file
+    """
+
+    count_query = "counts"
+    sha_query = "shas"
+
+    def __init__(self, file_name, parent):
+        content = read_snapshot(file_name)
+        _Table.__init__(self, str(content["table"]["database"]), str(content["table"]["table"]), parent)
+        self.file_name = file_name
+        self.source_id = str(content["table"]["id"])
+        self.created = str(content["created"])
+        self.snapshot_where_condition = content["table"]["where_condition"]
+        for name in ("block_size", "number_of_group_by"):
+            if content[name] != getattr(parent, name):
+                raise ValueError("The snapshot %s was made with a %s of %s, while the current one is %s"
+                                 % (file_name, name, content[name], getattr(parent, name)))
+
+        # the schema and the Group By column are the ones of the snapshot, whatever the options of the command line
+        self._ddl_columns = [{"name": str(x["name"]), "type": str(x["type"])} for x in content["columns"]]
+        self._ddl_partitions = [{"name": str(x["name"]), "type": str(x["type"])} for x in content["partitions"]]
+        self._group_by_column = str(content["group_by_column"])
+        self._counts = dict((x[0], x[1]) for x in content["buckets"])
+        self._shas = dict((x[0], str(x[2])) for x in content["buckets"] if x[2] is not None)
+        self._block_shas = dict((x[0], [str(sha) for sha in x[3]]) for x in content["buckets"] if x[2] is not None)
+        logging.info("The snapshot %s of %s (taken on %s with the WHERE condition: %s) has been loaded", file_name,
+                     self.source_id, self.created, self.snapshot_where_condition)
+
+    def get_type(self):
+        return "snapshot"
+
+    def set_where_condition(self, where):
+        if where is not None:
+            raise ValueError("No WHERE condition can be applied on a snapshot (the snapshot %s was taken with the "
+                             "condition: %s)" % (self.file_name, self.snapshot_where_condition))
+
+    def set_group_by_column(self, col):
+        if col is not None and col != self._group_by_column:
+            raise ValueError("The snapshot %s was taken with the Group By column %s, so it cannot be compared with "
+                             "the Group By column %s" % (self.file_name, self._group_by_column, col))
+
+    def fetch_ddl_columns(self):
+        return self._ddl_columns, self._ddl_partitions
+
+    def fetch_table_version(self):
+        return self.created
+
+    def get_partition_values(self, column):
+        raise ValueError("A snapshot cannot be compared partition by partition")
+
+    def get_metadata_row_count(self):
+        return sum(self._counts.values())
+
+    def get_table_size(self):
+        return None  # the checksums are already in the snapshot
+
+    def get_metadata_partition_row_counts(self, column, values):
+        return dict((value, None) for value in values)
+
+    def get_column_statistics(self, query, selected_columns):
+        raise ValueError("The Group By column of a snapshot cannot be changed")
+
+    def get_sql_sample_clause(self, percent):
+        return ""
+
+    def get_sql_quick_check_condition(self, modulo, residue):
+        raise ValueError("A quick check cannot be done on a snapshot")
+
+    def get_sql_bucket_expression(self):
+        return "gb"
+
+    def get_sql_column_value(self, col):
+        return col["name"]
+
+    def create_sql_groupby_count(self):
+        return self.count_query
+
+    def create_sql_show_bucket_columns(self, extra_columns_str, buckets_values):
+        return ""  # the rows are not in the snapshot
+
+    def create_sql_bucket_index(self, columns, buckets_values):
+        return ""  # the rows are not in the snapshot
+
+    def create_sql_column_checksums(self, columns, buckets_values):
+        return ""  # the checksums of each column are not in the snapshot
+
+    def create_sql_intermediate_checksums(self, buckets_values=None):
+        return self.sha_query
+
+    def create_sql_row_values(self):
+        return ""  # the rows are not in the snapshot
+
+    def create_sql_iblt(self, number_cells):
+        raise ValueError("The keys of the rows (needed by the IBLT comparison) are not in a snapshot")
+
+    def create_sql_additive_checksums(self, column, low, high):
+        raise ValueError("The keys of the rows (needed by the incremental comparison) are not in a snapshot")
+
+    def create_sql_show_rows_by_keys(self, columns, keys):
+        return ""
+
+    def delete_temporary_table(self, table_name):
+        pass  # the snapshot file is never deleted
+
+    def create_temporary_table(self, query):
+        raise ValueError("No temporary table can be created from a snapshot")
+
+    def temporary_table_exists(self, table_name):
+        return os.path.exists(table_name)
+
+    def launch_query_dict_result(self, query, result_dic, all_columns_from_2=False, query_type="count"):
+        if query == self.count_query:
+            result_dic.update(self._counts)
+        else:
+            result_dic["error"] = "This information is not available in the snapshot %s" % self.file_name
+
+    def launch_query_csv_compare_result(self, query, rows, query_type="drilldown"):
+        logging.warning("The rows of %s are not saved in the snapshot %s, so only the rows of the other table are "
+                        "shown", self.source_id, self.file_name)
+
+    def launch_query_rows_result(self, query, rows, query_type="drilldown"):
+        logging.warning("The rows of %s are not saved in the snapshot %s, so only the rows of the other table are "
+                        "shown", self.source_id, self.file_name)
+
+    def launch_query_with_intermediate_table(self, query, result):
+        result["names_sha_tables"][self.get_id_string()] = self.file_name
+        result["sha_dictionaries"][self.get_id_string()].update(self._shas)
+
+    def launch_cached_query_dict_result(self, query, result_dic):
+        self.launch_query_dict_result(query, result_dic)  # the snapshot is already a local cache
+
+    def launch_cached_query_with_intermediate_table(self, query, result):
+        self.launch_query_with_intermediate_table(query, result)
+
+    def launch_query_block_shas(self, temp_table, buckets_values, result_dic):
+        buckets = [int(x) for x in buckets_values.split(",") if x.strip() != ""]
+        for bucket in buckets:
+            if bucket in self._block_shas:
+                result_dic[bucket] = self._block_shas[bucket]
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+
+Copyright 2017 bol.com. All Rights Reserved
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Check that the checksums computed locally follow the formula of the query of THive.create_sql_intermediate_checksums(),
+and that the values fetched for them are converted into strings by Hive with the same expressions as the values
+concatenated by that query (the conversions themselves are made by Hive, so they are not checked here).
+
+Run with: python -m unittest discover tests
+"""
+
+import base64
+import hashlib
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "hive_compared_bq"))
+
+import hive_compared_bq  # noqa: E402
+import local_checksums  # noqa: E402
+
+try:
+    from hive import THive
+except ImportError:  # pyhs2 is not installed
+    THive = None
+else:
+    class OfflineHive(THive):
+        """A Hive table that is not connected, to only build its queries"""
+
+        def _create_connection(self):
+            return None
+
+
+def sql_sha(text):
+    """base64( unhex( SHA1( text)))"""
+    return base64.b64encode(hashlib.sha1(text.encode("utf-8")).digest()).decode("ascii")
+
+
+def sql_checksums(rows, block_lengths):
+    """Straightforward translation of the Hive query of create_sql_intermediate_checksums()"""
+    blocks = []  # 1st CTE: gb, block_0, block_1... with block_N = base64( unhex( SHA1( concat( key, '|', col, '|'...
+    for row in rows:
+        row_blocks = []
+        position = 2
+        for length in block_lengths:
+            row_blocks.append(sql_sha(u"|".join([row[1]] + list(row[position:position + length]))))
+            position += length
+        blocks.append((row[0], row_blocks))
+    full_lines = [(gb, sql_sha(u"".join(row_blocks)), row_blocks) for gb, row_blocks in blocks]  # 2nd CTE
+    results = {}
+    for gb in set(line[0] for line in full_lines):  # final query: concat_ws( '|', sort_array( collect_list( ...
+        lines = [line for line in full_lines if line[0] == gb]
+        results[gb] = (len(lines), sql_sha(u"|".join(sorted(line[1] for line in lines))),
+                       [sql_sha(u"|".join(sorted(line[2][idx] for line in lines)))
+                        for idx in range(len(block_lengths))])
+    return results
+
+
+class TestComputeChecksums(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = []
+        for i in range(200):
+            self.rows.append((i % 7, u"key%i" % i, u"%i" % (i * 3), u"café %i" % i, u"", u"3.5", u"x|y"))
+
+    def test_identical_to_sql(self):
+        for block_lengths in ([5], [2, 3], [1, 1, 1, 1, 1]):
+            self.assertEqual(local_checksums.compute_checksums(self.rows, block_lengths, 1),
+                             sql_checksums(self.rows, block_lengths))
+
+    def test_independent_of_row_order(self):
+        self.assertEqual(local_checksums.compute_checksums(list(reversed(self.rows)), [2, 3], 1),
+                         local_checksums.compute_checksums(self.rows, [2, 3], 1))
+
+    def test_several_processes(self):
+        rows = [(i % 101, u"key%i" % i, u"%i" % i) for i in range(3 * local_checksums.MIN_ROWS_PER_PROCESS)]
+        self.assertEqual(local_checksums.compute_checksums(rows, [1], 3), sql_checksums(rows, [1]))
+
+    def test_utf8_byte_strings(self):
+        # the values may be fetched as UTF-8 encoded byte strings (pyhs2 in Python 2)
+        rows = [tuple(x.encode("utf-8") if isinstance(x, type(u"")) else x for x in row) for row in self.rows]
+        self.assertEqual(local_checksums.compute_checksums(rows, [2, 3], 1),
+                         local_checksums.compute_checksums(self.rows, [2, 3], 1))
+
+    def test_normalized_values(self):
+        # the values as normalized by THive.get_sql_column_value(): NULL markers, doubles multiplied by 10000 and
+        # floored, booleans, timestamps and decimals converted into strings by Hive
+        rows = [(0, u"1", u"n_pr", u"35000", u"true", u"2017-03-01 12:34:56.789", u"3.50"),
+                (0, u"2", u"-12346", u"n_ra", u"false", u"n_up", u"n_am"),
+                (1, u"n_key", u"0", u"1", u"true", u"1970-01-01 00:00:00", u"-0.01")]
+        self.assertEqual(local_checksums.compute_checksums(rows, [5], 1), sql_checksums(rows, [5]))
+
+
+@unittest.skipIf(THive is None, "pyhs2 is not installed")
+class TestHiveRowValues(unittest.TestCase):
+
+    def setUp(self):
+        self.table = OfflineHive("db", "t", hive_compared_bq.TableComparator(), "hs2", None)
+        self.table._ddl_columns = [{"name": name, "type": column_type} for name, column_type in (
+            ("id", "bigint"), ("name", "string"), ("price", "double"), ("ratio", "float"), ("active", "boolean"),
+            ("updated", "timestamp"), ("day", "date"), ("amount", "decimal(10,2)"), ("label", "string"))]
+        self.table.decodeCP1252_columns = ["label"]
+        self.table._group_by_column = "id"
+
+    def test_same_conversions(self):
+        row_values = self.table.create_sql_row_values()
+        checksums = self.table.create_sql_intermediate_checksums()
+        self.assertIn("%s, '|'" % self.table.get_sql_key_value(), checksums)
+        self.assertIn(", %s, " % self.table.get_sql_key_value(), row_values)
+        positions = []
+        for col in self.table.get_ddl_columns():
+            value = self.table.get_sql_column_value(col)
+            self.assertIn(value, checksums)
+            self.assertIn("concat( %s)" % value, row_values)  # concat() converts them like in the checksums
+            positions.append(row_values.index("concat( %s)" % value))
+        self.assertEqual(positions, sorted(positions))  # the order of the columns in the blocks
+
+
+if __name__ == "__main__":
+    unittest.main()